@@ -1,40 +1,220 @@
 from __future__ import annotations
-from fastapi import APIRouter, HTTPException
-from .models import CreateTaskRequest, CreateTaskResponse, Task
-from .redis_store import RedisStore
-from .redis_queue import RedisQueue
+import asyncio
+import json
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
+from .models import (
+    CreateTaskRequest, CreateTaskResponse, Task,
+    BulkCreateTasksRequest, BulkCreateTasksResponse, BulkCreateItemResult,
+    BulkStatusRequest, BulkStatusResponse, BulkStatusItem,
+)
+from .storage import EventHub, TaskQueue, TaskStore
 from .metrics import metrics
+from .config import settings
+from . import codec
 
 router = APIRouter()
 
+# Placeholders; main.py binds the real instances via app.dependency_overrides
+def get_store() -> TaskStore:
+    raise RuntimeError("store dependency is not configured")
+
+def get_queue() -> TaskQueue:
+    raise RuntimeError("queue dependency is not configured")
+
+def get_event_hub() -> EventHub:
+    raise RuntimeError("event hub dependency is not configured")
+
 def _not_found(task_id: str) -> HTTPException:
     return HTTPException(status_code=404, detail=f"Task not found: {task_id}")
 
 @router.post("/tasks", response_model=CreateTaskResponse)
-async def create_task(req: CreateTaskRequest, store: RedisStore, queue: RedisQueue):
+async def create_task(
+    req: CreateTaskRequest,
+    store: TaskStore = Depends(get_store),
+    queue: TaskQueue = Depends(get_queue),
+):
     from .models import Task
-    task = Task(goal=req.goal, idempotency_key=req.idempotency_key)
-    created = await store.create_or_get_task(task)
+    task = Task(goal=req.goal, idempotency_key=req.idempotency_key, priority=req.priority, tenant=req.tenant)
+    # Creation, idempotency reservation and enqueue happen in one atomic script;
+    # a task returned for an existing idempotency key is never requeued
+    created = await store.create_or_get_task(task, queue=queue)
+
+    metrics.inc("tasks_created_total")
+    return CreateTaskResponse(task_id=created.task_id, status=created.status)
+
+@router.post("/tasks/bulk", response_model=BulkCreateTasksResponse)
+async def create_tasks_bulk(
+    req: BulkCreateTasksRequest,
+    store: TaskStore = Depends(get_store),
+    queue: TaskQueue = Depends(get_queue),
+):
+    if len(req.tasks) > settings.bulk_max_items:
+        raise HTTPException(status_code=413, detail=f"too many tasks: {len(req.tasks)} > {settings.bulk_max_items}")
+
+    results: List[BulkCreateItemResult] = []
+    to_create: List[Task] = []
+    owners: List[BulkCreateItemResult] = []
+    first_by_key: Dict[str, BulkCreateItemResult] = {}
+    duplicates: List[BulkCreateItemResult] = []
+
+    for i, raw in enumerate(req.tasks):
+        item = BulkCreateItemResult(index=i, ok=False)
+        results.append(item)
+        try:
+            r = CreateTaskRequest.model_validate(raw)
+        except ValidationError as e:
+            item.error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+            continue
+        if r.idempotency_key and r.idempotency_key in first_by_key:
+            item.duplicate_of = first_by_key[r.idempotency_key].index
+            duplicates.append(item)
+            continue
+        if r.idempotency_key:
+            first_by_key[r.idempotency_key] = item
+        to_create.append(Task(goal=r.goal, idempotency_key=r.idempotency_key, priority=r.priority, tenant=r.tenant))
+        owners.append(item)
+
+    for item, res in zip(owners, await store.create_many(to_create, queue=queue)):
+        if isinstance(res, Exception):
+            item.error = f"store error: {res}"
+            continue
+        t, created = res
+        item.ok, item.task_id, item.status, item.created = True, t.task_id, t.status, created
+
+    for item in duplicates:
+        first = results[item.duplicate_of]
+        item.ok, item.task_id, item.status, item.error = first.ok, first.task_id, first.status, first.error
+
+    created = sum(1 for it in results if it.created)
+    failed = sum(1 for it in results if not it.ok)
+    metrics.inc("tasks_created_total", created)
+    return BulkCreateTasksResponse(
+        created=created, existing=len(results) - created - failed, failed=failed, results=results,
+    )
 
-    # If idempotency returned an existing completed task, dont requeue
-    if created.status == "queued":
-        await queue.enqueue(created.task_id)
-    
-    await metrics.inc("task_created", 1)
-    return CreateTaskRequest(task_id=created.task_id, status=created.status)
+@router.post("/tasks/status", response_model=BulkStatusResponse)
+async def get_tasks_status(req: BulkStatusRequest, store: TaskStore = Depends(get_store)):
+    if len(req.task_ids) > settings.bulk_max_items:
+        raise HTTPException(status_code=413, detail=f"too many task ids: {len(req.task_ids)} > {settings.bulk_max_items}")
+    tasks = await store.get_tasks(req.task_ids, include_steps=req.include_steps)
+    return BulkStatusResponse(
+        results=[BulkStatusItem(task_id=tid, found=t is not None, task=t) for tid, t in zip(req.task_ids, tasks)]
+    )
 
 @router.get("/tasks/{task_id}", response_model=Task)
-async def get_task(task_id:str, store: RedisStore):
+async def get_task(task_id:str, store: TaskStore = Depends(get_store)):
     t = await store.get_task(task_id)
     if not t:
         raise _not_found(task_id)
     return t
 
+def _sse(event: str, data: str, event_id: Optional[int] = None) -> str:
+    head = f"event: {event}\n"
+    if event_id is not None:
+        head += f"id: {event_id}\n"
+    return head + f"data: {data}\n\n"
+
+def _status_data(t: Task) -> str:
+    return json.dumps({"status": t.status, "result": t.result, "error": t.error})
+
+@router.get("/tasks/{task_id}/events")
+async def task_events(
+    task_id: str,
+    request: Request,
+    from_step: int = 1,
+    store: TaskStore = Depends(get_store),
+    hub: EventHub = Depends(get_event_hub),
+):
+    """
+    Server-Sent Events: every StepRecord (event `step`) and status change
+    (event `status`) as it is written, then `end` once the task is terminal.
+    Resume with ?from_step=N or the Last-Event-ID header. A step's event id
+    is the highest step_no up to which every step has been sent: a step
+    re-run after a delayed retry arrives after later ones, so a resume may
+    repeat a step (same step_no) but never skips one.
+    """
+    last_id = request.headers.get("last-event-id", "")
+    if last_id.isdigit():
+        from_step = max(from_step, int(last_id) + 1)
+
+    # Subscribe before reading the backlog so nothing falls in between
+    sub = await hub.subscribe(task_id)
+    try:
+        task = await store.get_task(task_id)
+    except BaseException:
+        await hub.unsubscribe(sub)
+        raise
+    if not task:
+        await hub.unsubscribe(sub)
+        raise _not_found(task_id)
+
+    async def stream() -> AsyncIterator[str]:
+        snapshot: Optional[Task] = task
+        # Every step up to low was sent; sent holds the ones sent above it
+        low = from_step - 1
+        sent: Set[int] = set()
+
+        def take(step_no: int) -> Optional[int]:
+            """The event id to send step_no with, or None if it was sent already."""
+            nonlocal low
+            if step_no <= low or step_no in sent:
+                return None
+            sent.add(step_no)
+            while low + 1 in sent:
+                low += 1
+                sent.discard(low)
+            return low
+
+        try:
+            while snapshot is not None:
+                for st in snapshot.steps:
+                    event_id = take(st.step_no)
+                    if event_id is not None:
+                        yield _sse("step", codec.step_json(st), event_id)
+                yield _sse("status", _status_data(snapshot))
+                if snapshot.status in ("succeeded", "failed"):
+                    yield _sse("end", _status_data(snapshot))
+                    return
+
+                while not sub.lagged:
+                    try:
+                        data = await asyncio.wait_for(sub.queue.get(), timeout=settings.events_heartbeat_seconds)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                        continue
+                    ev = json.loads(data)
+                    if ev["type"] == "step":
+                        event_id = take(ev["step"]["step_no"])
+                        if event_id is not None:
+                            yield _sse("step", json.dumps(ev["step"]), event_id)
+                    elif ev["type"] == "status":
+                        payload = json.dumps({k: ev.get(k) for k in ("status", "result", "error")})
+                        yield _sse("status", payload)
+                        if ev.get("status") in ("succeeded", "failed"):
+                            yield _sse("end", payload)
+                            return
+
+                # Events were dropped for this watcher: resync from the store
+                sub.lagged = False
+                snapshot = await store.get_task(task_id)
+        finally:
+            await hub.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @router.get("/health")
 async def health():
     return {"ok": True}
 
-@router.get("/metrics")
+@router.get("/metrics", response_class=PlainTextResponse)
 async def prometheus_metrics():
     return await metrics.render_prometheus()
     
\ No newline at end of file
@@ -0,0 +1,296 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from .config import settings
+from .models import Task
+
+log = logging.getLogger(__name__)
+
+# Record: MAGIC | payload length | crc32(payload) | payload (zlib-compressed task JSON)
+_HEADER = struct.Struct(">2sII")
+_MAGIC = b"TA"
+_SEGMENT_RE = re.compile(r"^seg-(\d{8})\.log$")
+
+FINISHED_KEY = "tasks:finished"
+
+# Claims up to ARGV[3] members of KEYS[1] finished before ARGV[1] by pushing
+# their score out to ARGV[2]: an archiver that dies mid-batch leaves them to
+# be claimed again once the lease runs out.
+_CLAIM_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+for _, id in ipairs(ids) do
+  redis.call('ZADD', KEYS[1], ARGV[2], id)
+end
+return ids
+"""
+
+
+class TaskArchive:
+    """
+    Finished tasks in append-only segment files under settings.archive_dir:
+    - seg-NNNNNNNN.log holds checksummed, zlib-compressed task records
+    - seg-NNNNNNNN.idx lists "task_id offset length" per record
+    A segment is sealed at archive_segment_bytes and a new one started. The
+    index is kept in memory; records are read through a cached read-only
+    mmap of their segment. On open, records of the last segment missing from
+    its index (crash between the two writes) are re-indexed, and a torn
+    record at the tail is cut off.
+    Several processes may share the directory: appends (and the recovery on
+    open) hold an flock on its LOCK file and take the active segment and its
+    size from disk, not from memory. Index lines other processes appended
+    are read on a lookup miss and before every append.
+    File I/O runs in a thread, off the event loop.
+    """
+    def __init__(self, directory: Optional[str] = None, segment_bytes: Optional[int] = None) -> None:
+        self.dir = Path(directory or settings.archive_dir)
+        self.segment_bytes = segment_bytes or settings.archive_segment_bytes
+        self.dir.mkdir(parents=True, exist_ok=True)
+        # task_id -> (segment, offset, length incl. header)
+        self._index: Dict[str, Tuple[int, int, int]] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._active = 0
+        self._active_size = 0
+        # segment -> bytes of its .idx already read into _index
+        self._idx_read: Dict[int, int] = {}
+        self.reads = 0
+        self._load()
+
+    def _seg_path(self, seg: int) -> Path:
+        return self.dir / f"seg-{seg:08d}.log"
+
+    def _idx_path(self, seg: int) -> Path:
+        return self.dir / f"seg-{seg:08d}.idx"
+
+    @contextlib.contextmanager
+    def _dir_lock(self) -> Iterator[None]:
+        # One writer at a time across processes; threads of this one queue on _write_lock first
+        with open(self.dir / "LOCK", "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _load(self) -> None:
+        with self._write_lock, self._dir_lock():
+            segments = sorted(int(m.group(1)) for p in self.dir.iterdir() if (m := _SEGMENT_RE.match(p.name)))
+            for seg in segments:
+                end = self._read_idx(seg)
+                if seg == segments[-1]:
+                    self._recover(seg, end)
+            if segments:
+                self._active = segments[-1]
+                self._active_size = self._seg_path(self._active).stat().st_size
+
+    def _read_idx(self, seg: int) -> int:
+        """Indexes the .idx lines of seg not read yet; returns the end of the last record it lists."""
+        end = 0
+        path = self._idx_path(seg)
+        pos = self._idx_read.get(seg, 0)
+        try:
+            with open(path, "rb") as f:
+                f.seek(pos)
+                data = f.read()
+        except FileNotFoundError:
+            return end
+        # A line still being written by another process is read next time
+        data = data[: data.rfind(b"\n") + 1]
+        entries = []
+        for line in data.decode().splitlines():
+            parts = line.split()
+            if len(parts) != 3:
+                continue
+            entries.append((parts[0], seg, int(parts[1]), int(parts[2])))
+            end = max(end, int(parts[1]) + int(parts[2]))
+        with self._lock:
+            for task_id, sg, off, length in entries:
+                self._index[task_id] = (sg, off, length)
+        self._idx_read[seg] = pos + len(data)
+        return end
+
+    def _refresh(self) -> None:
+        """Picks up index lines and segments other processes appended since the last look."""
+        seg = self._active
+        self._read_idx(seg)
+        while self._idx_path(seg + 1).exists() or self._seg_path(seg + 1).exists():
+            seg += 1
+            self._read_idx(seg)
+        self._active = seg
+        try:
+            self._active_size = self._seg_path(seg).stat().st_size
+        except FileNotFoundError:
+            self._active_size = 0
+
+    def _recover(self, seg: int, start: int) -> None:
+        path = self._seg_path(seg)
+        data = path.read_bytes()
+        off, entries = start, []
+        while off + _HEADER.size <= len(data):
+            magic, length, crc = _HEADER.unpack_from(data, off)
+            payload = data[off + _HEADER.size: off + _HEADER.size + length]
+            if magic != _MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            task_id = Task.model_validate_json(zlib.decompress(payload)).task_id
+            entries.append((task_id, off, _HEADER.size + length))
+            off += _HEADER.size + length
+        if off < len(data):
+            log.warning("archive segment %s: dropping %d torn bytes at offset %d", path.name, len(data) - off, off)
+            with open(path, "r+b") as f:
+                f.truncate(off)
+        if entries:
+            with open(self._idx_path(seg), "a") as f:
+                f.write("".join(f"{t} {o} {n}\n" for t, o, n in entries))
+            self._read_idx(seg)
+
+    def _append_sync(self, tasks: List[Task]) -> None:
+        with self._write_lock, self._dir_lock():
+            # Another process may have appended or started a segment since we last looked
+            self._refresh()
+            if self._active_size >= self.segment_bytes:
+                self._active += 1
+                self._active_size = 0
+            seg, off = self._active, self._active_size
+            buf, entries = bytearray(), []
+            for t in tasks:
+                payload = zlib.compress(t.model_dump_json().encode(), settings.archive_compress_level)
+                entries.append((t.task_id, off + len(buf), _HEADER.size + len(payload)))
+                buf += _HEADER.pack(_MAGIC, len(payload), zlib.crc32(payload)) + payload
+            # Records durable first, then their index entries
+            with open(self._seg_path(seg), "ab") as f:
+                f.write(buf)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._idx_path(seg), "a") as f:
+                f.write("".join(f"{t} {o} {n}\n" for t, o, n in entries))
+                f.flush()
+                os.fsync(f.fileno())
+            self._active_size += len(buf)
+            self._read_idx(seg)
+
+    def _read_sync(self, task_id: str) -> Optional[Task]:
+        with self._lock:
+            loc = self._index.get(task_id)
+            if loc is None:
+                return None
+            seg, off, length = loc
+            m = self._maps.get(seg)
+            if m is None or len(m) < off + length:
+                # First read of this segment, or the active one grew since it was mapped
+                if m is not None:
+                    m.close()
+                with open(self._seg_path(seg), "rb") as f:
+                    m = self._maps[seg] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            raw = m[off: off + length]
+        magic, n, crc = _HEADER.unpack_from(raw, 0)
+        payload = raw[_HEADER.size: _HEADER.size + n]
+        if magic != _MAGIC or zlib.crc32(payload) != crc:
+            raise RuntimeError(f"archive record for {task_id} is corrupt")
+        self.reads += 1
+        return Task.model_validate_json(zlib.decompress(payload))
+
+    async def append(self, tasks: List[Task]) -> None:
+        if tasks:
+            await asyncio.to_thread(self._append_sync, tasks)
+
+    def _get_sync(self, task_id: str) -> Optional[Task]:
+        if task_id not in self._index:
+            # Possibly archived by another process after we last read the index
+            with self._write_lock:
+                self._refresh()
+        return self._read_sync(task_id)
+
+    async def get(self, task_id: str) -> Optional[Task]:
+        return await asyncio.to_thread(self._get_sync, task_id)
+
+    def close(self) -> None:
+        with self._lock:
+            for m in self._maps.values():
+                m.close()
+            self._maps.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "archive_tasks": len(self._index),
+            "archive_segments": self._active + 1 if self._index or self._active_size else 0,
+            "archive_active_segment_bytes": self._active_size,
+            "archive_reads_total": self.reads,
+        }
+
+
+class TaskArchiver:
+    """
+    Moves finished tasks from Redis into the TaskArchive: every
+    archive_interval_seconds it claims tasks finished more than
+    archive_after_seconds ago (RedisStore records them in FINISHED_KEY),
+    appends them to the archive and only then deletes their Redis keys.
+    """
+    def __init__(self, store: Any, archive: TaskArchive) -> None:
+        self.store = store
+        self.archive = archive
+        self.r: redis.Redis = store.r
+        self._claim = self.r.register_script(_CLAIM_LUA)
+        self._bg: Optional[asyncio.Task] = None
+        self.archived = 0
+
+    def start(self) -> None:
+        if self._bg is None:
+            self._bg = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        bg, self._bg = self._bg, None
+        if bg is not None:
+            bg.cancel()
+            try:
+                await bg
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                # A full batch means more are waiting: go again without sleeping
+                if await self.archive_once() >= settings.archive_batch:
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("archiving failed: %s", e)
+            await asyncio.sleep(settings.archive_interval_seconds)
+
+    async def archive_once(self) -> int:
+        """Archives one batch of due tasks; returns how many were claimed."""
+        now = time.time()
+        ids = [
+            i.decode() if isinstance(i, (bytes, bytearray)) else str(i)
+            for i in await self._claim(
+                keys=[FINISHED_KEY],
+                args=[now - settings.archive_after_seconds, now + settings.archive_lease_seconds, settings.archive_batch],
+            )
+        ]
+        if not ids:
+            return 0
+        tasks = await self.store.get_tasks(ids, include_steps=True, fallback=False)
+        done = [t for t in tasks if t is not None and t.status in ("succeeded", "failed")]
+        await self.archive.append(done)
+        await self.store.drop_archived(ids, [t.task_id for t in done])
+        self.archived += len(done)
+        return len(ids)
+
+    def stats(self) -> Dict[str, float]:
+        return {"archive_moved_tasks_total": self.archived}
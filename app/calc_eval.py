@@ -0,0 +1,211 @@
+from __future__ import annotations
+import ast
+import asyncio
+import math
+import multiprocessing
+import operator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Union
+
+from .config import settings
+
+
+Number = Union[int, float]
+# Compiled form: called with inline=True on the event loop, where work past
+# the inline budget raises Offload instead of being done
+Program = Callable[[bool], Number]
+
+
+class CalcError(Exception):
+    """Expression is not valid calc syntax."""
+
+
+class CalcLimitError(Exception):
+    """Expression is valid but exceeds a size or time limit; retrying cannot help."""
+
+
+class CalcUnavailable(Exception):
+    """The evaluation was lost with the worker pool, not rejected; retrying can help."""
+
+
+class Offload(Exception):
+    """Too expensive for the event loop; evaluate in the process pool."""
+
+
+def _check(v: Number) -> Number:
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        raise CalcError("expression did not produce a real number")
+    if isinstance(v, int):
+        if v.bit_length() > settings.calc_max_result_bits:
+            raise CalcLimitError(f"result exceeds {settings.calc_max_result_bits} bits")
+    elif not math.isfinite(v):
+        raise CalcLimitError("result is not finite")
+    return v
+
+
+def _predict(bits: int, inline: bool) -> None:
+    """Refuse, or move off the loop, an int operation whose result would have ~bits bits."""
+    if bits > settings.calc_max_result_bits:
+        raise CalcLimitError(f"result would exceed {settings.calc_max_result_bits} bits")
+    if inline and bits > settings.calc_inline_max_bits:
+        raise Offload()
+
+
+def _pow(a: Number, b: Number, inline: bool) -> Number:
+    if abs(b) > settings.calc_max_exponent:
+        raise CalcLimitError(f"exponent magnitude exceeds {settings.calc_max_exponent}")
+    if isinstance(a, int) and isinstance(b, int) and b > 0:
+        _predict(a.bit_length() * b, inline)
+    return a ** b
+
+
+def _mul(a: Number, b: Number, inline: bool) -> Number:
+    if isinstance(a, int) and isinstance(b, int):
+        _predict(a.bit_length() + b.bit_length(), inline)
+    return a * b
+
+
+def _plain(fn: Callable[[Number, Number], Number]) -> Callable[[Number, Number, bool], Number]:
+    return lambda a, b, inline: fn(a, b)
+
+
+_BINOPS: Dict[type, Callable[[Number, Number, bool], Number]] = {
+    ast.Add: _plain(operator.add),
+    ast.Sub: _plain(operator.sub),
+    ast.Mult: _mul,
+    ast.Div: _plain(operator.truediv),
+    ast.FloorDiv: _plain(operator.floordiv),
+    ast.Mod: _plain(operator.mod),
+    ast.Pow: _pow,
+}
+
+
+def _build(node: ast.AST) -> Program:
+    if isinstance(node, ast.Constant):
+        v = node.value
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            raise CalcError(f"disallowed constant: {v!r}")
+        if isinstance(v, int) and v.bit_length() > settings.calc_max_operand_bits:
+            raise CalcLimitError(f"operand exceeds {settings.calc_max_operand_bits} bits")
+        return lambda inline: v
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        operand = _build(node.operand)
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        return lambda inline: -operand(inline)
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINOPS:
+        left, right, op = _build(node.left), _build(node.right), _BINOPS[type(node.op)]
+        return lambda inline: _check(op(left(inline), right(inline), inline))
+    name = type(node.op if isinstance(node, (ast.BinOp, ast.UnaryOp)) else node).__name__
+    raise CalcError(f"disallowed syntax: {name}")
+
+
+@lru_cache(maxsize=settings.calc_cache_size)
+def compile_expr(expr: str) -> Program:
+    """Parse, validate and compile expr into nested closures; cached per expression."""
+    if len(expr) > settings.calc_max_expr_chars:
+        raise CalcLimitError(f"expression longer than {settings.calc_max_expr_chars} chars")
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except (SyntaxError, ValueError) as e:
+        raise CalcError(f"invalid expression: {e}") from e
+    try:
+        return _build(tree.body)
+    except RecursionError as e:
+        raise CalcLimitError("expression nested too deeply") from e
+
+
+def _run(program: Program, inline: bool) -> Number:
+    try:
+        return _check(program(inline))
+    except ZeroDivisionError as e:
+        raise CalcError("division by zero") from e
+    except OverflowError as e:
+        raise CalcLimitError(f"overflow: {e}") from e
+    except RecursionError as e:
+        raise CalcLimitError("expression nested too deeply") from e
+
+
+def _evaluate_offloaded(expr: str) -> Number:
+    # Runs in a pool process: same limits, no inline budget
+    return _run(compile_expr(expr), inline=False)
+
+
+class CalcEngine:
+    """
+    Evaluates calc expressions on the event loop while they stay cheap. An
+    expression whose int arithmetic would grow past calc_inline_max_bits is
+    moved to a process pool and given calc_timeout_seconds; past the
+    deadline the pool's processes are killed and the pool is rebuilt, so a
+    hostile expression costs one deadline and never blocks the loop.
+    """
+    def __init__(self) -> None:
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.inline = 0
+        self.offloaded = 0
+        self.deadline_exceeded = 0
+        self.rejected = 0
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # forkserver: forking a process with a running event loop and threads is unsafe
+            self._pool = ProcessPoolExecutor(
+                max_workers=settings.calc_pool_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return self._pool
+
+    def _kill_pool(self) -> None:
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        # shutdown() alone waits for the runaway evaluation to finish
+        for proc in list((getattr(pool, "_processes", None) or {}).values()):
+            proc.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def evaluate(self, expr: str) -> Dict[str, Union[Number, bool]]:
+        try:
+            program = compile_expr(expr)
+            try:
+                value = _run(program, inline=True)
+                self.inline += 1
+                return {"value": value, "offloaded": False}
+            except Offload:
+                pass
+            self.offloaded += 1
+            fut = asyncio.get_running_loop().run_in_executor(self._executor(), _evaluate_offloaded, expr)
+            try:
+                value = await asyncio.wait_for(fut, timeout=settings.calc_timeout_seconds)
+            except asyncio.TimeoutError:
+                self.deadline_exceeded += 1
+                self._kill_pool()
+                raise CalcLimitError(f"evaluation exceeded {settings.calc_timeout_seconds}s")
+            except BrokenProcessPool:
+                # Another evaluation's deadline killed the pool under us; this one is retryable
+                raise CalcUnavailable("calc worker pool was restarted")
+            return {"value": value, "offloaded": True}
+        except CalcLimitError:
+            self.rejected += 1
+            raise
+
+    def stats(self) -> Dict[str, float]:
+        info = compile_expr.cache_info()
+        return {
+            'calc_evaluations_total{mode="inline"}': self.inline,
+            'calc_evaluations_total{mode="pool"}': self.offloaded,
+            "calc_deadline_exceeded_total": self.deadline_exceeded,
+            "calc_rejected_total": self.rejected,
+            "calc_compile_cache_hits_total": info.hits,
+            "calc_compile_cache_misses_total": info.misses,
+            "calc_compile_cache_entries": info.currsize,
+        }
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+engine = CalcEngine()
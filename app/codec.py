@@ -0,0 +1,162 @@
+from __future__ import annotations
+import json
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+from .config import settings
+from .models import StepRecord
+
+try:
+    import msgpack  # type: ignore
+except ImportError:  # optional
+    msgpack = None
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # optional
+    orjson = None
+
+# Record layout: MAGIC | flags | serializer | body
+# Anything not starting with MAGIC is a legacy model_dump_json() record.
+MAGIC = 0x01
+FLAG_ZLIB = 0x01
+SER_JSON, SER_ORJSON, SER_MSGPACK = ord("j"), ord("o"), ord("m")
+
+_TRUNC_MARK = "...[truncated {} chars]"
+
+
+class CodecStats:
+    def __init__(self) -> None:
+        self.encoded = 0
+        self.encode_seconds = 0.0
+        self.encoded_bytes = 0
+        self.raw_bytes = 0
+        self.compressed = 0
+        self.decoded = 0
+        self.decode_seconds = 0.0
+        self.legacy_decoded = 0
+        self.truncated_fields = 0
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "codec_encoded_records_total": self.encoded,
+            "codec_encode_seconds_total": self.encode_seconds,
+            "codec_encoded_bytes_total": self.encoded_bytes,
+            "codec_uncompressed_bytes_total": self.raw_bytes,
+            "codec_compressed_records_total": self.compressed,
+            "codec_decoded_records_total": self.decoded,
+            "codec_decode_seconds_total": self.decode_seconds,
+            "codec_legacy_json_records_total": self.legacy_decoded,
+            "codec_truncated_fields_total": self.truncated_fields,
+        }
+
+stats = CodecStats()
+
+
+def _serializer() -> int:
+    want = settings.store_codec
+    if want in ("auto", "msgpack") and msgpack is not None:
+        return SER_MSGPACK
+    if want in ("auto", "msgpack", "orjson") and orjson is not None:
+        return SER_ORJSON
+    return SER_JSON
+
+
+def _cap(value: Any, limit: int) -> Any:
+    if isinstance(value, str):
+        if len(value) > limit:
+            stats.truncated_fields += 1
+            return value[:limit] + _TRUNC_MARK.format(len(value) - limit)
+        return value
+    if isinstance(value, dict):
+        return {k: _cap(v, limit) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_cap(v, limit) for v in value]
+    return value
+
+
+def apply_limits(d: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Per-field size caps on every string inside output, and on the error
+    message. A plan record's planned_steps are kept whole: a resumed task
+    runs them again, so a capped URL or expression would run cut short.
+    """
+    out = d.get("output")
+    if out is not None:
+        planned = out.get("planned_steps") if d.get("kind") == "plan" and isinstance(out, dict) else None
+        d["output"] = _cap(out, settings.store_max_field_chars)
+        if planned is not None:
+            d["output"]["planned_steps"] = planned
+    if d.get("error"):
+        d["error"] = _cap(d["error"], settings.store_max_error_chars)
+    return d
+
+
+def encode_step(step: StepRecord) -> bytes:
+    if settings.store_codec == "legacy":
+        return step.model_dump_json().encode()
+    t0 = time.perf_counter()
+    d = apply_limits(step.model_dump(mode="json"))
+    ser = _serializer()
+    if ser == SER_MSGPACK:
+        body = msgpack.packb(d, use_bin_type=True)
+    elif ser == SER_ORJSON:
+        body = orjson.dumps(d)
+    else:
+        body = json.dumps(d, separators=(",", ":"), ensure_ascii=False).encode()
+    flags = 0
+    stats.raw_bytes += len(body)
+    if len(body) >= settings.store_compress_min_bytes:
+        packed = zlib.compress(body, 6)
+        if len(packed) < len(body):
+            body, flags = packed, FLAG_ZLIB
+            stats.compressed += 1
+    out = bytes((MAGIC, flags, ser)) + body
+    stats.encoded += 1
+    stats.encoded_bytes += len(out)
+    stats.encode_seconds += time.perf_counter() - t0
+    return out
+
+
+def step_json(step: StepRecord) -> str:
+    """Size-capped JSON of a step, for consumers that need text (e.g. task events)."""
+    return json.dumps(apply_limits(step.model_dump(mode="json")), separators=(",", ":"), ensure_ascii=False)
+
+
+def decode_step_dict(raw: bytes) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    if not raw or raw[0] != MAGIC:
+        stats.legacy_decoded += 1
+        d = json.loads(raw)
+    else:
+        flags, ser, body = raw[1], raw[2], raw[3:]
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+        if ser == SER_MSGPACK:
+            if msgpack is None:
+                raise RuntimeError("step record is msgpack-encoded but msgpack is not installed (see requirements.txt)")
+            d = msgpack.unpackb(body, raw=False)
+        elif ser == SER_ORJSON and orjson is not None:
+            d = orjson.loads(body)
+        else:
+            # orjson output is plain JSON, so json can read it too
+            d = json.loads(body)
+    stats.decoded += 1
+    stats.decode_seconds += time.perf_counter() - t0
+    return d
+
+
+def decode_step(raw: bytes) -> StepRecord:
+    return StepRecord(**decode_step_dict(raw))
+
+
+def decode_steps(raws: Optional[List[bytes]]) -> List[StepRecord]:
+    """Steps in step_no order; a step re-run after a delayed retry is stored behind later ones."""
+    steps = [decode_step(b) for b in raws or []]
+    steps.sort(key=step_no)
+    return steps
+
+
+def step_no(step: StepRecord) -> int:
+    return step.step_no
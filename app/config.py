@@ -1,12 +1,130 @@
 from pydantic import BaseModel
 import os
+import socket
 
 class Settings(BaseModel):
     redis_url: str = os.getenv("REDIS_URL","redis://localhost:6379/0")
+    #Storage backend: "redis", or "memory" (one process, nothing persisted; no Redis needed)
+    storage_backend: str = os.getenv("APP_STORAGE_BACKEND","redis")
+    memory_store_shards: int = int(os.getenv("APP_MEMORY_STORE_SHARDS","64"))
 
     max_steps: int = int(os.getenv("APP_MAX_STEPS", "5"))
     step_timeout_seconds: float = float(os.getenv("APP_STEP_TIMEOUT_SECONDS","8"))
     max_concurrent_tasks: int = int(os.getenv("APP_MAX_CONCURRENT_TASKS", "10"))
+    # Extra task ids pulled beyond free slots, so a freed slot never waits on a round trip
+    dequeue_prefetch: int = int(os.getenv("APP_DEQUEUE_PREFETCH", "2"))
+    max_parallel_steps: int = int(os.getenv("APP_MAX_PARALLEL_STEPS", "4"))
+
+    #Bulk endpoints
+    bulk_max_items: int = int(os.getenv("APP_BULK_MAX_ITEMS","10000"))
+    bulk_pipeline_chunk: int = int(os.getenv("APP_BULK_PIPELINE_CHUNK","500"))
+
+    #Write-behind of step records / status updates: "off", "step" or "interval" (see README)
+    write_behind_mode: str = os.getenv("APP_WRITE_BEHIND_MODE","step")
+    write_behind_flush_interval_ms: int = int(os.getenv("APP_WRITE_BEHIND_FLUSH_INTERVAL_MS","250"))
+
+    #Stored step encoding: "auto" (msgpack > orjson > json, whichever is installed), "msgpack",
+    #"orjson", "json" or "legacy" (plain model_dump_json). Old JSON records are always readable.
+    #msgpack and orjson are in requirements.txt: a node without msgpack cannot read msgpack records
+    #(use "json" while a mixed fleet rolls out)
+    store_codec: str = os.getenv("APP_STORE_CODEC","auto")
+    store_compress_min_bytes: int = int(os.getenv("APP_STORE_COMPRESS_MIN_BYTES","1024"))
+    #Caps each string in a stored step's output, except a plan record's planned_steps (re-run on resume)
+    store_max_field_chars: int = int(os.getenv("APP_STORE_MAX_FIELD_CHARS","4000"))
+    store_max_error_chars: int = int(os.getenv("APP_STORE_MAX_ERROR_CHARS","2000"))
+
+    #Task progress events (Redis pub/sub -> SSE on GET /tasks/{id}/events)
+    events_enabled: bool = os.getenv("APP_EVENTS_ENABLED","1").lower() in ("1","true","yes")
+    events_subscriber_buffer: int = int(os.getenv("APP_EVENTS_SUBSCRIBER_BUFFER","256"))
+    events_heartbeat_seconds: float = float(os.getenv("APP_EVENTS_HEARTBEAT_SECONDS","15"))
+
+    #Metrics: set a shared directory to aggregate /metrics across several uvicorn worker processes
+    metrics_multiproc_dir: str = os.getenv("APP_METRICS_MULTIPROC_DIR","")
+    metrics_multiproc_flush_seconds: float = float(os.getenv("APP_METRICS_MULTIPROC_FLUSH_SECONDS","5"))
+    metrics_multiproc_stale_seconds: float = float(os.getenv("APP_METRICS_MULTIPROC_STALE_SECONDS","60"))
+
+    #Tracing: sampled per task, exported as OTLP/JSON to a file (one request per line) and/or an OTLP/HTTP endpoint
+    trace_enabled: bool = os.getenv("APP_TRACE_ENABLED","false").lower() in ("1","true","yes")
+    trace_sample_rate: float = float(os.getenv("APP_TRACE_SAMPLE_RATE","1.0"))
+    trace_export_file: str = os.getenv("APP_TRACE_EXPORT_FILE","traces.jsonl")
+    trace_export_endpoint: str = os.getenv("APP_TRACE_EXPORT_ENDPOINT","")
+    trace_export_batch_size: int = int(os.getenv("APP_TRACE_EXPORT_BATCH_SIZE","64"))
+    trace_export_interval_seconds: float = float(os.getenv("APP_TRACE_EXPORT_INTERVAL_SECONDS","2"))
+    trace_max_pending: int = int(os.getenv("APP_TRACE_MAX_PENDING","10000"))
+    #Sampling profiler for traced tasks; the profile is attached only to tasks slower than trace_profile_min_seconds
+    trace_profile_enabled: bool = os.getenv("APP_TRACE_PROFILE_ENABLED","false").lower() in ("1","true","yes")
+    trace_profile_interval_ms: int = int(os.getenv("APP_TRACE_PROFILE_INTERVAL_MS","10"))
+    trace_profile_min_seconds: float = float(os.getenv("APP_TRACE_PROFILE_MIN_SECONDS","2"))
+    trace_profile_max_stacks: int = int(os.getenv("APP_TRACE_PROFILE_MAX_STACKS","200"))
+
+    #http_get response cache: in-process LRU bounded by bytes, plus a shared Redis tier
+    http_cache_enabled: bool = os.getenv("APP_HTTP_CACHE_ENABLED","true").lower() in ("1","true","yes")
+    http_cache_redis_enabled: bool = os.getenv("APP_HTTP_CACHE_REDIS_ENABLED","true").lower() in ("1","true","yes")
+    http_cache_max_bytes: int = int(os.getenv("APP_HTTP_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    http_cache_max_entry_bytes: int = int(os.getenv("APP_HTTP_CACHE_MAX_ENTRY_BYTES", str(256 * 1024)))
+    # How long a stale entry with an ETag / Last-Modified is kept around for revalidation
+    http_cache_stale_seconds: int = int(os.getenv("APP_HTTP_CACHE_STALE_SECONDS","3600"))
+
+    #calc limits; int arithmetic growing past calc_inline_max_bits moves to a process pool with a hard deadline
+    calc_max_expr_chars: int = int(os.getenv("APP_CALC_MAX_EXPR_CHARS","512"))
+    calc_max_operand_bits: int = int(os.getenv("APP_CALC_MAX_OPERAND_BITS","1024"))
+    calc_max_exponent: int = int(os.getenv("APP_CALC_MAX_EXPONENT","100000"))
+    calc_max_result_bits: int = int(os.getenv("APP_CALC_MAX_RESULT_BITS","1000000"))
+    calc_inline_max_bits: int = int(os.getenv("APP_CALC_INLINE_MAX_BITS","8192"))
+    calc_timeout_seconds: float = float(os.getenv("APP_CALC_TIMEOUT_SECONDS","2"))
+    calc_pool_workers: int = int(os.getenv("APP_CALC_POOL_WORKERS","2"))
+    calc_cache_size: int = int(os.getenv("APP_CALC_CACHE_SIZE","1024"))
+
+    #Adaptive task concurrency (AIMD), starting at max_concurrent_tasks
+    adaptive_concurrency_enabled: bool = os.getenv("APP_ADAPTIVE_CONCURRENCY_ENABLED","true").lower() in ("1","true","yes")
+    concurrency_min: int = int(os.getenv("APP_CONCURRENCY_MIN","2"))
+    # 0: max_concurrent_tasks, so adapting never lifts the operator's cap unless asked to
+    concurrency_max: int = int(os.getenv("APP_CONCURRENCY_MAX","0"))
+    # A dependency call (LLM planner, http_get fetch) slower than tolerance x its running average counts as congestion
+    concurrency_latency_tolerance: float = float(os.getenv("APP_CONCURRENCY_LATENCY_TOLERANCE","2.0"))
+    concurrency_decrease_ratio: float = float(os.getenv("APP_CONCURRENCY_DECREASE_RATIO","0.9"))
+    #Per-tool bulkheads (the planner's is planner_max_concurrency)
+    bulkhead_calc: int = int(os.getenv("APP_BULKHEAD_CALC","8"))
+    bulkhead_http_get: int = int(os.getenv("APP_BULKHEAD_HTTP_GET","32"))
+    #Per-host circuit breakers and rate limits for http_get
+    circuit_enabled: bool = os.getenv("APP_CIRCUIT_ENABLED","true").lower() in ("1","true","yes")
+    circuit_failure_threshold: int = int(os.getenv("APP_CIRCUIT_FAILURE_THRESHOLD","5"))
+    circuit_failure_ratio: float = float(os.getenv("APP_CIRCUIT_FAILURE_RATIO","0.5"))
+    circuit_window_seconds: float = float(os.getenv("APP_CIRCUIT_WINDOW_SECONDS","30"))
+    circuit_open_seconds: float = float(os.getenv("APP_CIRCUIT_OPEN_SECONDS","15"))
+    circuit_half_open_max_calls: int = int(os.getenv("APP_CIRCUIT_HALF_OPEN_MAX_CALLS","1"))
+    circuit_shared: bool = os.getenv("APP_CIRCUIT_SHARED","false").lower() in ("1","true","yes")
+    circuit_sync_seconds: float = float(os.getenv("APP_CIRCUIT_SYNC_SECONDS","1.0"))
+    host_rate_limit_per_second: float = float(os.getenv("APP_HOST_RATE_LIMIT_PER_SECOND","50"))
+    host_rate_limit_burst: float = float(os.getenv("APP_HOST_RATE_LIMIT_BURST","100"))
+    # Hosts come from planned URLs: label at most this many, the rest share host="other"
+    circuit_metrics_max_hosts: int = int(os.getenv("APP_CIRCUIT_METRICS_MAX_HOSTS","50"))
+    #Global retry budget: retries allowed per attempt, plus a floor per second
+    retry_budget_ratio: float = float(os.getenv("APP_RETRY_BUDGET_RATIO","0.2"))
+    retry_budget_min_per_second: float = float(os.getenv("APP_RETRY_BUDGET_MIN_PER_SECOND","5"))
+    #Delayed retries: a backoff this long or longer is waited out in the store's delayed set, not in a task slot.
+    # The default is above the first backoff (retry_base_attempts + retry_jitter): only later ones leave the slot
+    delayed_retry_enabled: bool = os.getenv("APP_DELAYED_RETRY_ENABLED","true").lower() in ("1","true","yes")
+    delayed_retry_min_seconds: float = float(os.getenv("APP_DELAYED_RETRY_MIN_SECONDS","0.6"))
+    delayed_retry_key: str = os.getenv("APP_DELAYED_RETRY_KEY","delayed:tasks")
+    delayed_retry_poll_seconds: float = float(os.getenv("APP_DELAYED_RETRY_POLL_SECONDS","0.25"))
+    delayed_retry_batch: int = int(os.getenv("APP_DELAYED_RETRY_BATCH","100"))
+    # A claimed task not re-enqueued within this long (promoter died) is claimed again
+    delayed_retry_lease_seconds: float = float(os.getenv("APP_DELAYED_RETRY_LEASE_SECONDS","30"))
+    #Retention: TTLs set when a task turns terminal (0 keeps the keys)
+    # Opt-in: a TTL deletes finished tasks for good unless the archive is enabled
+    task_ttl_seconds: int = int(os.getenv("APP_TASK_TTL_SECONDS","0"))
+    idempotency_ttl_seconds: int = int(os.getenv("APP_IDEMPOTENCY_TTL_SECONDS","86400"))
+    #Archive: finished tasks move from Redis to local compressed segment files
+    archive_enabled: bool = os.getenv("APP_ARCHIVE_ENABLED","false").lower() in ("1","true","yes")
+    archive_dir: str = os.getenv("APP_ARCHIVE_DIR","archive")
+    archive_segment_bytes: int = int(os.getenv("APP_ARCHIVE_SEGMENT_BYTES",str(64 * 1024 * 1024)))
+    archive_compress_level: int = int(os.getenv("APP_ARCHIVE_COMPRESS_LEVEL","6"))
+    # Must stay well below a non-zero task_ttl_seconds, or tasks expire before they are archived
+    archive_after_seconds: float = float(os.getenv("APP_ARCHIVE_AFTER_SECONDS","600"))
+    archive_interval_seconds: float = float(os.getenv("APP_ARCHIVE_INTERVAL_SECONDS","5"))
+    archive_batch: int = int(os.getenv("APP_ARCHIVE_BATCH","200"))
+    archive_lease_seconds: float = float(os.getenv("APP_ARCHIVE_LEASE_SECONDS","60"))
 
     #Retry Configuration
     retry_max_attempts: int = int(os.getenv("APP_RETRY_MAX_ATTEMPTS","3"))
@@ -14,6 +132,78 @@ class Settings(BaseModel):
     retry_max_delay: float = float(os.getenv("APP_RETRY_MAX_DELAY","2.0"))
     retry_jitter: float = float(os.getenv("APP_RETRY_JITTER","0.2"))
 
+    #Queue backend with redis storage: "list" (LPUSH/BRPOP) or "stream" (consumer groups, at-least-once)
+    queue_backend: str = os.getenv("APP_QUEUE_BACKEND","list")
+    stream_name: str = os.getenv("APP_STREAM_NAME","stream:tasks")
+    stream_group: str = os.getenv("APP_STREAM_GROUP","workers")
+    stream_consumer: str = os.getenv("APP_STREAM_CONSUMER", f"{socket.gethostname()}-{os.getpid()}")
+    stream_batch_size: int = int(os.getenv("APP_STREAM_BATCH_SIZE","10"))
+    # Must exceed the longest task run, or a live task is claimed and run twice at once (see RedisStreamQueue)
+    stream_claim_idle_ms: int = int(os.getenv("APP_STREAM_CLAIM_IDLE_MS","120000"))
+    stream_reclaim_interval_seconds: float = float(os.getenv("APP_STREAM_RECLAIM_INTERVAL_SECONDS","15"))
+    stream_maxlen: int = int(os.getenv("APP_STREAM_MAXLEN","100000"))
+    #Priorities and tenants (list and memory queues): "strict" or "weighted" across priorities, weighted fair across tenants
+    queue_priority_mode: str = os.getenv("APP_QUEUE_PRIORITY_MODE","strict")
+    queue_priority_weights: dict[str, float] = {
+        k.strip(): float(v) for k, _, v in (
+            p.partition("=") for p in os.getenv("APP_QUEUE_PRIORITY_WEIGHTS","high=8,normal=4,low=1").split(",")
+        ) if k.strip()
+    }
+    # Tenants not listed weigh 1
+    queue_tenant_weights: dict[str, float] = {
+        k.strip(): float(v) for k, _, v in (
+            p.partition("=") for p in os.getenv("APP_QUEUE_TENANT_WEIGHTS","").split(",")
+        ) if k.strip()
+    }
+    # A task waiting this long is served ahead of higher priorities (0 disables)
+    queue_aging_seconds: float = float(os.getenv("APP_QUEUE_AGING_SECONDS","30"))
+    queue_metrics_max_tenants: int = int(os.getenv("APP_QUEUE_METRICS_MAX_TENANTS","50"))
+
     openai_model: str = os.getenv("OPENAI_MODEL","gpt-4.1-mini")
+    openai_base_url: str = os.getenv("OPENAI_BASE_URL","")
+
+    #Planner: "openai" or "stub" (offline, rule-based plan after a simulated latency)
+    planner_backend: str = os.getenv("APP_PLANNER_BACKEND","openai")
+    planner_max_concurrency: int = int(os.getenv("APP_PLANNER_MAX_CONCURRENCY","4"))
+    planner_timeout_seconds: float = float(os.getenv("APP_PLANNER_TIMEOUT_SECONDS","30"))
+    planner_stub_latency_ms: int = int(os.getenv("APP_PLANNER_STUB_LATENCY_MS","300"))
+    planner_stub_chunk_chars: int = int(os.getenv("APP_PLANNER_STUB_CHUNK_CHARS","16"))
+    # Stream the plan_steps call and start each step as soon as its JSON object is complete
+    planner_streaming_enabled: bool = os.getenv("APP_PLANNER_STREAMING_ENABLED","true").lower() in ("1","true","yes")
+    # Rule-based plan first, the backend above only for goals the rules do not cover (see RoutingPlanner)
+    planner_routing_enabled: bool = os.getenv("APP_PLANNER_ROUTING_ENABLED","true").lower() in ("1","true","yes")
+    planner_routing_max_unmatched_words: int = int(os.getenv("APP_PLANNER_ROUTING_MAX_UNMATCHED_WORDS","0"))
+    planner_routing_max_goal_chars: int = int(os.getenv("APP_PLANNER_ROUTING_MAX_GOAL_CHARS","500"))
+    planner_routing_filler_words: set[str] = {
+        w.strip().lower() for w in os.getenv(
+            "APP_PLANNER_ROUTING_FILLER_WORDS",
+            "a,an,the,and,then,please,fetch,get,download,open,read,load,url,page,from,at,of,to,"
+            "calc,calculate,compute,evaluate,what,is,what's,whats",
+        ).split(",") if w.strip()
+    }
+
+    #Plan cache (in-process LRU + Redis tier, keyed on normalized goal + model + planner version)
+    plan_cache_enabled: bool = os.getenv("APP_PLAN_CACHE_ENABLED","1").lower() in ("1","true","yes")
+    plan_cache_max_entries: int = int(os.getenv("APP_PLAN_CACHE_MAX_ENTRIES","1024"))
+    plan_cache_ttl_seconds: float = float(os.getenv("APP_PLAN_CACHE_TTL_SECONDS","300"))
+    plan_cache_redis_ttl_seconds: int = int(os.getenv("APP_PLAN_CACHE_REDIS_TTL_SECONDS","3600"))
+    plan_cache_casefold: bool = os.getenv("APP_PLAN_CACHE_CASEFOLD","0").lower() in ("1","true","yes")
+
+    #HTTP client pool (shared by http_get)
+    http_max_connections: int = int(os.getenv("APP_HTTP_MAX_CONNECTIONS","100"))
+    http_max_keepalive_connections: int = int(os.getenv("APP_HTTP_MAX_KEEPALIVE_CONNECTIONS","20"))
+    http_max_connections_per_host: int = int(os.getenv("APP_HTTP_MAX_CONNECTIONS_PER_HOST","10"))
+    http_keepalive_expiry: float = float(os.getenv("APP_HTTP_KEEPALIVE_EXPIRY","30"))
+    http_timeout_seconds: float = float(os.getenv("APP_HTTP_TIMEOUT_SECONDS","6"))
+    # http_get stops reading the body here; 16000 bytes always hold the 4000 chars kept as text
+    http_max_body_bytes: int = int(os.getenv("APP_HTTP_MAX_BODY_BYTES","16000"))
+    # Response headers kept in the step output ("*" keeps all)
+    http_header_allowlist: list[str] = [
+        h.strip().lower() for h in os.getenv(
+            "APP_HTTP_HEADER_ALLOWLIST",
+            "content-type,content-length,content-encoding,content-language,cache-control,etag,last-modified,expires,date,location",
+        ).split(",") if h.strip()
+    ]
+    http2: bool = os.getenv("APP_HTTP2","0").lower() in ("1","true","yes")
 
 settings = Settings()
@@ -0,0 +1,109 @@
+from __future__ import annotations
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Set
+
+from .planner import PlannedStep
+
+
+def dependencies(steps: Sequence[PlannedStep]) -> List[List[int]]:
+    """
+    Dependency lists per step (0-based indices into the plan).
+    A step may only depend on earlier steps, which rules out cycles.
+    Steps without `depends_on` are independent and may run in parallel.
+    """
+    return [step_dependencies(i, st) for i, st in enumerate(steps)]
+
+
+def step_dependencies(i: int, st: PlannedStep) -> List[int]:
+    """Dependency list of step i alone, for plans that arrive step by step."""
+    raw = st.get("depends_on") or []
+    if not isinstance(raw, list):
+        raise ValueError(f"invalid plan: step {i} depends_on must be a list")
+    out: List[int] = []
+    for d in raw:
+        if not isinstance(d, int) or isinstance(d, bool) or not 0 <= d < i:
+            raise ValueError(f"invalid plan: step {i} depends on {d!r}, expected an earlier step index")
+        if d not in out:
+            out.append(d)
+    return out
+
+
+async def run_dag(
+        deps: List[List[int]],
+        run: Callable[[int], Awaitable[None]],
+        *,
+        max_parallel: int,
+        on_settled: Callable[[int], Awaitable[None]],
+        feed: Optional[Callable[[Callable[[List[int]], None]], Awaitable[None]]] = None,
+) -> None:
+    """
+    Runs run(i) for every step once all of deps[i] have succeeded, at most
+    max_parallel at a time, lowest index first. on_settled(i) is called from
+    this coroutine (never from a step) as each step finishes, in index order
+    for steps finishing together. The first failure cancels every running
+    step, waits for them, and is re-raised; steps never started are skipped.
+
+    With feed, the plan is still arriving while steps run: feed(add) runs in
+    its own task and calls add(step_deps) for each new step, which is
+    appended to deps. The run ends once feed has returned and every step is
+    done; feed raising fails the run like a failed step. A failed step does
+    not cut feed short: the running steps are cancelled, feed runs to its
+    end without starting anything new, so the caller can still record the
+    plan, and then the step's error is re-raised (or feed's, if it fails).
+    """
+    pending = list(range(len(deps)))
+    done: Set[int] = set()
+    running: Dict[asyncio.Task, int] = {}
+    arrived = asyncio.Event()
+
+    def add(step_deps: List[int]) -> None:
+        deps.append(step_deps)
+        pending.append(len(deps) - 1)
+        arrived.set()
+
+    async def stop_running() -> None:
+        for t in running:
+            t.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        for i in sorted(running.values()):
+            await on_settled(i)
+        running.clear()
+
+    pump: Optional[asyncio.Task] = asyncio.create_task(feed(add)) if feed is not None else None
+    waiter: Optional[asyncio.Task] = None
+    try:
+        while pending or running or pump is not None:
+            ready = [i for i in pending if all(d in done for d in deps[i])]
+            for i in ready[: max(1, max_parallel) - len(running)]:
+                pending.remove(i)
+                running[asyncio.create_task(run(i))] = i
+            waits = set(running)
+            if pump is not None:
+                if waiter is None:
+                    waiter = asyncio.create_task(arrived.wait())
+                waits |= {pump, waiter}
+            finished, _ = await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            if waiter is not None and waiter in finished:
+                arrived.clear()
+                waiter = None
+            if pump is not None and pump in finished:
+                fed, pump = pump, None
+                fed.result()
+            for t in sorted((t for t in finished if t in running), key=running.__getitem__):
+                i = running.pop(t)
+                await on_settled(i)
+                t.result()
+                done.add(i)
+    except Exception:
+        if pump is not None:
+            # A step failed while the plan streamed: let the plan finish, start nothing more
+            await stop_running()
+            await pump
+        raise
+    finally:
+        for t in (pump, waiter):
+            if t is not None and not t.done():
+                t.cancel()
+                await asyncio.gather(t, return_exceptions=True)
+        if running:
+            await stop_running()
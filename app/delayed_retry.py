@@ -0,0 +1,79 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from .config import settings
+from .metrics import metrics
+from .storage import TaskQueue, TaskStore
+
+log = logging.getLogger(__name__)
+
+
+class DelayedRetryScheduler:
+    """
+    Tasks waiting out a retry backoff, off the worker's slots: a set of task
+    ids scored by due time, kept by the store (a sorted set in Redis).
+    A promoter loop on every worker claims due ids with a lease and puts
+    them back on the queue with their tenant and priority; the resumed run
+    skips the steps that already succeeded.
+    """
+    def __init__(self, store: TaskStore, queue: TaskQueue, key: Optional[str] = None) -> None:
+        self.store = store
+        self.queue = queue
+        self.key = key or settings.delayed_retry_key
+        self._bg: Optional[asyncio.Task] = None
+        self.promoted = 0
+
+    def start(self) -> None:
+        if self._bg is None:
+            self._bg = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        bg, self._bg = self._bg, None
+        if bg is not None:
+            bg.cancel()
+            try:
+                await bg
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    async def schedule(self, task_id: str, delay_s: float, attempts: Dict[int, int], error: str) -> None:
+        await self.store.schedule_retry(
+            task_id, delayed_key=self.key, delay_s=delay_s, attempts=attempts, error=error,
+        )
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                # A full batch means more may be due: go again without sleeping
+                if await self.promote_due() >= settings.delayed_retry_batch:
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("delayed retry promotion failed: %s", e)
+            await asyncio.sleep(settings.delayed_retry_poll_seconds)
+
+    async def promote_due(self) -> int:
+        """Re-enqueues the tasks whose retry is due; returns how many were claimed."""
+        now = time.time()
+        lease_until = now + settings.delayed_retry_lease_seconds
+        ids: List[str] = await self.store.claim_retries(self.key, now, lease_until, settings.delayed_retry_batch)
+        if not ids:
+            return 0
+        tasks = await self.store.get_tasks(ids, include_steps=False)
+        for task_id, task in zip(ids, tasks):
+            if task is not None and task.status == "queued":
+                await self.queue.enqueue(task_id, task.tenant, task.priority)
+                self.promoted += 1
+                metrics.inc("tasks_retry_promoted_total")
+            # Gone, or already terminal: nothing to run. The entry stays if the task already ran,
+            # failed and was parked again before this line: that is its next retry.
+            await self.store.drop_retry(self.key, task_id, lease_until)
+        return len(ids)
+
+    async def stats(self) -> Dict[str, float]:
+        waiting, due = await self.store.retry_counts(self.key, time.time())
+        return {"delayed_retry_tasks": waiting, "delayed_retry_due": due}
@@ -0,0 +1,149 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
+from typing import Any, Dict, Optional, Set
+
+import redis.asyncio as redis
+
+from .config import settings
+
+log = logging.getLogger(__name__)
+
+
+def channel(task_id: str) -> str:
+    return f"task:{task_id}:events"
+
+
+def step_event(step_json: str) -> str:
+    # step_json is already JSON; splice instead of re-encoding it
+    return '{"type":"step","step":' + step_json + "}"
+
+
+def status_event(fields: Dict[str, Any]) -> str:
+    return json.dumps({"type": "status", **{k: v for k, v in fields.items() if k in ("status", "result", "error")}})
+
+
+class Subscription:
+    def __init__(self, task_id: str) -> None:
+        self.task_id = task_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.events_subscriber_buffer)
+        # set when events were dropped; the reader must resync from the store
+        self.lagged = False
+
+
+def _deliver(subs: Set[Subscription], data: str) -> None:
+    for sub in list(subs):
+        try:
+            sub.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            sub.lagged = True
+
+
+class LocalEventHub:
+    """
+    In-process task events for the memory backend: InMemoryStore calls
+    publish() as it stores a step or a status, and every local watcher of
+    the task gets it. Same subscription semantics as TaskEventHub.
+    """
+    def __init__(self) -> None:
+        self._subs: Dict[str, Set[Subscription]] = {}
+
+    async def subscribe(self, task_id: str) -> Subscription:
+        sub = Subscription(task_id)
+        self._subs.setdefault(task_id, set()).add(sub)
+        return sub
+
+    async def unsubscribe(self, sub: Subscription) -> None:
+        subs = self._subs.get(sub.task_id)
+        if subs is None:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._subs[sub.task_id]
+
+    def watching(self, task_id: str) -> bool:
+        return task_id in self._subs
+
+    def publish(self, task_id: str, data: str) -> None:
+        subs = self._subs.get(task_id)
+        if subs:
+            _deliver(subs, data)
+
+    async def aclose(self) -> None:
+        self._subs.clear()
+
+
+class TaskEventHub:
+    """
+    Per-process fan-out of task events published by workers on Redis pub/sub.
+    One pub/sub connection serves every local watcher: a task channel is
+    subscribed when its first watcher arrives and dropped with its last.
+    """
+    def __init__(self, r: redis.Redis) -> None:
+        self.r = r
+        self._pubsub: Optional[Any] = None
+        self._reader: Optional[asyncio.Task] = None
+        self._subs: Dict[str, Set[Subscription]] = {}
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self, task_id: str) -> Subscription:
+        sub = Subscription(task_id)
+        ch = channel(task_id)
+        async with self._lock:
+            if self._pubsub is None:
+                self._pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+            first = ch not in self._subs
+            self._subs.setdefault(ch, set()).add(sub)
+            if first:
+                await self._pubsub.subscribe(ch)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+        return sub
+
+    async def unsubscribe(self, sub: Subscription) -> None:
+        ch = channel(sub.task_id)
+        async with self._lock:
+            subs = self._subs.get(ch)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                del self._subs[ch]
+                if self._pubsub is not None:
+                    await self._pubsub.unsubscribe(ch)
+
+    async def _read(self) -> None:
+        while self._subs:
+            try:
+                msg = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("task event reader failed: %s", e)
+                self._mark_all_lagged()
+                await asyncio.sleep(1.0)
+                continue
+            if msg is None or msg.get("type") != "message":
+                continue
+            ch = msg["channel"]
+            ch = ch.decode() if isinstance(ch, (bytes, bytearray)) else ch
+            data = msg["data"]
+            data = data.decode() if isinstance(data, (bytes, bytearray)) else data
+            _deliver(self._subs.get(ch, set()), data)
+
+    def _mark_all_lagged(self) -> None:
+        for subs in self._subs.values():
+            for sub in subs:
+                sub.lagged = True
+
+    async def aclose(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
@@ -0,0 +1,308 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+
+import httpx
+import redis.asyncio as redis
+
+from .config import settings
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Called with the conditional request headers (or None); returns the closed
+# response, for status and headers, and the http_get output built from it
+Fetch = Callable[[Optional[Dict[str, str]]], Awaitable[Tuple[httpx.Response, Dict[str, Any]]]]
+
+# Response headers kept with an entry, to recompute freshness after a 304
+_FRESHNESS_HEADERS = ("cache-control", "expires", "date", "age", "etag", "last-modified", "vary")
+
+# Statuses kept by the cache: the heuristically cacheable ones of RFC 9111 §4.2.2
+_CACHEABLE_STATUS = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+
+
+def _directives(cache_control: str) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    for part in cache_control.split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            out[name.lower()] = value.strip().strip('"')
+    return out
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def freshness(headers: Mapping[str, str], now: float) -> Tuple[bool, float, bool]:
+    """
+    (storable, fresh_until, shareable) for a response with these headers.
+    fresh_until <= now means every use must be revalidated first.
+    """
+    cc = _directives(headers.get("cache-control", ""))
+    if "no-store" in cc or headers.get("vary", "").strip() == "*":
+        return False, 0.0, False
+    shareable = "private" not in cc
+    if "no-cache" in cc:
+        return True, now, shareable
+
+    date = _http_date(headers.get("date")) or now
+    try:
+        age = max(0.0, float(headers.get("age", 0)))
+    except ValueError:
+        age = 0.0
+    # Time the response already spent in caches upstream, plus clock skew
+    current_age = max(age, now - date)
+
+    lifetime: Optional[float] = None
+    if "max-age" in cc:
+        try:
+            lifetime = float(cc["max-age"])
+        except ValueError:
+            lifetime = 0.0
+    elif "expires" in headers:
+        # An unparseable Expires means "already expired"
+        expires = _http_date(headers.get("expires"))
+        lifetime = (expires - date) if expires is not None else 0.0
+    if lifetime is None:
+        return True, now, shareable
+    return True, now + lifetime - current_age, shareable
+
+
+class HttpResponseCache:
+    """
+    Cache of http_get results, keyed by URL:
+    - in-process LRU bounded by total payload bytes
+    - optional shared Redis tier (SET EX), so every node reuses responses
+    Fresh entries (Cache-Control max-age / Expires) are served without a
+    request. Stale entries that carry an ETag or Last-Modified are kept for
+    stale_s and revalidated with If-None-Match / If-Modified-Since; a 304
+    refreshes them. Private responses are not kept in either tier: every
+    task and tenant shares them.
+    Concurrent fetches of one URL are collapsed into one. Waiters get the
+    result as a "hit" when it is a fresh, storable response, as "coalesced"
+    when it is not (a 5xx, no-store), and fetch their own when it is private.
+    """
+    def __init__(
+            self,
+            r: Optional[redis.Redis],
+            *,
+            max_bytes: Optional[int] = None,
+            max_entry_bytes: Optional[int] = None,
+            stale_s: Optional[int] = None,
+            prefix: str = "httpcache:",
+    ) -> None:
+        self.r = r
+        self.max_bytes = max_bytes or settings.http_cache_max_bytes
+        self.max_entry_bytes = max_entry_bytes or settings.http_cache_max_entry_bytes
+        self.stale_s = stale_s if stale_s is not None else settings.http_cache_stale_seconds
+        self.prefix = prefix
+        # key -> (payload size, entry)
+        self._lru: "OrderedDict[str, Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(str(httpx.URL(url)).encode()).hexdigest()
+
+    def _mem_get(self, key: str) -> Optional[Dict[str, Any]]:
+        hit = self._lru.get(key)
+        if hit is None:
+            return None
+        entry = hit[1]
+        if entry["fresh_until"] + self.stale_s < time.time():
+            self._mem_drop(key)
+            return None
+        self._lru.move_to_end(key)
+        return entry
+
+    def _mem_drop(self, key: str) -> None:
+        size, _ = self._lru.pop(key)
+        self._bytes -= size
+
+    def _mem_put(self, key: str, entry: Dict[str, Any], size: int) -> None:
+        if key in self._lru:
+            self._mem_drop(key)
+        self._lru[key] = (size, entry)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._lru:
+            self._mem_drop(next(iter(self._lru)))
+
+    async def _redis_get(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.r is None:
+            return None
+        try:
+            raw = await self.r.get(self.prefix + key)
+        except Exception as e:
+            log.warning("http cache redis get failed: %s", e)
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    async def _redis_put(self, key: str, entry: Dict[str, Any], payload: str) -> None:
+        if self.r is None:
+            return
+        ttl = int(entry["fresh_until"] - time.time()) + self.stale_s
+        if ttl <= 0:
+            return
+        try:
+            await self.r.set(self.prefix + key, payload, ex=ttl)
+        except Exception as e:
+            log.warning("http cache redis set failed: %s", e)
+
+    async def _store(self, key: str, entry: Dict[str, Any]) -> None:
+        if not entry["shareable"]:
+            # The in-process tier is shared by every task and tenant too
+            if key in self._lru:
+                self._mem_drop(key)
+            return
+        if entry["fresh_until"] <= time.time() and not entry["validators"]:
+            # Nothing to serve it with later: not fresh and cannot be revalidated
+            return
+        payload = json.dumps(entry, separators=(",", ":"))
+        if len(payload) > self.max_entry_bytes:
+            return
+        self._mem_put(key, entry, len(payload))
+        await self._redis_put(key, entry, payload)
+
+    @staticmethod
+    def _entry(resp: httpx.Response, output: Dict[str, Any], now: float) -> Optional[Dict[str, Any]]:
+        if resp.status_code not in _CACHEABLE_STATUS:
+            return None
+        storable, fresh_until, shareable = freshness(resp.headers, now)
+        if not storable:
+            return None
+        validators = {}
+        if "etag" in resp.headers:
+            validators["If-None-Match"] = resp.headers["etag"]
+        if "last-modified" in resp.headers:
+            validators["If-Modified-Since"] = resp.headers["last-modified"]
+        return {
+            "output": output,
+            "fresh_until": fresh_until,
+            "shareable": shareable,
+            "validators": validators,
+            "body_bytes": output.get("bytes_read", 0),
+            "headers": {k: resp.headers[k] for k in _FRESHNESS_HEADERS if k in resp.headers},
+        }
+
+    def _count(self, result: str, saved: int = 0) -> None:
+        # "coalesced" counts as a lookup, not a hit: nothing reusable was served
+        self.lookups += 1
+        metrics.inc("http_cache_requests_total", result=result)
+        if result == "hit":
+            self.hits += 1
+        elif result == "revalidated":
+            self.revalidated += 1
+        if saved:
+            self.bytes_saved += saved
+            metrics.inc("http_cache_bytes_saved_total", saved)
+
+    async def get(self, url: str, fetch: Fetch) -> Dict[str, Any]:
+        """http_get output for url plus "cache": "hit", "revalidated" or "miss"."""
+        key = self.key(url)
+        entry = self._mem_get(key)
+        if entry is not None and entry["fresh_until"] > time.time():
+            self._count("hit", entry["body_bytes"])
+            return {**entry["output"], "cache": "hit"}
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            try:
+                out, body_bytes, shared = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                return await self.get(url, fetch)
+            if shared is not None:
+                # Served by another caller's request
+                self._count(shared, body_bytes if shared == "hit" else 0)
+                return {**out, "cache": shared}
+            # Private to the caller that fetched it
+            out, _, _ = await self._lookup(key, None, fetch)
+            return out
+
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            out, body_bytes, shared = await self._lookup(key, entry, fetch)
+            fut.set_result((out, body_bytes, shared))
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        return out
+
+    async def _lookup(
+            self, key: str, entry: Optional[Dict[str, Any]], fetch: Fetch
+    ) -> Tuple[Dict[str, Any], int, Optional[str]]:
+        """
+        (output, body bytes, how waiters may share it) from the Redis tier, a
+        revalidation or a full fetch. The last is "hit", "coalesced" or None
+        for a private response.
+        """
+        if entry is None:
+            entry = await self._redis_get(key)
+            if entry is not None and entry["fresh_until"] > time.time():
+                self._mem_put(key, entry, len(json.dumps(entry, separators=(",", ":"))))
+                self._count("hit", entry["body_bytes"])
+                return {**entry["output"], "cache": "hit"}, entry["body_bytes"], "hit"
+
+        validators = entry["validators"] if entry is not None else {}
+        resp, output = await fetch(validators or None)
+        now = time.time()
+        if resp.status_code == 304 and entry is not None:
+            # Same body; headers sent with the 304 update the stored ones
+            headers = {**entry["headers"], **{k: v for k, v in resp.headers.items() if k in _FRESHNESS_HEADERS}}
+            _, fresh_until, shareable = freshness(httpx.Headers(headers), now)
+            if "etag" in headers:
+                entry["validators"]["If-None-Match"] = headers["etag"]
+            entry.update(fresh_until=fresh_until, shareable=shareable, headers=headers)
+            await self._store(key, entry)
+            self._count("revalidated", entry["body_bytes"])
+            return {**entry["output"], "cache": "revalidated"}, entry["body_bytes"], self._shared(entry, now)
+
+        fresh = self._entry(resp, output, now)
+        if fresh is not None:
+            await self._store(key, fresh)
+            shared = self._shared(fresh, now)
+        else:
+            if key in self._lru:
+                self._mem_drop(key)
+            shared = None if "private" in _directives(resp.headers.get("cache-control", "")) else "coalesced"
+        self._count("miss")
+        return {**output, "cache": "miss"}, output.get("bytes_read", 0), shared
+
+    @staticmethod
+    def _shared(entry: Dict[str, Any], now: float) -> Optional[str]:
+        if not entry["shareable"]:
+            return None
+        return "hit" if entry["fresh_until"] > now else "coalesced"
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "http_cache_entries": len(self._lru),
+            "http_cache_bytes": self._bytes,
+            "http_cache_max_bytes": self.max_bytes,
+            "http_cache_hit_ratio": (self.hits + self.revalidated) / self.lookups if self.lookups else 0.0,
+        }
@@ -0,0 +1,138 @@
+from __future__ import annotations
+import asyncio
+import importlib.util
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+from .config import settings
+
+log = logging.getLogger(__name__)
+
+
+class HttpClientPool:
+    """
+    App-lifetime httpx client shared by every http_get tool call.
+    - global limits (max_connections / keepalive) are enforced by httpx
+    - per-host limits are enforced here with one semaphore per host, kept
+      only while a request to the host holds or waits for it
+    """
+    def __init__(
+            self,
+            *,
+            max_connections: Optional[int] = None,
+            max_keepalive_connections: Optional[int] = None,
+            max_connections_per_host: Optional[int] = None,
+            keepalive_expiry: Optional[float] = None,
+            http2: Optional[bool] = None,
+            timeout_s: Optional[float] = None,
+    ) -> None:
+        self.max_connections = max_connections or settings.http_max_connections
+        self.max_keepalive_connections = max_keepalive_connections or settings.http_max_keepalive_connections
+        self.max_connections_per_host = max_connections_per_host or settings.http_max_connections_per_host
+        self.keepalive_expiry = keepalive_expiry if keepalive_expiry is not None else settings.http_keepalive_expiry
+        self.timeout_s = timeout_s or settings.http_timeout_seconds
+
+        want_http2 = settings.http2 if http2 is None else http2
+        if want_http2 and importlib.util.find_spec("h2") is None:
+            log.warning("http2 requested but the 'h2' package is not installed; using HTTP/1.1")
+            want_http2 = False
+        self.http2 = want_http2
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._transport: Optional[httpx.AsyncHTTPTransport] = None
+        self._host_sems: Dict[str, asyncio.Semaphore] = {}
+        # host -> requests holding or waiting for its semaphore
+        self._host_users: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = {}
+        self.requests_total = 0
+        self.host_waits_total = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._transport = httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                http2=self.http2,
+            )
+            self._client = httpx.AsyncClient(
+                transport=self._transport,
+                timeout=self.timeout_s,
+                follow_redirects=True,
+            )
+        return self._client
+
+    @staticmethod
+    def host_key(url: str) -> str:
+        u = httpx.URL(url)
+        port = u.port or (443 if u.scheme == "https" else 80)
+        return f"{u.host}:{port}"
+
+    @asynccontextmanager
+    async def slot(self, url: str) -> AsyncIterator[httpx.AsyncClient]:
+        host = self.host_key(url)
+        sem = self._host_sems.get(host)
+        if sem is None:
+            sem = self._host_sems[host] = asyncio.Semaphore(self.max_connections_per_host)
+        if sem.locked():
+            self.host_waits_total += 1
+        self._host_users[host] = self._host_users.get(host, 0) + 1
+        try:
+            async with sem:
+                self._in_flight[host] = self._in_flight.get(host, 0) + 1
+                self.requests_total += 1
+                try:
+                    yield self.client
+                finally:
+                    self._in_flight[host] -= 1
+                    if self._in_flight[host] == 0:
+                        del self._in_flight[host]
+        finally:
+            # Hosts come from planned URLs: an unused semaphore is dropped, not kept forever
+            self._host_users[host] -= 1
+            if self._host_users[host] == 0:
+                del self._host_users[host]
+                del self._host_sems[host]
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        async with self.slot(url) as client:
+            return await client.get(url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """GET with the body left unread; leaving the block closes the response and frees the slot."""
+        async with self.slot(url) as client:
+            async with client.stream("GET", url, **kwargs) as resp:
+                yield resp
+
+    def snapshot(self) -> Dict[str, float]:
+        active = idle = 0
+        pool = getattr(self._transport, "_pool", None)
+        for conn in getattr(pool, "connections", []) or []:
+            if conn.is_idle():
+                idle += 1
+            else:
+                active += 1
+        out: Dict[str, float] = {
+            "http_pool_requests_total": self.requests_total,
+            "http_pool_host_waits_total": self.host_waits_total,
+            'http_pool_connections{state="active"}': active,
+            'http_pool_connections{state="idle"}': idle,
+            "http_pool_max_connections": self.max_connections,
+            "http_pool_max_connections_per_host": self.max_connections_per_host,
+        }
+        for host, n in self._in_flight.items():
+            out[f'http_pool_in_flight{{host="{host}"}}'] = n
+        return out
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._transport = None
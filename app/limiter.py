@@ -0,0 +1,194 @@
+from __future__ import annotations
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from .config import settings
+
+
+class Permit:
+    """Handed out by AdaptiveLimiter.slot(); mark failed or ignore before leaving the block."""
+    __slots__ = ("started", "failed", "ignore", "slow")
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.failed = False
+        # e.g. a task that turned out to be done already: its latency says nothing
+        self.ignore = False
+        # Set by AdaptiveLimiter.observe() when a dependency call ran slow
+        self.slow = False
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that follows observed latency and failures (AIMD):
+    - a failure, or a task with a dependency call (see observe()) slower than
+      tolerance x that dependency's long-run average, cuts the limit by
+      decrease_ratio, at most once per average task latency so one slow wave
+      does not collapse it
+    - a success while the limit was fully used raises it by 1/limit, i.e.
+      about +1 per limit's worth of completions
+    The limit stays within [min_limit, max_limit].
+    Latency is compared per dependency, not per task: a task's own latency
+    depends on its plan (rule-routed or LLM-planned, how many steps), so a
+    normal mix of tasks would look like congestion.
+    """
+    def __init__(
+            self,
+            name: str,
+            *,
+            initial: Optional[int] = None,
+            min_limit: Optional[int] = None,
+            max_limit: Optional[int] = None,
+            tolerance: Optional[float] = None,
+            decrease_ratio: Optional[float] = None,
+            adaptive: Optional[bool] = None,
+    ) -> None:
+        self.name = name
+        self.limit = float(initial or settings.max_concurrent_tasks)
+        self.adaptive = settings.adaptive_concurrency_enabled if adaptive is None else adaptive
+        self.min_limit = min_limit or settings.concurrency_min
+        self.max_limit = max_limit or settings.concurrency_max or int(self.limit)
+        if not self.adaptive:
+            self.min_limit = self.max_limit = int(self.limit)
+        self.limit = min(max(self.limit, self.min_limit), self.max_limit)
+        self.tolerance = tolerance or settings.concurrency_latency_tolerance
+        self.decrease_ratio = decrease_ratio or settings.concurrency_decrease_ratio
+        self.in_flight = 0
+        self.avg_latency: Optional[float] = None
+        # dependency -> long-run average call latency
+        self.dep_latency: Dict[str, float] = {}
+        # The permit of the slot the current task runs in, for observe()
+        self._permit: ContextVar[Optional[Permit]] = ContextVar(f"permit_{name}", default=None)
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def capacity(self) -> int:
+        return int(self.limit)
+
+    async def acquire(self) -> None:
+        while self.in_flight >= self.capacity:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+                else:
+                    # woken, then cancelled: hand the wake-up on
+                    self._wake()
+                raise
+        self.in_flight += 1
+
+    def release(self, permit: Optional[Permit] = None) -> None:
+        used = self.in_flight >= self.capacity
+        self.in_flight -= 1
+        if permit is not None and not permit.ignore and self.adaptive:
+            self._sample(time.perf_counter() - permit.started, permit.failed or permit.slow, permit.failed, used)
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[Permit]:
+        await self.acquire()
+        permit = Permit()
+        token = self._permit.set(permit)
+        try:
+            yield permit
+        except BaseException:
+            permit.failed = True
+            raise
+        finally:
+            self._permit.reset(token)
+            self.release(permit)
+
+    def observe(self, dependency: str, latency: float) -> None:
+        """
+        Latency of one successful call to dependency (a tool, the planner)
+        made by the task holding the current slot; marks its permit slow
+        when the call took over tolerance x the dependency's average.
+        """
+        avg = self.dep_latency.get(dependency)
+        permit = self._permit.get()
+        if permit is not None and avg is not None and latency > avg * self.tolerance:
+            permit.slow = True
+        self.dep_latency[dependency] = latency if avg is None else avg + 0.05 * (latency - avg)
+
+    def _sample(self, latency: float, congested: bool, failed: bool, used: bool) -> None:
+        avg = self.avg_latency
+        now = time.monotonic()
+        if congested:
+            if avg is None or now - self._last_decrease >= avg:
+                new = max(self.min_limit, self.limit * self.decrease_ratio)
+                if new < self.limit:
+                    self.limit = new
+                    self.decreases += 1
+                self._last_decrease = now
+        elif used:
+            new = min(self.max_limit, self.limit + 1 / self.limit)
+            if new > self.limit:
+                self.limit = new
+                self.increases += 1
+        if not failed:
+            # Only spaces decreases out; the long-run average follows a sustained shift, not a burst
+            self.avg_latency = latency if avg is None else avg + 0.05 * (latency - avg)
+
+    def _wake(self) -> None:
+        free = self.capacity - self.in_flight
+        while free > 0 and self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+    def stats(self) -> Dict[str, float]:
+        n = self.name
+        return {
+            f'concurrency_limit{{name="{n}"}}': self.capacity,
+            f'concurrency_in_flight{{name="{n}"}}': self.in_flight,
+            f'concurrency_waiting{{name="{n}"}}': len(self._waiters),
+            f'concurrency_avg_latency_seconds{{name="{n}"}}': self.avg_latency or 0.0,
+            **{
+                f'concurrency_dependency_avg_latency_seconds{{name="{n}",dependency="{d}"}}': v
+                for d, v in self.dep_latency.items()
+            },
+            f'concurrency_limit_changes_total{{name="{n}",direction="increase"}}': self.increases,
+            f'concurrency_limit_changes_total{{name="{n}",direction="decrease"}}': self.decreases,
+        }
+
+
+class Bulkhead:
+    """Fixed concurrency pool for one dependency, so it cannot take every slot from the others."""
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.limit = limit
+        self._sem = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def __aenter__(self) -> "Bulkhead":
+        self.waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc: object) -> None:
+        self.in_flight -= 1
+        self._sem.release()
+
+    def stats(self) -> Dict[str, float]:
+        n = self.name
+        return {
+            f'bulkhead_limit{{name="{n}"}}': self.limit,
+            f'bulkhead_in_flight{{name="{n}"}}': self.in_flight,
+            f'bulkhead_waiting{{name="{n}"}}': self.waiting,
+        }
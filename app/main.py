@@ -3,32 +3,81 @@ from fastapi import FastAPI, Depends
 import redis.asyncio as redis
 
 from .config import settings
-from .api import router
+from .api import router, get_store as api_get_store, get_queue as api_get_queue, get_event_hub as api_get_event_hub
+from .events import LocalEventHub, TaskEventHub
+from .storage import EventHub, TaskQueue, TaskStore
 from .redis_store import RedisStore
+from .store import InMemoryStore
+from .archive import TaskArchive, TaskArchiver
 from .redis_queue import RedisQueue
+from .redis_stream_queue import RedisStreamQueue
+from .memory_queue import InMemoryQueue
 from .worker import Worker
+from . import calc_eval
+from .metrics import metrics
+from .tracing import tracer
+from .profiler import profiler
 
 app = FastAPI(title = "LLM Task Runner (Redis + OpenAI)", version="0.1.0")
 
-r = redis.from_url(settings.redis_url, decode_responses=False)
-store = RedisStore(r)
-queue = RedisQueue(r)
+r = None
+archive = None
+archiver = None
+store: TaskStore
+queue: TaskQueue
+event_hub: EventHub
+if settings.storage_backend == "memory":
+    event_hub = LocalEventHub()
+    store = InMemoryStore(hub=event_hub)
+    queue = InMemoryQueue()
+elif settings.storage_backend == "redis":
+    r = redis.from_url(settings.redis_url, decode_responses=False)
+    archive = TaskArchive() if settings.archive_enabled else None
+    store = RedisStore(r, archive=archive)
+    archiver = TaskArchiver(store, archive) if archive is not None else None
+    if archive is not None:
+        metrics.register_collector(archive.stats)
+        metrics.register_collector(archiver.stats)
+    queue = RedisStreamQueue(r) if settings.queue_backend == "stream" else RedisQueue(r)
+    event_hub = TaskEventHub(r)
+else:
+    raise ValueError(f"unknown storage backend: {settings.storage_backend}")
 worker = Worker(store,queue)
 
-def get_store() -> RedisStore:
+def get_store() -> TaskStore:
     return store
 
-def get_queue() -> RedisQueue:
+def get_queue() -> TaskQueue:
     return queue
 
+def get_event_hub() -> EventHub:
+    return event_hub
+
 @app.on_event("startup")
 async def startup():
+    metrics.start()
+    tracer.start()
+    if settings.trace_enabled and settings.trace_profile_enabled:
+        profiler.start()
     worker.start()
+    if archiver is not None:
+        archiver.start()
 
 @app.on_event("shutdown")
 async def shutdown():
     await worker.stop()
-    await r.aclose()
+    if archiver is not None:
+        await archiver.stop()
+        archive.close()
+    calc_eval.engine.shutdown()
+    await worker.http.aclose()
+    await worker.planner.aclose()
+    await event_hub.aclose()
+    await metrics.stop()
+    profiler.stop()
+    await tracer.stop()
+    if r is not None:
+        await r.aclose()
 
 # Dependency Injections of store into routes
 @app.middleware("http")
@@ -43,5 +92,6 @@ async def root():
 #Hook store into endpoints via Depends
 app.include_router(router)
 
-app.dependency_overrides[RedisStore] = get_store
-app.dependency_overrides[RedisQueue] = get_queue
+app.dependency_overrides[api_get_store] = get_store
+app.dependency_overrides[api_get_queue] = get_queue
+app.dependency_overrides[api_get_event_hub] = get_event_hub
@@ -0,0 +1,152 @@
+from __future__ import annotations
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .config import settings
+from .metrics import metrics
+from .redis_queue import DEFAULT_TENANT, PRIORITIES
+
+
+class InMemoryQueue:
+    """
+    The memory backend's task queue: RedisQueue's scheduling, in process.
+    One deque per (priority, tenant); stride scheduling across tenants
+    within a priority, strict or weighted order across priorities, and
+    aging, exactly as _DEQUEUE_LUA does it. Idle workers wait on an event
+    set by every enqueue. Nothing survives a restart.
+    """
+    kind = "memory"
+
+    def __init__(self) -> None:
+        self._lists: Dict[Tuple[str, str], Deque[Tuple[int, str]]] = {}
+        # priority -> {active tenant: pass}
+        self._tenants: Dict[str, Dict[str, float]] = {p: {} for p in PRIORITIES}
+        # active priority -> pass (weighted mode)
+        self._prios: Dict[str, float] = {}
+        # Virtual time a tenant / priority (re)activates at, so it cannot own the backlog
+        self._vtime_t: Dict[str, float] = {p: 0.0 for p in PRIORITIES}
+        self._vtime_p = 0.0
+        self._nonempty = asyncio.Event()
+        self._tenant_labels: set[str] = set()
+
+    async def enqueue(self, task_id: str, tenant: Optional[str] = None, priority: str = "normal") -> None:
+        tenant = tenant or DEFAULT_TENANT
+        items = self._lists.get((priority, tenant))
+        if items is None:
+            items = self._lists[(priority, tenant)] = deque()
+        items.append((int(time.time() * 1000), task_id))
+        if len(items) == 1:
+            self._tenants[priority].setdefault(tenant, self._vtime_t[priority])
+            self._prios.setdefault(priority, self._vtime_p)
+        self._nonempty.set()
+
+    @staticmethod
+    def _lowest(passes: Dict[str, float]) -> str:
+        # ZRANGE 0 0 order: lowest score, then name
+        return min(passes.items(), key=lambda kv: (kv[1], kv[0]))[0]
+
+    def _pick(self, now_ms: int) -> Optional[str]:
+        first: Optional[str] = None
+        aged: Optional[str] = None
+        aged_ts = 0
+        aging_ms = settings.queue_aging_seconds * 1000
+        for p in PRIORITIES:
+            tenants = self._tenants[p]
+            if not tenants:
+                continue
+            if first is None:
+                first = p
+            elif aging_ms > 0:
+                ts = self._lists[(p, self._lowest(tenants))][0][0]
+                if now_ms - ts >= aging_ms and (aged is None or ts < aged_ts):
+                    aged, aged_ts = p, ts
+        if aged is not None:
+            return aged
+        if settings.queue_priority_mode == "weighted" and first is not None and self._prios:
+            return self._lowest(self._prios)
+        return first
+
+    def _pop(self, max_items: int) -> List[str]:
+        now_ms = int(time.time() * 1000)
+        out: List[str] = []
+        while len(out) < max_items:
+            p = self._pick(now_ms)
+            if p is None:
+                break
+            tenants = self._tenants[p]
+            tenant = self._lowest(tenants)
+            pass_ = tenants[tenant]
+            items = self._lists[(p, tenant)]
+            ts, task_id = items.popleft()
+            self._vtime_t[p] = pass_
+            if not items:
+                del tenants[tenant]
+                del self._lists[(p, tenant)]
+            else:
+                tenants[tenant] = pass_ + 1 / settings.queue_tenant_weights.get(tenant, 1)
+            ppass = self._prios.get(p, 0.0)
+            self._vtime_p = ppass
+            if not tenants:
+                self._prios.pop(p, None)
+            else:
+                self._prios[p] = ppass + 1 / settings.queue_priority_weights.get(p, 1)
+            out.append(task_id)
+            metrics.observe(
+                "queue_class_wait_seconds", max(0.0, (now_ms - ts) / 1000),
+                priority=p, tenant=self._tenant_label(tenant),
+            )
+        return out
+
+    def _tenant_label(self, tenant: str) -> str:
+        # Bounded label cardinality: tenants past the cap share one series
+        if tenant in self._tenant_labels:
+            return tenant
+        if len(self._tenant_labels) < settings.queue_metrics_max_tenants:
+            self._tenant_labels.add(tenant)
+            return tenant
+        return "other"
+
+    async def dequeue_blocking(self, timeout_s: int = 0) -> str:
+        items = await self.dequeue_batch(1, timeout_s)
+        if not items:
+            raise TimeoutError("queue timeout")
+        return items[0]
+
+    async def dequeue_batch(self, max_items: int, timeout_s: int = 0) -> List[str]:
+        """Pops up to max_items in scheduling order; [] on timeout (0 waits forever)."""
+        if max_items <= 0:
+            return []
+        deadline = time.monotonic() + timeout_s
+        while True:
+            items = self._pop(max_items)
+            if items:
+                return items
+            self._nonempty.clear()
+            remaining = deadline - time.monotonic()
+            if timeout_s and remaining <= 0:
+                return []
+            try:
+                await asyncio.wait_for(self._nonempty.wait(), timeout=remaining if timeout_s else None)
+            except asyncio.TimeoutError:
+                return []
+
+    async def ack(self, task_id: str) -> None:
+        # The pop already removed the item; nothing to acknowledge
+        return None
+
+    async def stats(self) -> Dict[str, float]:
+        now_ms = time.time() * 1000
+        out: Dict[str, float] = {f'queue_priority_depth{{priority="{p}"}}': 0 for p in PRIORITIES}
+        total = 0
+        for (p, t), items in self._lists.items():
+            label = f'priority="{p}",tenant="{self._tenant_label(t)}"'
+            out[f"queue_class_depth{{{label}}}"] = out.get(f"queue_class_depth{{{label}}}", 0) + len(items)
+            out[f'queue_priority_depth{{priority="{p}"}}'] += len(items)
+            total += len(items)
+            if items:
+                key = f"queue_class_oldest_seconds{{{label}}}"
+                out[key] = max(out.get(key, 0.0), max(0.0, (now_ms - items[0][0]) / 1000))
+        out["queue_depth"] = total
+        return out
@@ -1,36 +1,305 @@
 from __future__ import annotations
 import asyncio
-from typing import Dict
+import bisect
+import inspect
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from .config import settings
+
+log = logging.getLogger(__name__)
+
+Collector = Callable[[], Union[Dict[str, float], Awaitable[Dict[str, float]]]]
+Labels = Tuple[Tuple[str, str], ...]
+
+PREFIX = "llm_task_runner_"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Declared up front so they render (at zero) before the first event
+COUNTERS = {
+    "tasks_created_total": "Tasks created through the API",
+    "tasks_succeeded_total": "Tasks that finished successfully",
+    "tasks_failed_total": "Tasks that finished with an error",
+    "tasks_deferred_total": "Task runs parked for a delayed step retry",
+    "tasks_retry_promoted_total": "Delayed tasks put back on the queue once their retry was due",
+    "tool_calls_total": "Tool steps by tool and outcome",
+    "tool_retries_total": "Tool attempts retried after a failure",
+    "llm_plans_total": "Planner calls that reached the planner backend",
+    "planner_routes_total": "Routing decisions: rule plan used, or LLM fallback by reason",
+    "plan_stream_steps_total": "Steps started from a plan still being streamed",
+    "plan_stream_discarded_steps_total": "Speculatively started steps dropped because the streamed plan failed",
+    "plan_cache_hits_total": "Plans served from the plan cache",
+    "plan_cache_misses_total": "Plan cache misses",
+    "plan_cache_coalesced_total": "Plan requests that joined an identical in-flight request",
+    "http_get_truncated_total": "http_get bodies cut off at the byte cap",
+    "http_cache_requests_total": "http_get cache lookups by result (hit, revalidated, miss)",
+    "http_cache_bytes_saved_total": "Response body bytes not downloaded thanks to the http_get cache",
+    "circuit_opened_total": "Times a host's circuit breaker opened",
+    "circuit_rejected_total": "http_get calls refused by an open circuit",
+    "host_rate_limited_total": "http_get calls delayed by a host's rate limit",
+}
+GAUGES = {
+    "tasks_running": "Tasks currently executing",
+}
+HISTOGRAMS = {
+    "queue_wait_seconds": "From task creation to start of execution",
+    "queue_class_wait_seconds": "Time in the list queue by priority and tenant",
+    "plan_latency_seconds": "Plan step latency, cache lookup included",
+    "plan_stream_first_step_seconds": "From the start of a streamed planner call to its first complete step",
+    "tool_latency_seconds": "Tool step latency, retries and backoff included",
+    "task_duration_seconds": "From task creation to terminal status",
+    "task_run_seconds": "From start of execution to terminal status",
+}
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt(name: str, labels: Iterable[Tuple[str, str]], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return f"{PREFIX}{name}{{{','.join(parts)}}}" if parts else f"{PREFIX}{name}"
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
 
 class Metrics:
+    """
+    Counters, gauges and histograms keyed by (name, labels).
+    Updates are plain dict operations on the event loop thread, so there is
+    no lock and recording never awaits.
+
+    Multi-process mode (settings.metrics_multiproc_dir): each process writes
+    its snapshot to <dir>/metrics-<pid>.json every few seconds and /metrics
+    merges every fresh snapshot. Counters and histograms are summed; gauges
+    are summed as well, except samples from collectors registered with
+    shared=True (global state such as queue depth), which take the max.
+    """
     def __init__(self)-> None:
-        self._lock = asyncio.Lock()
-        self.counters: Dict[str, int] = {
-            "task_created": 0,
-            "task_running": 0,
-            "tasks_succeeded": 0,
-            "tasks_failed": 0,
-            "tool_calls": 0,
-            "tool_failures": 0,
-            "llm_plans": 0,
+        self._counters: Dict[Tuple[str, Labels], float] = {(n, ()): 0 for n in COUNTERS}
+        self._gauges: Dict[Tuple[str, Labels], float] = {(n, ()): 0 for n in GAUGES}
+        self._hists: Dict[Tuple[str, Labels], Histogram] = {}
+        self._buckets: Dict[str, Sequence[float]] = {}
+        self._collectors: List[Tuple[Collector, bool]] = []
+        self._flusher: Optional[asyncio.Task] = None
+
+    def register_collector(self, fn: Collector, *, shared: bool = False) -> None:
+        """
+        fn returns {metric_name: value}; names may carry labels, e.g. 'x{host="a"}'.
+        Names ending in _total are counters, the rest gauges.
+        """
+        self._collectors.append((fn, shared))
+
+    def inc(self, name: str, by: float = 1, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        self._counters[key] = self._counters.get(key, 0) + by
+
+    def gauge_add(self, name: str, by: float, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        self._gauges[key] = self._gauges.get(key, 0) + by
+
+    def gauge_set(self, name: str, value: float, **labels: Any) -> None:
+        self._gauges[(name, _labels(labels))] = value
+
+    def set_buckets(self, name: str, buckets: Sequence[float]) -> None:
+        self._buckets[name] = buckets
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        h = self._hists.get(key)
+        if h is None:
+            h = self._hists[key] = Histogram(self._buckets.get(name, DEFAULT_BUCKETS))
+        h.observe(value)
+
+    def total(self, name: str) -> float:
+        """A counter summed over all its label sets, in this process."""
+        return sum(v for (n, _), v in self._counters.items() if n == name)
+
+    def quantile(self, name: str, q: float) -> Optional[float]:
+        """
+        q-quantile of a histogram over all its label sets, in this process,
+        interpolated linearly inside the bucket it falls in.
+        """
+        hs = [h for (n, _), h in self._hists.items() if n == name]
+        if not hs or not sum(h.count for h in hs):
+            return None
+        buckets = hs[0].buckets
+        counts = [sum(c) for c in zip(*(h.counts for h in hs if h.buckets == buckets))]
+        rank = q * sum(counts)
+        cum, lower = 0, 0.0
+        for upper, c in zip(buckets, counts):
+            if c and cum + c >= rank:
+                return lower + (upper - lower) * (rank - cum) / c
+            cum += c
+            lower = upper
+        return buckets[-1]
+
+    async def _collect(self) -> List[Tuple[str, float, bool]]:
+        out: List[Tuple[str, float, bool]] = []
+        for fn, shared in self._collectors:
+            try:
+                values = fn()
+                if inspect.isawaitable(values):
+                    values = await values
+            except Exception as e:
+                # A collector backed by Redis must not take /metrics down with it
+                log.warning("metrics collector %r failed: %s", fn, e)
+                self.inc("metrics_collector_errors_total")
+                continue
+            out.extend((k, v, shared) for k, v in values.items())
+        return out
+
+    async def snapshot(self) -> Dict[str, Any]:
+        return {
+            "pid": os.getpid(),
+            "ts": time.time(),
+            "counters": [[n, list(l), v] for (n, l), v in self._counters.items()],
+            "gauges": [[n, list(l), v] for (n, l), v in self._gauges.items()],
+            "hists": [[n, list(l), h.buckets, h.counts, h.sum, h.count] for (n, l), h in self._hists.items()],
+            "collected": [[k, v, shared] for k, v, shared in await self._collect()],
         }
 
+    def _snapshot_path(self, pid: int) -> str:
+        return os.path.join(settings.metrics_multiproc_dir, f"metrics-{pid}.json")
 
-    async def inc(self, name: str, by: int = 1) -> None :
-        async with self._lock:
-            self.counters[name] = self.counters.get(name,0) + by
+    async def flush(self) -> None:
+        if not settings.metrics_multiproc_dir:
+            return
+        snap = await self.snapshot()
+        path = self._snapshot_path(snap["pid"])
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snap, f)
+        os.replace(tmp, path)
 
-    async def dec(self, name: str, by: int = 1) -> None :
-        await self.inc(name, -by)
+    def _read_snapshots(self) -> List[Dict[str, Any]]:
+        d = settings.metrics_multiproc_dir
+        cutoff = time.time() - settings.metrics_multiproc_stale_seconds
+        snaps = []
+        for fn in os.listdir(d):
+            if not (fn.startswith("metrics-") and fn.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(d, fn)) as f:
+                    snap = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # Snapshots of processes that stopped flushing are ignored
+            if snap.get("ts", 0) >= cutoff:
+                snaps.append(snap)
+        return snaps
+
+    def start(self) -> None:
+        if settings.metrics_multiproc_dir and self._flusher is None:
+            os.makedirs(settings.metrics_multiproc_dir, exist_ok=True)
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await self.flush()
+            except Exception as e:
+                log.warning("metrics snapshot flush failed: %s", e)
+            await asyncio.sleep(settings.metrics_multiproc_flush_seconds)
+
+    async def stop(self) -> None:
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except (asyncio.CancelledError, Exception):
+            pass
+        self._flusher = None
+        try:
+            os.remove(self._snapshot_path(os.getpid()))
+        except OSError:
+            pass
 
     async def render_prometheus(self) -> str:
-        async with self._lock:
-            lines = []
-            for k,v in self.counters.items():
-                metric = f"llm_task_runner_{k}"
-                lines.append(f"# TYPE {metric} counter")
-                lines.append(f"{metric} {v}")
-            return "\n".join(lines) + "\n"
+        if settings.metrics_multiproc_dir:
+            await self.flush()
+            snaps = self._read_snapshots()
+        else:
+            snaps = [await self.snapshot()]
+
+        counters: Dict[Tuple[str, Labels], float] = {}
+        gauges: Dict[Tuple[str, Labels], float] = {}
+        hists: Dict[Tuple[str, Labels], Histogram] = {}
+        collected: Dict[str, float] = {}
+        for snap in snaps:
+            for n, l, v in snap["counters"]:
+                key = (n, tuple(map(tuple, l)))
+                counters[key] = counters.get(key, 0) + v
+            for n, l, v in snap["gauges"]:
+                key = (n, tuple(map(tuple, l)))
+                gauges[key] = gauges.get(key, 0) + v
+            for n, l, buckets, counts, s, c in snap["hists"]:
+                key = (n, tuple(map(tuple, l)))
+                h = hists.get(key)
+                if h is None:
+                    h = hists[key] = Histogram(buckets)
+                if h.buckets == list(buckets):
+                    h.counts = [a + b for a, b in zip(h.counts, counts)]
+                    h.sum += s
+                    h.count += c
+            for k, v, shared in snap["collected"]:
+                if shared:
+                    collected[k] = max(collected.get(k, v), v)
+                else:
+                    collected[k] = collected.get(k, 0) + v
+
+        # Exposition format wants every sample of a family under one TYPE line
+        families: Dict[str, Tuple[str, List[str]]] = {}
+
+        def family(name: str, kind: str) -> List[str]:
+            return families.setdefault(name, (kind, []))[1]
+
+        # The zero placeholder of a declared counter goes once labelled series exist
+        labelled = {n for n, l in counters if l}
+        for (n, l), v in sorted(counters.items()):
+            if not l and not v and n in labelled:
+                continue
+            family(n, "counter").append(f"{_fmt(n, l)} {v}")
+        for (n, l), v in sorted(gauges.items()):
+            family(n, "gauge").append(f"{_fmt(n, l)} {v}")
+        for (n, l), h in sorted(hists.items(), key=lambda kv: kv[0]):
+            lines = family(n, "histogram")
+            cum = 0
+            for le, c in zip(h.buckets, h.counts):
+                cum += c
+                lines.append(f"{_fmt(n + '_bucket', l, 'le=' + json.dumps(str(le)))} {cum}")
+            lines.append(f"{_fmt(n + '_bucket', l, 'le=' + json.dumps('+Inf'))} {h.count}")
+            lines.append(f"{_fmt(n + '_sum', l)} {h.sum}")
+            lines.append(f"{_fmt(n + '_count', l)} {h.count}")
+        for k, v in collected.items():
+            base = k.split("{", 1)[0]
+            family(base, "counter" if base.endswith("_total") else "gauge").append(f"{PREFIX}{k} {v}")
+
+        out: List[str] = []
+        for name, (kind, samples) in families.items():
+            doc = COUNTERS.get(name) or GAUGES.get(name) or HISTOGRAMS.get(name)
+            if doc:
+                out.append(f"# HELP {PREFIX}{name} {doc}")
+            out.append(f"# TYPE {PREFIX}{name} {kind}")
+            out.extend(samples)
+        return "\n".join(out) + "\n"
 
 metrics = Metrics()
-      
\ No newline at end of file
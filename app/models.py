@@ -4,10 +4,14 @@ from datetime import datetime
 import uuid
 
 TaskStatus = Literal["queued", "running", "succeeded", "failed"]
+TaskPriority = Literal["high", "normal", "low"]
 
 class CreateTaskRequest(BaseModel):
     goal: str = Field(min_length=1, max_length=10_000)
     idempotency_key: Optional[str] = Field(default=None, max_length=200)
+    priority: TaskPriority = "normal"
+    # Fair-share key: tasks of one tenant cannot crowd out the others
+    tenant: Optional[str] = Field(default=None, max_length=64, pattern=r"^[A-Za-z0-9_.-]+$")
 
 class CreateTaskResponse(BaseModel):
     task_id: str
@@ -32,7 +36,43 @@ class Task(BaseModel):
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
     idempotency_key: Optional[str]
+    priority: TaskPriority = "normal"
+    tenant: Optional[str] = None
+    # step_no -> failed attempts of steps that went through a delayed retry
+    attempts: Dict[int, int] = Field(default_factory=dict)
 
     steps: List[StepRecord] = Field(default_factory=list)
     result: Optional[str] = None
-    error: Optional[str] = None
\ No newline at end of file
+    error: Optional[str] = None
+
+class BulkCreateTasksRequest(BaseModel):
+    # Items are validated one by one so a bad item fails alone, not the whole batch
+    tasks: List[Dict[str, Any]] = Field(min_length=1)
+
+class BulkCreateItemResult(BaseModel):
+    index: int
+    ok: bool
+    task_id: Optional[str] = None
+    status: Optional[TaskStatus] = None
+    created: bool = False
+    # index of the earlier item in this batch carrying the same idempotency_key
+    duplicate_of: Optional[int] = None
+    error: Optional[str] = None
+
+class BulkCreateTasksResponse(BaseModel):
+    created: int
+    existing: int
+    failed: int
+    results: List[BulkCreateItemResult]
+
+class BulkStatusRequest(BaseModel):
+    task_ids: List[str] = Field(min_length=1)
+    include_steps: bool = False
+
+class BulkStatusItem(BaseModel):
+    task_id: str
+    found: bool
+    task: Optional[Task] = None
+
+class BulkStatusResponse(BaseModel):
+    results: List[BulkStatusItem]
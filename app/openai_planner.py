@@ -1,18 +1,30 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Literal, TypedDict
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional
 
-from openai import OpenAI
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
 from .config import settings
+from .planner import PlannedStep, PlannerUnavailable
 
-ToolName = Literal["http_get","calc"]
+# Errors about the API, not the goal (APITimeoutError is an APIConnectionError)
+_UNAVAILABLE = (APIConnectionError, RateLimitError, InternalServerError)
 
-class PlannedStep(TypedDict):
-    tool: ToolName
-    args: Dict[str, Any]
-    
 class OpenAIPlanner:
-    def __init__(self)-> None:
-        self.client = OpenAI()
+    name = "openai_planner"
+    version = "2"
+
+    def __init__(self, client: Optional[AsyncOpenAI] = None)-> None:
+        # Created lazily so importing this module does not require OPENAI_API_KEY
+        self._client = client
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            self._client = AsyncOpenAI(
+                base_url=settings.openai_base_url or None,
+                timeout=settings.planner_timeout_seconds,
+            )
+        return self._client
 
     def _tools(self) -> List[Dict[str, Any]]:
         return [
@@ -30,6 +42,11 @@ class OpenAIPlanner:
                                 "properties": {
                                     "tool": {"type": "string","enum":["http_get","calc"]},
                                     "args": {"type": "object"},
+                                    "depends_on": {
+                                        "type": "array",
+                                        "items": {"type": "integer"},
+                                        "description": "0-based indices of earlier steps whose results this step needs",
+                                    },
                                 },
                                 "required": ["tool","args"],
                                 "additionalProperties": False,
@@ -42,8 +59,8 @@ class OpenAIPlanner:
             }
         ]
 
-    def plan(self, goal:str) -> List[PlannedStep]:
-        prompt = (
+    def _prompt(self, goal: str) -> str:
+        return (
             "You are a planner for a backend agent. \n"
             "Return only via tool calling `plan_steps`. \n"
             "Allowed tools: \n"
@@ -51,25 +68,60 @@ class OpenAIPlanner:
             "- calc: {expr} \n"
             "Constraints:\n"
             "- <=5 steps\n"
+            "- Steps run in parallel unless depends_on lists earlier step indices\n"
             "- If no tool is needed, return steps=[]\n"
             f"Goal: {goal}"
         )
 
-        resp = self.client.responses.create(
-            model =settings.openai_model,
-            input=prompt,
-            tools= self._tools(),
-        )
+    async def plan(self, goal:str) -> List[PlannedStep]:
+        try:
+            resp = await self.client.responses.create(
+                model =settings.openai_model,
+                input=self._prompt(goal),
+                tools= self._tools(),
+            )
+        except _UNAVAILABLE as e:
+            raise PlannerUnavailable(f"planner backend unavailable: {e}") from e
 
         steps: List[PlannedStep] = []
         for item in resp.output:
             if getattr(item, "type", None) == "function_call" and getattr(item, "name", None) == "plan_steps":
                 args = item.arguments
-                import json
                 payload = json.loads(args) if isinstance(args, str) else args
                 steps = payload.get("steps",[])
                 break
         
         return steps[:settings.max_steps]
 
-planner = OpenAIPlanner()    
\ No newline at end of file
+    async def stream_plan(self, goal: str) -> AsyncIterator[str]:
+        """Argument deltas of the plan_steps call, as the model streams them."""
+        try:
+            stream = await self.client.responses.create(
+                model=settings.openai_model,
+                input=self._prompt(goal),
+                tools=self._tools(),
+                stream=True,
+            )
+        except _UNAVAILABLE as e:
+            raise PlannerUnavailable(f"planner backend unavailable: {e}") from e
+        call_id: Optional[str] = None
+        try:
+            async for event in stream:
+                kind = getattr(event, "type", None)
+                if kind == "response.output_item.added":
+                    item = event.item
+                    if call_id is None and getattr(item, "type", None) == "function_call" and getattr(item, "name", None) == "plan_steps":
+                        call_id = item.id
+                elif kind == "response.function_call_arguments.delta" and call_id is not None and event.item_id == call_id:
+                    yield event.delta
+        except _UNAVAILABLE as e:
+            raise PlannerUnavailable(f"planner backend unavailable: {e}") from e
+        finally:
+            await stream.close()
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+planner = OpenAIPlanner()
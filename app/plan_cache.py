@@ -0,0 +1,171 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from .config import settings
+from .metrics import metrics
+from .planner import PlannedStep
+
+log = logging.getLogger(__name__)
+
+_WS_RE = re.compile(r"\s+")
+
+
+class PlanCache:
+    """
+    Two-tier cache of planner output:
+    - in-process LRU (bounded by entries, per-entry TTL)
+    - optional shared Redis tier (SET EX), so other nodes reuse plans too
+    Concurrent misses for the same key are collapsed into one planner call
+    (get_or_plan; streamed plans use lookup/store and are not collapsed).
+    """
+    def __init__(
+            self,
+            r: Optional[redis.Redis],
+            *,
+            max_entries: Optional[int] = None,
+            ttl_s: Optional[float] = None,
+            redis_ttl_s: Optional[int] = None,
+            prefix: str = "plancache:",
+    ) -> None:
+        self.r = r
+        self.max_entries = max_entries or settings.plan_cache_max_entries
+        self.ttl_s = ttl_s or settings.plan_cache_ttl_seconds
+        self.redis_ttl_s = redis_ttl_s or settings.plan_cache_redis_ttl_seconds
+        self.prefix = prefix
+        self._lru: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def normalize_goal(goal: str) -> str:
+        g = unicodedata.normalize("NFKC", goal)
+        g = _WS_RE.sub(" ", g).strip()
+        if settings.plan_cache_casefold:
+            g = g.casefold()
+        return g
+
+    def key(self, goal: str, planner_name: str, planner_version: str) -> str:
+        raw = "\x1f".join([self.normalize_goal(goal), settings.openai_model, planner_name, planner_version])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _mem_get(self, key: str) -> Optional[List[PlannedStep]]:
+        hit = self._lru.get(key)
+        if hit is None:
+            return None
+        expires_at, payload = hit
+        if expires_at < time.monotonic():
+            del self._lru[key]
+            return None
+        self._lru.move_to_end(key)
+        return json.loads(payload)
+
+    def _mem_put(self, key: str, payload: str) -> None:
+        self._lru[key] = (time.monotonic() + self.ttl_s, payload)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    async def _redis_get(self, key: str) -> Optional[str]:
+        if self.r is None:
+            return None
+        try:
+            raw = await self.r.get(self.prefix + key)
+        except Exception as e:
+            log.warning("plan cache redis get failed: %s", e)
+            return None
+        if raw is None:
+            return None
+        return raw.decode() if isinstance(raw, (bytes, bytearray)) else str(raw)
+
+    async def _redis_put(self, key: str, payload: str) -> None:
+        if self.r is None:
+            return
+        try:
+            await self.r.set(self.prefix + key, payload, ex=self.redis_ttl_s)
+        except Exception as e:
+            log.warning("plan cache redis set failed: %s", e)
+
+    async def lookup(self, goal: str, planner_name: str, planner_version: str) -> Optional[Tuple[List[PlannedStep], str]]:
+        """(steps, 'memory' | 'redis') on a hit, else None; for callers that plan themselves (streamed plans)."""
+        key = self.key(goal, planner_name, planner_version)
+        steps = self._mem_get(key)
+        if steps is not None:
+            metrics.inc("plan_cache_hits_total", tier="memory")
+            return steps, "memory"
+        payload = await self._redis_get(key)
+        if payload is None:
+            metrics.inc("plan_cache_misses_total")
+            return None
+        self._mem_put(key, payload)
+        metrics.inc("plan_cache_hits_total", tier="redis")
+        return json.loads(payload), "redis"
+
+    async def store(self, goal: str, planner_name: str, planner_version: str, steps: List[PlannedStep]) -> None:
+        key = self.key(goal, planner_name, planner_version)
+        payload = json.dumps(steps)
+        await self._redis_put(key, payload)
+        self._mem_put(key, payload)
+
+    async def get_or_plan(
+            self,
+            goal: str,
+            planner_name: str,
+            planner_version: str,
+            plan_fn: Callable[[], Awaitable[List[PlannedStep]]],
+    ) -> Tuple[List[PlannedStep], str]:
+        """Returns (steps, source) where source is 'memory', 'redis', 'coalesced' or 'miss'."""
+        key = self.key(goal, planner_name, planner_version)
+
+        steps = self._mem_get(key)
+        if steps is not None:
+            metrics.inc("plan_cache_hits_total", tier="memory")
+            return steps, "memory"
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            metrics.inc("plan_cache_coalesced_total")
+            try:
+                payload = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The leader was cancelled, not us: plan again
+                return await self.get_or_plan(goal, planner_name, planner_version, plan_fn)
+            return json.loads(payload), "coalesced"
+
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            payload = await self._redis_get(key)
+            source = "redis"
+            if payload is None:
+                source = "miss"
+                payload = json.dumps(await plan_fn())
+                await self._redis_put(key, payload)
+            self._mem_put(key, payload)
+            fut.set_result(payload)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # Waiters re-raise it; mark retrieved so an unobserved failure is not logged
+            fut.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        if source == "redis":
+            metrics.inc("plan_cache_hits_total", tier="redis")
+        else:
+            metrics.inc("plan_cache_misses_total")
+        return json.loads(payload), source
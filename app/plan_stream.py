@@ -0,0 +1,117 @@
+from __future__ import annotations
+import json
+from typing import Any, AsyncIterator, List, Optional, get_args
+
+from .planner import PlannedStep, ToolName
+
+_TOOLS = set(get_args(ToolName))
+_WS = " \t\r\n"
+
+
+class StepsParser:
+    """
+    Incremental scanner for the plan_steps arguments, {"steps": [{...}, ...]}.
+    feed() takes the next text chunk and returns the step objects it
+    completed, so a step can start before the model has written the rest
+    of the plan. Only the top-level "steps" array is split; each element is
+    handed to json.loads once its closing brace arrives. Anything that is
+    not an object inside that array raises ValueError.
+    """
+    def __init__(self) -> None:
+        self._stack: List[str] = []
+        self._in_str = False
+        self._esc = False
+        # Top-level key being read / last one read
+        self._key: Optional[List[str]] = None
+        self._last_key = ""
+        self._in_steps = False
+        self.steps_closed = False
+        self._obj: Optional[List[str]] = None
+        self.count = 0
+
+    def feed(self, chunk: str) -> List[PlannedStep]:
+        out: List[PlannedStep] = []
+        for c in chunk:
+            if self._obj is not None:
+                self._obj.append(c)
+            if self._in_str:
+                if self._key is not None and not (c == '"' and not self._esc):
+                    self._key.append(c)
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+                    if self._key is not None:
+                        self._last_key, self._key = "".join(self._key), None
+                continue
+            depth = len(self._stack)
+            if c == '"':
+                if self._in_steps and depth == 2:
+                    raise ValueError(f"invalid plan: step {self.count} is not an object")
+                self._in_str = True
+                if depth == 1:
+                    self._key = []
+            elif c in "{[":
+                if self._in_steps and depth == 2:
+                    if c != "{":
+                        raise ValueError(f"invalid plan: step {self.count} is not an object")
+                    self._obj = [c]
+                elif depth == 1 and c == "[" and self._last_key == "steps":
+                    self._in_steps = True
+                self._stack.append(c)
+            elif c in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if self._in_steps and depth == 3 and self._obj is not None:
+                    out.append(self._step("".join(self._obj)))
+                    self._obj = None
+                elif self._in_steps and depth == 2:
+                    self._in_steps, self.steps_closed = False, True
+            elif self._in_steps and depth == 2 and c not in _WS and c != ",":
+                raise ValueError(f"invalid plan: step {self.count} is not an object")
+        return out
+
+    def _step(self, raw: str) -> PlannedStep:
+        st: Any = json.loads(raw)
+        if not isinstance(st.get("tool"), str) or st["tool"] not in _TOOLS:
+            raise ValueError(f"invalid plan: step {self.count} has unknown tool {st.get('tool')!r}")
+        if not isinstance(st.get("args"), dict):
+            raise ValueError(f"invalid plan: step {self.count} args must be an object")
+        self.count += 1
+        return st
+
+
+async def stream_steps(chunks: AsyncIterator[str]) -> AsyncIterator[PlannedStep]:
+    """
+    Steps of a streamed plan_steps call, each as soon as it is complete.
+    Once the stream ends the whole arguments document is parsed again and
+    must hold exactly the steps already yielded, else ValueError: steps
+    started on the strength of a plan that turns out broken are the
+    caller's to cancel. No call at all (empty stream) is an empty plan.
+    """
+    parser = StepsParser()
+    text: List[str] = []
+    yielded: List[PlannedStep] = []
+    try:
+        async for chunk in chunks:
+            text.append(chunk)
+            for st in parser.feed(chunk):
+                yielded.append(st)
+                yield st
+    finally:
+        # Abandoned mid-plan (cancelled, or a step was rejected): close the model's stream now
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    doc = "".join(text)
+    if not doc.strip():
+        return
+    try:
+        payload = json.loads(doc)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid plan: arguments are not valid JSON ({e.msg} at {e.pos})") from e
+    steps = payload.get("steps", []) if isinstance(payload, dict) else None
+    if steps != yielded:
+        raise ValueError("invalid plan: final steps differ from the streamed ones")
@@ -1,12 +1,36 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Literal, TypedDict
+from typing import Any, AsyncIterator, Dict, List, Literal, NotRequired, Optional, Protocol, Tuple, TypedDict
+import asyncio
+import json
 import re
 
+from . import calc_eval
+from .config import settings
+from .metrics import metrics
+
 ToolName = Literal["http_get", "calc"]
 
 class PlannedStep(TypedDict):
     tool: ToolName
     args: Dict[str, Any]
+    # 0-based indices of earlier steps that must finish first; omitted = independent
+    depends_on: NotRequired[List[int]]
+
+class PlannerUnavailable(Exception):
+    """The planner backend could not answer (transport error, rate limit, server error); the goal is not at fault."""
+
+class AsyncPlanner(Protocol):
+    name: str
+    version: str
+
+    async def plan(self, goal: str) -> List[PlannedStep]: ...
+
+    async def aclose(self) -> None: ...
+
+class StreamingPlanner(AsyncPlanner, Protocol):
+    def stream_plan(self, goal: str) -> AsyncIterator[str]:
+        """The plan_steps arguments JSON, chunk by chunk as the model writes it."""
+        ...
 
 class Planner:
 
@@ -27,4 +51,129 @@ class Planner:
                 steps.append({"tool":"calc", "args":{"expr":expr}})
         return steps
 
-planner = Planner()    
\ No newline at end of file
+class StubPlanner:
+    """
+    Offline stand-in for the LLM planner: waits a simulated model latency
+    without blocking the loop, then returns the rule-based plan.
+    stream_plan() emits the same plan as plan_steps arguments in chunks of
+    chunk_chars, the latency spread over them; override arguments() to
+    stream something else (a broken or oversized plan).
+    """
+    name = "stub_planner"
+    version = "1"
+
+    def __init__(self, latency_s: Optional[float] = None, chunk_chars: Optional[int] = None) -> None:
+        self.latency_s = settings.planner_stub_latency_ms / 1000 if latency_s is None else latency_s
+        self.chunk_chars = chunk_chars or settings.planner_stub_chunk_chars
+        self._rules = Planner()
+
+    async def plan(self, goal: str) -> List[PlannedStep]:
+        if self.latency_s > 0:
+            await asyncio.sleep(self.latency_s)
+        return self._rules.plan(goal)[:settings.max_steps]
+
+    def arguments(self, goal: str) -> str:
+        return json.dumps({"steps": self._rules.plan(goal)[:settings.max_steps]})
+
+    async def stream_plan(self, goal: str) -> AsyncIterator[str]:
+        text = self.arguments(goal)
+        chunks = [text[i: i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+        for chunk in chunks:
+            if self.latency_s > 0:
+                await asyncio.sleep(self.latency_s / len(chunks))
+            yield chunk
+
+    async def aclose(self) -> None:
+        return None
+
+class RoutingPlanner:
+    """
+    Rule-based Planner first, the LLM planner (fallback) only when the rules
+    are not confident. The rule plan is used when:
+    - it has at least one step and at most one URL is in the goal
+    - every calc expression it extracted compiles
+    - at most planner_routing_max_unmatched_words words are left once the
+      URL, the calc expression and planner_routing_filler_words are removed
+    - the goal is at most planner_routing_max_goal_chars long
+    Worker calls route() itself so it can skip the plan cache and the
+    planner bulkhead for rule plans; plan() is the same decision for
+    callers that only know AsyncPlanner.
+    """
+    name = "routing_planner"
+    rules_name = "rule_planner"
+
+    WORD_RE = re.compile(r"[a-z][a-z']*")
+
+    def __init__(self, fallback: AsyncPlanner) -> None:
+        self.fallback = fallback
+        self.version = fallback.version
+        self._rules = Planner()
+        self.hits = 0
+        self.misses = 0
+
+    def _unmatched(self, goal: str) -> List[str]:
+        rest = Planner.URL_RE.sub(" ", goal)
+        low = rest.lower()
+        if "calc:" in low:
+            rest = rest.split(":", 1)[0]
+        elif re.search(r"\bcalculate\b", low):
+            rest = rest[: low.index("calculate")]
+        fillers = settings.planner_routing_filler_words
+        return [w for w in self.WORD_RE.findall(rest.lower()) if w not in fillers]
+
+    def _decline(self, goal: str, steps: List[PlannedStep]) -> Optional[str]:
+        """Why the rule plan is not trusted, or None when it is."""
+        if len(goal) > settings.planner_routing_max_goal_chars:
+            return "goal_too_long"
+        if not steps:
+            return "no_rule_match"
+        if len(Planner.URL_RE.findall(goal)) > 1:
+            return "multiple_urls"
+        for st in steps:
+            if st["tool"] == "calc":
+                try:
+                    calc_eval.compile_expr(st["args"]["expr"])
+                except (calc_eval.CalcError, calc_eval.CalcLimitError):
+                    return "calc_not_an_expression"
+        if len(self._unmatched(goal)) > settings.planner_routing_max_unmatched_words:
+            return "unmatched_words"
+        return None
+
+    def route(self, goal: str) -> Tuple[Optional[List[PlannedStep]], str]:
+        """(rule plan, "covered") when the rules suffice, else (None, reason for the LLM)."""
+        try:
+            steps = self._rules.plan(goal)
+        except (IndexError, ValueError):
+            # e.g. "Calculate" capitalised: matched case-insensitively, split case-sensitively
+            steps = []
+        reason = self._decline(goal, steps)
+        if reason is None:
+            self.hits += 1
+            metrics.inc("planner_routes_total", route="rules", reason="covered")
+            return steps[:settings.max_steps], "covered"
+        self.misses += 1
+        metrics.inc("planner_routes_total", route="llm", reason=reason)
+        return None, reason
+
+    async def plan(self, goal: str) -> List[PlannedStep]:
+        steps, _ = self.route(goal)
+        return steps if steps is not None else await self.fallback.plan(goal)
+
+    async def aclose(self) -> None:
+        await self.fallback.aclose()
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"planner_routing_hit_ratio": self.hits / total if total else 0.0}
+
+def build_planner() -> AsyncPlanner:
+    if settings.planner_backend == "stub":
+        backend: AsyncPlanner = StubPlanner()
+    elif settings.planner_backend == "openai":
+        from .openai_planner import OpenAIPlanner
+        backend = OpenAIPlanner()
+    else:
+        raise ValueError(f"unknown planner backend: {settings.planner_backend}")
+    return RoutingPlanner(backend) if settings.planner_routing_enabled else backend
+
+planner = Planner()
@@ -0,0 +1,93 @@
+from __future__ import annotations
+import sys
+import threading
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from .config import settings
+
+
+class SamplingProfiler:
+    """
+    Wall-clock stack sampler for the event loop thread. Every interval_ms a
+    background thread takes the loop thread's current stack; a sample is
+    charged to a task when one of the task's coroutine frames (registered
+    with attach()) is on it. While the loop waits for I/O no task frame is on
+    the stack, so the profile shows where each task kept the loop busy.
+
+    Stacks are kept in folded form ("outer;inner;leaf" -> samples), ready for
+    flamegraph tools, and capped at max_stacks distinct stacks per task.
+    """
+    def __init__(self, interval_ms: Optional[int] = None, max_stacks: Optional[int] = None) -> None:
+        self.interval_s = (interval_ms or settings.trace_profile_interval_ms) / 1000
+        self.max_stacks = max_stacks or settings.trace_profile_max_stacks
+        # id(frame) -> task key; frames stay alive while registered
+        self._frames: Dict[int, str] = {}
+        self._samples: Dict[str, Counter] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._target: Optional[int] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, thread_id: Optional[int] = None) -> None:
+        if self._thread is not None:
+            return
+        self._target = thread_id or threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="task-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+        self._thread = None
+
+    def attach(self, key: str) -> Tuple[int, str]:
+        """Charge samples with the caller's frame on the stack to key; pass the result to detach()."""
+        frame_id = id(sys._getframe(1))
+        self._frames[frame_id] = key
+        self._samples.setdefault(key, Counter())
+        return frame_id, key
+
+    def detach(self, token: Tuple[int, str]) -> None:
+        self._frames.pop(token[0], None)
+
+    def take(self, key: str) -> Counter:
+        """Samples collected for key, forgetting them."""
+        return self._samples.pop(key, Counter())
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            if not self._frames:
+                continue
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            key = None
+            while frame is not None:
+                if key is None:
+                    key = self._frames.get(id(frame))
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            del frame
+            if key is None:
+                continue
+            samples = self._samples.get(key)
+            if samples is None:
+                continue
+            folded = ";".join(reversed(stack))
+            if folded not in samples and len(samples) >= self.max_stacks:
+                folded = "[other]"
+            samples[folded] += 1
+
+
+def folded(samples: Counter, limit: int = 50) -> str:
+    """Top stacks as folded-stack lines, heaviest first."""
+    return "\n".join(f"{stack} {n}" for stack, n in samples.most_common(limit))
+
+profiler = SamplingProfiler()
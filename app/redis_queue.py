@@ -1,19 +1,268 @@
 from __future__ import annotations
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
 import redis.asyncio as redis
 
+from .config import settings
+from .metrics import metrics
+
+# Highest first
+PRIORITIES = ("high", "normal", "low")
+DEFAULT_TENANT = "default"
+
+# Pushes one item onto a (priority, tenant) list and, when that list was
+# empty, activates the tenant and the priority at the current virtual time,
+# so a returning tenant queues behind the others instead of owning the
+# backlog. Prepended to every script that enqueues (see redis_store).
+FAIR_PUSH_LUA = """
+local function fair_push(list, tenants, prios, vtime, wake, item, tenant, prio)
+  if redis.call('LPUSH', list, item) == 1 then
+    redis.call('ZADD', tenants, 'NX', tonumber(redis.call('HGET', vtime, 't:' .. prio)) or 0, tenant)
+    redis.call('ZADD', prios, 'NX', tonumber(redis.call('HGET', vtime, 'p')) or 0, prio)
+  end
+  redis.call('LPUSH', wake, 1)
+  redis.call('LTRIM', wake, 0, 63)
+end
+"""
+
+_ENQUEUE_LUA = FAIR_PUSH_LUA + """
+fair_push(KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], ARGV[1], ARGV[2], ARGV[3])
+"""
+
+# Pops up to ARGV[3] items. Tenants within a priority are served by stride
+# scheduling: the active tenant with the lowest pass goes next and its pass
+# grows by 1/weight. Priorities are taken strictly in order, or by the same
+# stride scheme over priority weights; in both modes a lower priority whose
+# next item waited aging_ms goes first.
+# KEYS: active priorities zset, virtual time hash, pre-priority list, then
+#       the tenants zset of each priority in ARGV order
+# ARGV: list key prefix, mode, count, now ms, aging ms, n priorities,
+#       n x (name, weight) highest first, then (tenant, weight) pairs
+# Returns a flat list of (task_id, tenant, priority, enqueued ms).
+# The per-tenant lists are only known from the tenants zsets, so their names
+# are built here; they carry the hash tag of the declared keys (see
+# RedisQueue), which keeps every key of a call in one slot.
+_DEQUEUE_LUA = """
+local lists, mode = ARGV[1], ARGV[2]
+local count, now, aging = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local np = tonumber(ARGV[6])
+local order, pweight, tweight, tkeys = {}, {}, {}, {}
+for i = 1, np do
+  order[i] = ARGV[5 + 2 * i]
+  pweight[order[i]] = tonumber(ARGV[6 + 2 * i])
+  tkeys[order[i]] = KEYS[3 + i]
+end
+for i = 7 + 2 * np, #ARGV, 2 do
+  tweight[ARGV[i]] = tonumber(ARGV[i + 1])
+end
+
+local out = {}
+local n = 0
+-- items queued before priorities existed drain first
+while n < count do
+  local id = redis.call('RPOP', KEYS[3])
+  if not id then break end
+  table.insert(out, id); table.insert(out, ''); table.insert(out, ''); table.insert(out, '0')
+  n = n + 1
+end
+
+local function pick()
+  local first, aged, aged_ts = nil, nil, nil
+  for i = 1, np do
+    local p = order[i]
+    local t = redis.call('ZRANGE', tkeys[p], 0, 0)[1]
+    if t then
+      if not first then
+        first = p
+      elseif aging > 0 then
+        local item = redis.call('LINDEX', lists .. p .. ':' .. t, -1)
+        local ts = item and tonumber(string.match(item, '^(%d+):'))
+        if ts and now - ts >= aging and (not aged_ts or ts < aged_ts) then
+          aged, aged_ts = p, ts
+        end
+      end
+    end
+  end
+  if aged then return aged end
+  if mode == 'weighted' and first then
+    return redis.call('ZRANGE', KEYS[1], 0, 0)[1] or first
+  end
+  return first
+end
+
+while n < count do
+  local p = pick()
+  if not p then break end
+  local tkey = tkeys[p]
+  local top = redis.call('ZRANGE', tkey, 0, 0, 'WITHSCORES')
+  local tenant, pass = top[1], tonumber(top[2])
+  local list = lists .. p .. ':' .. tenant
+  local item = redis.call('RPOP', list)
+  redis.call('HSET', KEYS[2], 't:' .. p, pass)
+  if redis.call('LLEN', list) == 0 then
+    redis.call('ZREM', tkey, tenant)
+  else
+    redis.call('ZADD', tkey, pass + 1 / (tweight[tenant] or 1), tenant)
+  end
+  local ppass = tonumber(redis.call('ZSCORE', KEYS[1], p)) or 0
+  redis.call('HSET', KEYS[2], 'p', ppass)
+  if redis.call('ZCARD', tkey) == 0 then
+    redis.call('ZREM', KEYS[1], p)
+  else
+    redis.call('ZADD', KEYS[1], ppass + 1 / (pweight[p] or 1), p)
+  end
+  if item then
+    local ts, id = string.match(item, '^(%d+):(.+)$')
+    table.insert(out, id or item); table.insert(out, tenant); table.insert(out, p); table.insert(out, ts or '0')
+    n = n + 1
+  end
+end
+return out
+"""
+
+
+def _s(v: Any) -> str:
+    return v.decode() if isinstance(v, (bytes, bytearray)) else str(v)
+
 
 class RedisQueue:
+    """
+    Task queue on Redis lists, one list per (priority, tenant):
+    - tenants within a priority get weighted fair shares
+      (settings.queue_tenant_weights, default weight 1)
+    - priorities are served strictly in order, or weighted
+      (settings.queue_priority_mode / queue_priority_weights)
+    - a task waiting settings.queue_aging_seconds is served ahead of
+      higher priorities, so low priority cannot starve
+    Scheduling runs in one Lua script per batch, so all workers share it.
+    Idle workers block on a wake-up list pushed by every enqueue.
+    Keys other than the pre-priority list are named "{<name>}:...": the hash
+    tag puts them in the slot of <name> itself, so the queue's own scripts
+    only touch one slot, per-tenant lists included. That does not make the
+    store Redis Cluster ready: RedisStore's create script enqueues in the
+    same call that writes task:<id> and idemp:<key>, in other slots.
+    """
+    kind = "list"
+
     def __init__(self, r: redis.Redis, name: str = "queue:tasks"):
         self.r = r
+        # Also the pre-priority FIFO, drained first after an upgrade
         self.name = name
+        # "{name}" hashes like name: one cluster slot for the whole queue
+        self.tag = f"{{{name}}}"
+        self.prios_key = f"{self.tag}:prios"
+        self.vtime_key = f"{self.tag}:vtime"
+        self.wake_key = f"{self.tag}:wake"
+        self._enqueue_script = r.register_script(_ENQUEUE_LUA)
+        self._dequeue_script = r.register_script(_DEQUEUE_LUA)
+        self._tenant_labels: set[str] = set()
+
+    def list_key(self, priority: str, tenant: str) -> str:
+        return f"{self.tag}:q:{priority}:{tenant}"
+
+    def tenants_key(self, priority: str) -> str:
+        return f"{self.tag}:tenants:{priority}"
+
+    def push_args(self, task_id: str, tenant: Optional[str] = None, priority: str = "normal") -> Tuple[List[str], List[Any]]:
+        """Keys and args of fair_push for one task, for scripts that enqueue."""
+        tenant = tenant or DEFAULT_TENANT
+        keys = [
+            self.list_key(priority, tenant), self.tenants_key(priority),
+            self.prios_key, self.vtime_key, self.wake_key,
+        ]
+        return keys, [f"{int(time.time() * 1000)}:{task_id}", tenant, priority]
+
+    async def enqueue(self, task_id: str, tenant: Optional[str] = None, priority: str = "normal") -> None:
+        keys, args = self.push_args(task_id, tenant, priority)
+        await self._enqueue_script(keys=keys, args=args)
+
+    def _tenant_label(self, tenant: str) -> str:
+        # Bounded label cardinality: tenants past the cap share one series
+        if tenant in self._tenant_labels:
+            return tenant
+        if len(self._tenant_labels) < settings.queue_metrics_max_tenants:
+            self._tenant_labels.add(tenant)
+            return tenant
+        return "other"
 
-    async def enqueue(self, task_id: str) -> None:
-        # LPUSH + BRPOP is a common pattern
-        await self.r.lpush(self.name, task_id)
+    async def _pop(self, max_items: int) -> List[str]:
+        args: List[Any] = [
+            f"{self.tag}:q:", settings.queue_priority_mode, max_items, int(time.time() * 1000),
+            int(settings.queue_aging_seconds * 1000), len(PRIORITIES),
+        ]
+        for p in PRIORITIES:
+            args += [p, settings.queue_priority_weights.get(p, 1)]
+        for tenant, w in settings.queue_tenant_weights.items():
+            args += [tenant, w]
+        keys = [self.prios_key, self.vtime_key, self.name] + [self.tenants_key(p) for p in PRIORITIES]
+        res = await self._dequeue_script(keys=keys, args=args)
+        now_ms = time.time() * 1000
+        out: List[str] = []
+        for i in range(0, len(res), 4):
+            task_id, tenant, prio, ts = _s(res[i]), _s(res[i + 1]), _s(res[i + 2]), int(res[i + 3])
+            out.append(task_id)
+            if ts:
+                metrics.observe(
+                    "queue_class_wait_seconds", max(0.0, (now_ms - ts) / 1000),
+                    priority=prio, tenant=self._tenant_label(tenant),
+                )
+        return out
 
-    async def dequeue_blocking(self, timeout_s:int = 0) -> str :
-        item = await self.r.brpop(self.name, timeout= timeout_s)
-        if item is None:
+    async def dequeue_blocking(self, timeout_s: int = 0) -> str:
+        items = await self.dequeue_batch(1, timeout_s)
+        if not items:
             raise TimeoutError("queue timeout")
-        _,data = item
-        return data.decode() if isinstance(data, (bytes, bytearray)) else str(data)
\ No newline at end of file
+        return items[0]
+
+    async def dequeue_batch(self, max_items: int, timeout_s: int = 0) -> List[str]:
+        """Pops up to max_items in scheduling order; [] on timeout."""
+        if max_items <= 0:
+            return []
+        deadline = time.monotonic() + timeout_s
+        while True:
+            items = await self._pop(max_items)
+            if items:
+                return items
+            # Wake-ups outnumber items (another worker may have taken them): wait out the rest
+            remaining = deadline - time.monotonic()
+            if timeout_s and remaining <= 0:
+                return []
+            if await self.r.brpop(self.wake_key, timeout=max(1, int(remaining)) if timeout_s else 0) is None:
+                return []
+
+    async def ack(self, task_id: str) -> None:
+        # The pop already removed the item; nothing to acknowledge
+        return None
+
+    async def stats(self) -> Dict[str, float]:
+        pipe = self.r.pipeline(transaction=False)
+        pipe.llen(self.name)
+        for p in PRIORITIES:
+            pipe.zrange(self.tenants_key(p), 0, -1)
+        legacy, *active = await pipe.execute()
+
+        lists = [(p, _s(t)) for p, tenants in zip(PRIORITIES, active) for t in tenants]
+        pipe = self.r.pipeline(transaction=False)
+        for p, t in lists:
+            pipe.llen(self.list_key(p, t))
+            pipe.lindex(self.list_key(p, t), -1)
+        replies = await pipe.execute() if lists else []
+
+        now_ms = time.time() * 1000
+        out: Dict[str, float] = {}
+        total = legacy
+        for p in PRIORITIES:
+            out[f'queue_priority_depth{{priority="{p}"}}'] = 0
+        for (p, t), depth, head in zip(lists, replies[::2], replies[1::2]):
+            label = f'priority="{p}",tenant="{self._tenant_label(t)}"'
+            out[f"queue_class_depth{{{label}}}"] = out.get(f"queue_class_depth{{{label}}}", 0) + depth
+            out[f'queue_priority_depth{{priority="{p}"}}'] += depth
+            total += depth
+            ts = int(_s(head).split(":", 1)[0]) if head else 0
+            if ts:
+                age = max(0.0, (now_ms - ts) / 1000)
+                key = f"queue_class_oldest_seconds{{{label}}}"
+                out[key] = max(out.get(key, 0.0), age)
+        out["queue_depth"] = total
+        return out
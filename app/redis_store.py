@@ -1,79 +1,272 @@
 from __future__ import annotations
-from typing import Optional, List
+from typing import Any, Dict, Optional, List, Tuple, Union
 from datetime import datetime
 import json
-
+import time
 import redis.asyncio as redis
 
+from .config import settings
 from .models import Task, StepRecord
+from .metrics import metrics
+from .redis_queue import FAIR_PUSH_LUA
+from .archive import FINISHED_KEY, TaskArchive
+from .tracing import tracer, KIND_CLIENT
+from . import codec, events
+
+# Idempotency reservation (SET NX) + task hash + optional enqueue, atomically.
+# KEYS: idemp key ("" when none), task key, then the queue's keys (none when not enqueueing)
+# ARGV: task_id, takeover id, queue kind ("list" | "stream" | ""), number of queue args,
+#       queue args..., hash field/value pairs...
+# Returns {1, task_id} when created, {0, existing_id} when the key already maps to a task.
+# The script reads no task by the mapped id: the caller does (the task may be archived), and
+# only when it is gone passes that id as the takeover id, to replace the mapping if unchanged.
+# Every key is passed in KEYS, but they span hash slots: this needs a single Redis, not Cluster.
+_CREATE_LUA = FAIR_PUSH_LUA + """
+if KEYS[1] ~= '' then
+  if not redis.call('SET', KEYS[1], ARGV[1], 'NX') then
+    local existing = redis.call('GET', KEYS[1])
+    if existing ~= ARGV[2] then
+      return {0, existing}
+    end
+    redis.call('SET', KEYS[1], ARGV[1])
+  end
+end
+local nq = tonumber(ARGV[4])
+redis.call('HSET', KEYS[2], unpack(ARGV, 5 + nq))
+if ARGV[3] == 'list' then
+  fair_push(KEYS[3], KEYS[4], KEYS[5], KEYS[6], KEYS[7], ARGV[5], ARGV[6], ARGV[7])
+elseif ARGV[3] == 'stream' then
+  redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[5], '*', 'task_id', ARGV[1])
+end
+return {1, ARGV[1]}
+"""
+
+# Claims up to ARGV[3] due members of KEYS[1] by pushing their score out to
+# ARGV[2] (the lease): a promoter that dies before re-enqueueing leaves them
+# to be claimed again once the lease runs out, instead of losing them.
+# ARGV: now, lease deadline, count
+_CLAIM_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+for _, id in ipairs(ids) do
+  redis.call('ZADD', KEYS[1], ARGV[2], id)
+end
+return ids
+"""
+
+# Removes ARGV[1] from KEYS[1], only while its score is still ARGV[2] when given:
+# the claim's lease, not a due time set by a later schedule_retry.
+_DROP_LUA = """
+if ARGV[2] ~= '' then
+  local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+  if not score or tonumber(score) ~= tonumber(ARGV[2]) then
+    return 0
+  end
+end
+return redis.call('ZREM', KEYS[1], ARGV[1])
+"""
+
+_TERMINAL = ("succeeded", "failed")
+
+metrics.set_buckets("task_stored_bytes", (1e3, 4e3, 16e3, 64e3, 256e3, 1e6, 4e6))
+
+def _decode(v: Any) -> str:
+    return v.decode() if isinstance(v, (bytes, bytearray)) else str(v)
 
 class RedisStore:
-    def __init__(self, r:redis.Redis):
+    def __init__(self, r:redis.Redis, archive: Optional[TaskArchive] = None):
         self.r = r
+        # Finished tasks moved out of Redis are read from here
+        self.archive = archive
+        self._create_script = r.register_script(_CREATE_LUA)
+        self._claim_script = r.register_script(_CLAIM_LUA)
+        self._drop_script = r.register_script(_DROP_LUA)
+        # op -> [calls, round_trips]
+        self._op_stats: Dict[str, List[int]] = {}
+
+    def _count(self, op: str, round_trips: int = 1) -> None:
+        s = self._op_stats.setdefault(op, [0, 0])
+        s[0] += 1
+        s[1] += round_trips
+
+    def _span(self, op: str, **attrs: Any) -> Any:
+        return tracer.span(f"redis.{op}", {"db.system": "redis", "db.operation": op, **attrs}, kind=KIND_CLIENT)
+
+    def stats(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for op, (calls, rts) in self._op_stats.items():
+            out[f'store_ops_total{{op="{op}"}}'] = calls
+            out[f'store_round_trips_total{{op="{op}"}}'] = rts
+        return out
 
     def _task_key(self, task_id: str) -> str:
         return f"task:{task_id}"
-    
+
     def _steps_key(self, task_id: str) -> str:
         return f"task:{task_id}:steps"
-    
+
     def _idemp_key(self, idempotency_key: str) -> str:
         return f"idemp:{idempotency_key}"
-    
-    async def create_or_get_task(self, task: Task) -> Task:
-        # Idempotency mapping (string -> task_id)
-        if task.idempotency_key:
-            existing_id = await self.r.get(self._idemp_key(task.idempotency_key))
-            if existing_id:
-                existing = await self.get_task(existing_id.decode())
-                if existing:
-                    return existing
-        
-        now = datetime.utcnow()
-        task.created_at = now
-        task.updated_at = now
-
-        await self.r.hset(
-            self._task_key(task_id),
-            mapping={
-                "task_id": task.task_id,
-                "goal": task.goal,
-                "status": task.status,
-                "created_at": task.created_at.isoformat(),
-                "updated_at": task.updated_at.isoformat(),
-                "idempotency_key": task.idempotency_key or "",
-                "result": task.result or "",
-                "error": task.error or "",
-            },
-        )
 
-        if task.idempotency_key:
-            await self.r.set(self._idemp_key(task.idempotency_key), task.task_id)
-
-        return task
-    
-    async def get_task(self, task_id: str) -> Optional[Task]:
-        data = await self.r.hgetall(self._task_key(task_id))
-        if not data:
-            return None
-        
-        d = {k.decode(): v.decode() for k,v in data.items()}
-        t = Task(
+    @staticmethod
+    def _task_from_hash(data: Dict[Any, Any], raw_steps: List[Any]) -> Task:
+        d = {_decode(k): _decode(v) for k,v in data.items()}
+        return Task(
             task_id=d["task_id"],
             goal=d["goal"],
             status=d["status"],
-            created_at=datetime.fromisoformat(d["created_at"])
-            updated_at=datetime.fromisoformat(d["updated_at"])
+            created_at=datetime.fromisoformat(d["created_at"]),
+            updated_at=datetime.fromisoformat(d["updated_at"]),
             idempotency_key=d["idempotency_key"] or None,
+            priority=d.get("priority") or "normal",
+            tenant=d.get("tenant") or None,
             result = d["result"] or None,
             error = d["error"] or None,
-            steps=[]
+            attempts={int(k): v for k, v in json.loads(d.get("attempts") or "{}").items()},
+            steps=codec.decode_steps(raw_steps),
         )
 
-        steps = await self.get_steps(task_id)
-        t.steps = steps
-        return t
-    
+    def _create_call(self, task: Task, queue: Any, takeover: str = "") -> Tuple[List[str], List[Any]]:
+        now = datetime.utcnow()
+        task.created_at = now
+        task.updated_at = now
+
+        mapping = {
+            "task_id": task.task_id,
+            "goal": task.goal,
+            "status": task.status,
+            "created_at": task.created_at.isoformat(),
+            "updated_at": task.updated_at.isoformat(),
+            "idempotency_key": task.idempotency_key or "",
+            "priority": task.priority,
+            "tenant": task.tenant or "",
+            "result": task.result or "",
+            "error": task.error or "",
+        }
+        qkeys, qargs = queue.push_args(task.task_id, task.tenant, task.priority) if queue is not None else ([], [])
+        args: List[Any] = [
+            task.task_id,
+            takeover,
+            getattr(queue, "kind", "") if queue is not None else "",
+            len(qargs),
+            *qargs,
+        ]
+        for k, v in mapping.items():
+            args += [k, v]
+        keys = [
+            self._idemp_key(task.idempotency_key) if task.idempotency_key else "",
+            self._task_key(task.task_id),
+            *qkeys,
+        ]
+        return keys, args
+
+    async def _existing(self, task: Task, existing: str, queue: Any, found: Optional[Task] = None) -> Tuple[Task, bool]:
+        """
+        The task an idempotency key maps to, from Redis or the archive (found,
+        when the caller read it already). If it is gone altogether (expired),
+        the key is taken over and task created, unless another create did so
+        first, in which case that one is returned.
+        """
+        for _ in range(3):
+            if found is None:
+                found = await self.get_task(existing)
+            if found is not None:
+                return found, False
+            keys, args = self._create_call(task, queue, takeover=existing)
+            res = await self._create_script(keys=keys, args=args)
+            self._count("create_or_get_task")
+            if int(res[0]) == 1:
+                return task, True
+            existing = _decode(res[1])
+        raise RuntimeError(f"idempotency key {task.idempotency_key!r} keeps changing tasks")
+
+    async def create_or_get_task(self, task: Task, queue: Any = None) -> Task:
+        """
+        Creates the task, or returns the one already mapped to its idempotency
+        key, archived ones included. With `queue`, a newly created task is
+        enqueued in the same script. One round trip to create; an existing
+        task is then read with get_task.
+        """
+        keys, args = self._create_call(task, queue)
+        res = await self._create_script(keys=keys, args=args)
+        self._count("create_or_get_task")
+        if int(res[0]) == 1:
+            return task
+        return (await self._existing(task, _decode(res[1]), queue))[0]
+
+    async def create_many(self, tasks: List[Task], queue: Any = None) -> List[Union[Tuple[Task, bool], Exception]]:
+        """
+        Bulk create_or_get_task: the same atomic script per task, pipelined in
+        chunks of settings.bulk_pipeline_chunk, then the existing tasks of the
+        keys that were taken in one get_tasks. Per task: (task, created) or
+        the exception for that task alone.
+        """
+        out: List[Union[Tuple[Task, bool], Exception]] = []
+        # index in out -> existing task id
+        hits: Dict[int, str] = {}
+        chunk = max(1, settings.bulk_pipeline_chunk)
+        for i in range(0, len(tasks), chunk):
+            part = tasks[i:i + chunk]
+            pipe = self.r.pipeline(transaction=False)
+            for t in part:
+                keys, args = self._create_call(t, queue)
+                await self._create_script(keys=keys, args=args, client=pipe)
+            replies = await pipe.execute(raise_on_error=False)
+            self._count("create_many")
+            for t, res in zip(part, replies):
+                if isinstance(res, Exception) or int(res[0]) == 1:
+                    out.append(res if isinstance(res, Exception) else (t, True))
+                else:
+                    hits[len(out)] = _decode(res[1])
+                    out.append((t, False))
+        if hits:
+            found = await self.get_tasks(list(hits.values()))
+            for (j, existing), t in zip(hits.items(), found):
+                try:
+                    out[j] = await self._existing(tasks[j], existing, queue, found=t)
+                except Exception as e:
+                    out[j] = e
+        return out
+
+    async def get_task(self, task_id: str) -> Optional[Task]:
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hgetall(self._task_key(task_id))
+        pipe.lrange(self._steps_key(task_id), 0, -1)
+        with self._span("get_task"):
+            data, raw_steps = await pipe.execute()
+        self._count("get_task")
+        if not data:
+            return await self.archive.get(task_id) if self.archive is not None else None
+        size = sum(len(k) + len(v) for k, v in data.items()) + sum(len(b) for b in raw_steps)
+        metrics.observe("task_stored_bytes", size)
+        return self._task_from_hash(data, raw_steps)
+
+    async def get_tasks(self, task_ids: List[str], include_steps: bool = True, fallback: bool = True) -> List[Optional[Task]]:
+        """Many get_task calls in one pipelined round trip per chunk; fallback=False skips the archive."""
+        out: List[Optional[Task]] = []
+        chunk = max(1, settings.bulk_pipeline_chunk)
+        for i in range(0, len(task_ids), chunk):
+            part = task_ids[i:i + chunk]
+            pipe = self.r.pipeline(transaction=False)
+            for tid in part:
+                pipe.hgetall(self._task_key(tid))
+                if include_steps:
+                    pipe.lrange(self._steps_key(tid), 0, -1)
+            replies = await pipe.execute()
+            self._count("get_tasks")
+            step = 2 if include_steps else 1
+            for j in range(len(part)):
+                data = replies[j * step]
+                raw_steps = replies[j * step + 1] if include_steps else []
+                out.append(self._task_from_hash(data, raw_steps) if data else None)
+        if fallback and self.archive is not None:
+            for i, t in enumerate(out):
+                if t is None:
+                    t = await self.archive.get(task_ids[i])
+                    if t is not None and not include_steps:
+                        t.steps = []
+                    out[i] = t
+        return out
+
     async def update_task_fields(
             self,
             task_id: str,
@@ -89,15 +282,128 @@ class RedisStore:
             mapping["result"] = result
         if error is not None:
             mapping["error"] = error
-        await self.r.hset(self._task_key(task_id), mapping=mapping)
-    
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hset(self._task_key(task_id), mapping=mapping)
+        if status in _TERMINAL:
+            extra = await self._finish(pipe, task_id)
+        else:
+            extra = 0
+        if settings.events_enabled and status is not None:
+            pipe.publish(events.channel(task_id), events.status_event(mapping))
+        with self._span("update_task_fields"):
+            await pipe.execute()
+        self._count("update_task_fields", 1 + extra)
+
     async def append_step(self, task_id: str, step: StepRecord) -> None:
-        await self.r.rpush(self._steps_key(task_id), step.model_dump_json())
+        pipe = self.r.pipeline(transaction=False)
+        pipe.rpush(self._steps_key(task_id), codec.encode_step(step))
+        if settings.events_enabled:
+            pipe.publish(events.channel(task_id), events.step_event(codec.step_json(step)))
+        with self._span("append_step"):
+            await pipe.execute()
+        self._count("append_step")
+
+    async def apply_batch(self, task_id: str, steps: List[StepRecord], fields: Dict[str, str]) -> None:
+        """Buffered steps then field updates, as one MULTI/EXEC round trip."""
+        pipe = self.r.pipeline(transaction=True)
+        extra = 0
+        if steps:
+            pipe.rpush(self._steps_key(task_id), *[codec.encode_step(s) for s in steps])
+        if fields:
+            pipe.hset(self._task_key(task_id), mapping=fields)
+            if fields.get("status") in _TERMINAL:
+                extra = await self._finish(pipe, task_id)
+        if settings.events_enabled:
+            # Published inside the transaction, so watchers never see a step before it is stored
+            for s in steps:
+                pipe.publish(events.channel(task_id), events.step_event(codec.step_json(s)))
+            if "status" in fields:
+                pipe.publish(events.channel(task_id), events.status_event(fields))
+        with self._span("apply_batch", steps=len(steps), fields=len(fields)):
+            await pipe.execute()
+        self._count("apply_batch", 1 + extra)
+
+    async def _finish(self, pipe: Any, task_id: str) -> int:
+        """
+        Retention for a task turning terminal, queued on pipe after its status
+        write. Returns the round trips it made itself: the idempotency key is
+        named in the task hash, and is read first so the EXPIRE goes to the
+        node that holds it (a script could only reach it by a built name).
+        """
+        extra = 0
+        if settings.task_ttl_seconds > 0:
+            pipe.expire(self._task_key(task_id), settings.task_ttl_seconds)
+            pipe.expire(self._steps_key(task_id), settings.task_ttl_seconds)
+        if settings.idempotency_ttl_seconds > 0:
+            key = await self.r.hget(self._task_key(task_id), "idempotency_key")
+            extra = 1
+            if key:
+                pipe.expire(self._idemp_key(_decode(key)), settings.idempotency_ttl_seconds)
+        if settings.archive_enabled:
+            pipe.zadd(FINISHED_KEY, {task_id: time.time()})
+        return extra
+
+    async def drop_archived(self, claimed: List[str], archived: List[str]) -> None:
+        """Deletes archived tasks from Redis and takes every claimed id off the finished set."""
+        pipe = self.r.pipeline(transaction=True)
+        for tid in archived:
+            pipe.delete(self._task_key(tid), self._steps_key(tid))
+        if claimed:
+            pipe.zrem(FINISHED_KEY, *claimed)
+        with self._span("drop_archived", tasks=len(archived)):
+            await pipe.execute()
+        self._count("drop_archived")
+
+    async def schedule_retry(
+            self,
+            task_id: str,
+            *,
+            delayed_key: str,
+            delay_s: float,
+            attempts: Dict[int, int],
+            error: str,
+    ) -> None:
+        """
+        Parks the task for a delayed retry: status back to queued, attempt
+        state stored, and due time added to delayed_key, in one MULTI/EXEC.
+        """
+        fields = {
+            "updated_at": datetime.utcnow().isoformat(),
+            "status": "queued",
+            "error": error,
+            "attempts": json.dumps(attempts, separators=(",", ":")),
+        }
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hset(self._task_key(task_id), mapping=fields)
+        pipe.zadd(delayed_key, {task_id: time.time() + delay_s})
+        if settings.events_enabled:
+            pipe.publish(events.channel(task_id), events.status_event(fields))
+        with self._span("schedule_retry"):
+            await pipe.execute()
+        self._count("schedule_retry")
+
+    async def claim_retries(self, delayed_key: str, now: float, lease_until: float, count: int) -> List[str]:
+        """Up to count task ids due by now, leased until lease_until (see _CLAIM_LUA)."""
+        with self._span("claim_retries"):
+            ids = await self._claim_script(keys=[delayed_key], args=[now, lease_until, count])
+        self._count("claim_retries")
+        return [_decode(i) for i in ids]
+
+    async def drop_retry(self, delayed_key: str, task_id: str, lease_until: Optional[float] = None) -> None:
+        """Removes task_id from delayed_key; with lease_until, only if it was not rescheduled since that claim."""
+        await self._drop_script(keys=[delayed_key], args=[task_id, "" if lease_until is None else lease_until])
+        self._count("drop_retry")
+
+    async def retry_counts(self, delayed_key: str, now: float) -> Tuple[int, int]:
+        """(waiting, due) delayed retries under delayed_key."""
+        pipe = self.r.pipeline(transaction=False)
+        pipe.zcard(delayed_key)
+        pipe.zcount(delayed_key, "-inf", now)
+        waiting, due = await pipe.execute()
+        return waiting, due
 
     async def get_steps(self, task_id: str) -> List[StepRecord]:
-        raw = await self.r.lrange(self._steps_key(task_id), 0, -1)
-        steps: List[StepRecord] = []
-        for b in raw:
-            steps.append(StepRecord(**json.loads(b.decode())))
-        return steps
-            
+        with self._span("get_steps"):
+            raw = await self.r.lrange(self._steps_key(task_id), 0, -1)
+        self._count("get_steps")
+        return codec.decode_steps(raw)
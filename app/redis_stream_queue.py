@@ -0,0 +1,153 @@
+from __future__ import annotations
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+from .config import settings
+
+log = logging.getLogger(__name__)
+
+
+def _s(v) -> str:
+    return v.decode() if isinstance(v, (bytes, bytearray)) else str(v)
+
+
+class RedisStreamQueue:
+    """
+    Consumer-group queue on a Redis Stream, same enqueue/dequeue_blocking
+    interface as RedisQueue plus ack().
+    - XREADGROUP pulls at most the requested batch; entries stay in the
+      group's pending list (PEL) until ack() after the terminal status write
+    - entries idle in another consumer's PEL for longer than claim_idle_ms
+      (crashed node) are taken over with XAUTOCLAIM. Each call scans only
+      part of the PEL, so the scan resumes where the last one stopped and
+      wraps to the start once Redis reports the end
+    claim_idle_ms must exceed the longest task run. Otherwise a live worker's
+    task can be claimed and run a second time, concurrently: Worker._execute
+    skips only tasks that are already succeeded or failed, and a task still
+    running has no heartbeat to tell it apart from one whose worker died.
+    Only a claim after the first run finished sees a terminal status and
+    just acks.
+    """
+    kind = "stream"
+
+    def __init__(
+            self,
+            r: redis.Redis,
+            name: Optional[str] = None,
+            group: Optional[str] = None,
+            consumer: Optional[str] = None,
+    ) -> None:
+        self.r = r
+        self.name = name or settings.stream_name
+        self.group = group or settings.stream_group
+        self.consumer = consumer or settings.stream_consumer
+        self.batch_size = settings.stream_batch_size
+        self.claim_idle_ms = settings.stream_claim_idle_ms
+        self.reclaim_interval_s = settings.stream_reclaim_interval_seconds
+        self.maxlen = settings.stream_maxlen
+        self._buffer: Deque[Tuple[str, str]] = deque()
+        self._msg_ids: Dict[str, List[str]] = {}
+        self._group_ready = False
+        self._next_reclaim = 0.0
+        # XAUTOCLAIM cursor: "0-0" starts over at the head of the PEL
+        self._reclaim_from = "0-0"
+        self.reclaimed_total = 0
+
+    async def _ensure_group(self) -> None:
+        if self._group_ready:
+            return
+        try:
+            await self.r.xgroup_create(self.name, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def push_args(self, task_id: str, tenant: Optional[str] = None, priority: str = "normal") -> Tuple[List[str], List[Any]]:
+        """Keys and args for scripts that enqueue; a stream has one FIFO order, so tenant and priority are ignored."""
+        return [self.name], [self.maxlen]
+
+    async def enqueue(self, task_id: str, tenant: Optional[str] = None, priority: str = "normal") -> None:
+        await self.r.xadd(self.name, {"task_id": task_id}, maxlen=self.maxlen, approximate=True)
+
+    def _buffer_entries(self, entries) -> int:
+        n = 0
+        for msg_id, fields in entries or []:
+            if not fields:
+                # trimmed away while pending; nothing left to run
+                continue
+            task_id = _s(fields.get(b"task_id", fields.get("task_id", b"")))
+            msg_id = _s(msg_id)
+            self._buffer.append((msg_id, task_id))
+            self._msg_ids.setdefault(task_id, []).append(msg_id)
+            n += 1
+        return n
+
+    async def _reclaim(self, count: int) -> None:
+        now = time.monotonic()
+        if now < self._next_reclaim:
+            return
+        self._next_reclaim = now + self.reclaim_interval_s
+        res = await self.r.xautoclaim(
+            self.name, self.group, self.consumer,
+            min_idle_time=self.claim_idle_ms, start_id=self._reclaim_from, count=count,
+        )
+        # [next_start, entries] on Redis 6.2, [next_start, entries, deleted_ids] on 7+
+        # A long PEL of live entries would otherwise hide stale ones behind them
+        self._reclaim_from = _s(res[0]) if res else "0-0"
+        n = self._buffer_entries(res[1] if res else [])
+        if n:
+            self.reclaimed_total += n
+            log.info("reclaimed %d pending task(s) from dead consumers", n)
+
+    async def dequeue_blocking(self, timeout_s: int = 0) -> str:
+        ids = await self.dequeue_batch(1, timeout_s)
+        if not ids:
+            raise TimeoutError("queue timeout")
+        return ids[0]
+
+    async def dequeue_batch(self, max_items: int, timeout_s: int = 0) -> List[str]:
+        if max_items <= 0:
+            return []
+        await self._ensure_group()
+        if not self._buffer:
+            await self._reclaim(min(max_items, self.batch_size))
+        if not self._buffer:
+            res = await self.r.xreadgroup(
+                self.group, self.consumer, {self.name: ">"},
+                count=min(max_items, self.batch_size), block=int(timeout_s * 1000) if timeout_s else 0,
+            )
+            for _, entries in res or []:
+                self._buffer_entries(entries)
+        out: List[str] = []
+        while self._buffer and len(out) < max_items:
+            out.append(self._buffer.popleft()[1])
+        return out
+
+    async def ack(self, task_id: str) -> None:
+        ids = self._msg_ids.pop(task_id, None)
+        if ids:
+            await self.r.xack(self.name, self.group, *ids)
+
+    async def stats(self) -> Dict[str, float]:
+        await self._ensure_group()
+        out: Dict[str, float] = {
+            "queue_stream_length": await self.r.xlen(self.name),
+            "queue_stream_buffered": len(self._buffer),
+            "queue_stream_reclaimed_total": self.reclaimed_total,
+        }
+        for g in await self.r.xinfo_groups(self.name):
+            g = {_s(k): v for k, v in g.items()}
+            if _s(g.get("name")) != self.group:
+                continue
+            out["queue_stream_pending"] = g.get("pending") or 0
+            out["queue_stream_consumers"] = g.get("consumers") or 0
+            if g.get("lag") is not None:
+                # lag is only reported by Redis >= 7
+                out["queue_stream_lag"] = g["lag"]
+        return out
@@ -0,0 +1,383 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+import redis.asyncio as redis
+
+from .config import settings
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# Token bucket per host, shared by every node. KEYS[1]: bucket hash;
+# ARGV: rate per second, burst, now in ms. Returns 0 when a token was taken,
+# else the ms to wait before one is available.
+_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+
+
+class CircuitOpenError(Exception):
+    """
+    Call refused because the host's circuit is open. Deliberately not a
+    ToolError: retrying against an open circuit only burns the step budget.
+    """
+    def __init__(self, host: str, retry_in: float) -> None:
+        super().__init__(f"circuit open for {host}, failing fast (next probe in {max(0.0, retry_in):.1f}s)")
+        self.host = host
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Per-host breaker over a tumbling window of calls:
+    - closed: opens once a window has failure_threshold failures making up
+      at least failure_ratio of its calls
+    - open: every call fails fast for circuit_open_seconds
+    - half-open: up to half_open_max_calls probes; a success closes the
+      circuit, a failure opens it again
+    """
+    def __init__(self, host: str) -> None:
+        self.host = host
+        # Calls admitted and not yet recorded; a breaker in use is never dropped
+        self.active = 0
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.window_start = time.monotonic()
+        self.calls = 0
+        self.failures = 0
+        self.probes = 0
+
+    def _roll(self, now: float) -> None:
+        if now - self.window_start >= settings.circuit_window_seconds:
+            self.window_start, self.calls, self.failures = now, 0, 0
+
+    def allow(self, now: float) -> bool:
+        if self.state == OPEN:
+            if now < self.open_until:
+                return False
+            self.state, self.probes = HALF_OPEN, 0
+        if self.state == HALF_OPEN:
+            if self.probes >= settings.circuit_half_open_max_calls:
+                return False
+            self.probes += 1
+        return True
+
+    def open(self, now: float, until: Optional[float] = None) -> None:
+        self.state = OPEN
+        self.open_until = until if until is not None else now + settings.circuit_open_seconds
+
+    def record(self, now: float, failed: bool) -> bool:
+        """Returns True when this result opened the circuit."""
+        if self.state == HALF_OPEN:
+            self.probes = max(0, self.probes - 1)
+            if failed:
+                self.open(now)
+                return True
+            self.state = CLOSED
+            self.window_start, self.calls, self.failures = now, 0, 0
+            return False
+        self._roll(now)
+        self.calls += 1
+        if failed:
+            self.failures += 1
+            if (
+                self.state == CLOSED
+                and self.failures >= settings.circuit_failure_threshold
+                and self.failures >= settings.circuit_failure_ratio * self.calls
+            ):
+                self.open(now)
+                return True
+        return False
+
+    def abandon(self) -> None:
+        """A call that ended without a verdict (e.g. cancelled) gives its probe slot back."""
+        if self.state == HALF_OPEN:
+            self.probes = max(0, self.probes - 1)
+
+    def idle(self, now: float) -> bool:
+        """Closed, unused and past its window: it holds nothing a new breaker would not."""
+        return self.state == CLOSED and self.active == 0 and now - self.window_start >= settings.circuit_window_seconds
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Takes a token; returns 0, or the seconds to wait until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.ts) * self.rate >= self.burst
+
+
+class RetryBudget:
+    """
+    Process-wide cap on retries: every attempt deposits ratio tokens, every
+    retry spends one, and min_per_second tokens trickle in regardless. When
+    a dependency fails wholesale, retries stop adding load after the budget
+    is spent instead of multiplying it by retry_max_attempts.
+    """
+    def __init__(self, ratio: Optional[float] = None, min_per_second: Optional[float] = None) -> None:
+        self.ratio = settings.retry_budget_ratio if ratio is None else ratio
+        self.min_per_second = settings.retry_budget_min_per_second if min_per_second is None else min_per_second
+        # Burst allowance: ten seconds of the floor rate
+        self.max_tokens = max(1.0, self.min_per_second * 10)
+        self.tokens = self.max_tokens
+        self.ts = time.monotonic()
+        self.spent = 0
+        self.denied = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.ts) * self.min_per_second)
+        self.ts = now
+
+    def deposit(self) -> None:
+        self._refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.spent += 1
+            return True
+        self.denied += 1
+        return False
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "retry_budget_tokens": self.tokens,
+            "retry_budget_spent_total": self.spent,
+            "retry_budget_denied_total": self.denied,
+        }
+
+
+class HostCall:
+    __slots__ = ("failed",)
+
+    def __init__(self) -> None:
+        # set for responses that count against the host without raising, e.g. 5xx
+        self.failed = False
+
+
+class HostGuard:
+    """
+    Circuit breaker and token bucket per host for outbound tool calls.
+    With r set (settings.circuit_shared), nodes share the state that makes
+    them back off together:
+    - an opened circuit is published as circuit:open:<host> (PX open time)
+      and seen by other nodes within circuit_sync_seconds
+    - half-open probes take circuit:probe:<host> (SET NX), so one node
+      probes for the whole fleet while the others keep failing fast
+    - the token bucket lives in Redis (ratelimit:<host>, one script call)
+    Redis errors fall back to the local state.
+    Hosts come from planned URLs, so per-host state is dropped once it holds
+    nothing (a closed breaker past its window, a full bucket), swept once per
+    circuit_window_seconds, and metric labels are capped.
+    """
+    def __init__(self, r: Optional[redis.Redis] = None) -> None:
+        self.r = r
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._synced: Dict[str, float] = {}
+        self._swept = time.monotonic()
+        self._host_labels: set[str] = set()
+        self._bucket_script = r.register_script(_BUCKET_LUA) if r is not None else None
+
+    @staticmethod
+    def host(url: str) -> str:
+        u = httpx.URL(url)
+        return f"{u.host}:{u.port or (443 if u.scheme == 'https' else 80)}"
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        b = self._breakers.get(host)
+        if b is None:
+            b = self._breakers[host] = CircuitBreaker(host)
+        return b
+
+    def _sweep(self, now: float) -> None:
+        if now - self._swept < settings.circuit_window_seconds:
+            return
+        self._swept = now
+        for host in [h for h, b in self._breakers.items() if b.idle(now)]:
+            del self._breakers[host]
+            self._synced.pop(host, None)
+        for host in [h for h, t in self._buckets.items() if t.full(now)]:
+            del self._buckets[host]
+
+    def _host_label(self, host: str) -> str:
+        # Bounded label cardinality: hosts past the cap share one series
+        if host in self._host_labels:
+            return host
+        if len(self._host_labels) < settings.circuit_metrics_max_hosts:
+            self._host_labels.add(host)
+            return host
+        return "other"
+
+    async def _sync_open(self, b: CircuitBreaker, now: float) -> None:
+        if self.r is None or now - self._synced.get(b.host, 0.0) < settings.circuit_sync_seconds:
+            return
+        self._synced[b.host] = now
+        try:
+            pttl = await self.r.pttl(f"circuit:open:{b.host}")
+        except Exception as e:
+            log.warning("circuit state read failed for %s: %s", b.host, e)
+            return
+        if pttl and pttl > 0 and b.state == CLOSED:
+            b.open(now, now + pttl / 1000)
+
+    async def _publish_open(self, b: CircuitBreaker) -> None:
+        if self.r is None:
+            return
+        try:
+            await self.r.set(f"circuit:open:{b.host}", "1", px=max(1, int(settings.circuit_open_seconds * 1000)))
+        except Exception as e:
+            log.warning("circuit state write failed for %s: %s", b.host, e)
+
+    async def _claim_probe(self, b: CircuitBreaker) -> bool:
+        if self.r is None:
+            return True
+        try:
+            return bool(await self.r.set(
+                f"circuit:probe:{b.host}", "1", nx=True, px=max(1, int(settings.step_timeout_seconds * 1000))
+            ))
+        except Exception as e:
+            log.warning("circuit probe claim failed for %s: %s", b.host, e)
+            return True
+
+    async def _release_probe(self, b: CircuitBreaker, closed: bool) -> None:
+        if self.r is None:
+            return
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.delete(f"circuit:probe:{b.host}")
+            if closed:
+                pipe.delete(f"circuit:open:{b.host}")
+            await pipe.execute()
+        except Exception as e:
+            log.warning("circuit probe release failed for %s: %s", b.host, e)
+
+    async def _throttle(self, host: str) -> None:
+        rate, burst = settings.host_rate_limit_per_second, settings.host_rate_limit_burst
+        if rate <= 0:
+            return
+        while True:
+            wait = None
+            if self._bucket_script is not None:
+                try:
+                    wait = int(await self._bucket_script(
+                        keys=[f"ratelimit:{host}"], args=[rate, burst, int(time.time() * 1000)]
+                    )) / 1000
+                except Exception as e:
+                    log.warning("shared rate limit failed for %s: %s", host, e)
+            if wait is None:
+                bucket = self._buckets.get(host)
+                if bucket is None:
+                    bucket = self._buckets[host] = TokenBucket(rate, burst)
+                wait = bucket.take(time.monotonic())
+            if wait <= 0:
+                return
+            metrics.inc("host_rate_limited_total", host=self._host_label(host))
+            await asyncio.sleep(wait)
+
+    @asynccontextmanager
+    async def call(self, url: str) -> AsyncIterator[HostCall]:
+        """Admits one request to url's host; raises CircuitOpenError instead when the circuit is open."""
+        host = self.host(url)
+        now = time.monotonic()
+        self._sweep(now)
+        b = self.breaker(host)
+        # Held from here, so a sweep during the awaits below cannot drop it
+        b.active += 1
+        try:
+            await self._sync_open(b, now)
+            probe_due = b.state != CLOSED and now >= b.open_until
+            allowed = b.allow(now)
+            if allowed and probe_due and not await self._claim_probe(b):
+                # Another node holds the probe for this host
+                b.abandon()
+                allowed = False
+            if not allowed:
+                metrics.inc("circuit_rejected_total", host=self._host_label(host))
+                retry_in = b.open_until - now if b.state == OPEN else settings.circuit_sync_seconds
+                raise CircuitOpenError(host, retry_in)
+            probing = b.state == HALF_OPEN
+            try:
+                await self._throttle(host)
+            except BaseException:
+                # Cancelled while waiting for the rate limit: the host was never asked, give the probe back
+                b.abandon()
+                if probing:
+                    await asyncio.shield(self._release_probe(b, closed=False))
+                raise
+        except BaseException:
+            b.active -= 1
+            raise
+
+        call = HostCall()
+        cancelled = False
+        try:
+            yield call
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            b.active -= 1
+            if cancelled:
+                # No verdict on the host; give the probe back
+                b.abandon()
+                if probing:
+                    await asyncio.shield(self._release_probe(b, closed=False))
+            else:
+                if b.record(time.monotonic(), call.failed):
+                    log.warning("circuit opened for %s", host)
+                    metrics.inc("circuit_opened_total", host=self._host_label(host))
+                    await self._publish_open(b)
+                if probing:
+                    await self._release_probe(b, closed=b.state == CLOSED)
+
+    def stats(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for host, b in self._breakers.items():
+            label = self._host_label(host)
+            # host="other" counts the hosts past the label cap in that state
+            for name, state in (("circuit_open", OPEN), ("circuit_half_open", HALF_OPEN)):
+                key = f'{name}{{host="{label}"}}'
+                out[key] = out.get(key, 0) + (1 if b.state == state else 0)
+        out["circuit_tracked_hosts"] = len(self._breakers)
+        return out
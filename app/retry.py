@@ -3,11 +3,25 @@ import asyncio
 import random
 from typing import Callable, Awaitable, TypeVar, Optional
 
+from .tracing import tracer
+
 T = TypeVar("T")
 
 class RetryError(Exception):
     pass
 
+class RetryLater(Exception):
+    """
+    Raised instead of sleeping through a long backoff: the caller reschedules
+    attempt `attempt + 1` after `delay` seconds, away from whatever it holds.
+    `step_no` is filled in by whoever knows which step it is (the worker).
+    """
+    def __init__(self, attempt: int, delay: float, cause: Exception, step_no: Optional[int] = None) -> None:
+        super().__init__(str(cause))
+        self.attempt = attempt
+        self.delay = delay
+        self.step_no = step_no
+
 async def retry_async(
         fn: Callable[[], Awaitable[T]],
         *,
@@ -16,16 +30,28 @@ async def retry_async(
         max_delay: float,
         jitter: float,
         retry_on: tuple[type[Exception], ...] = (Exception,),
+        on_retry: Optional[Callable[[int, Exception], None]] = None,
+        allow_retry: Optional[Callable[[], bool]] = None,
+        first_attempt: int = 1,
+        defer_after: Optional[float] = None,
 ) -> T:
     last_exc: Optional[Exception] = None
-    for i in range(1 , attempts+1) :
+    for i in range(first_attempt , attempts+1) :
         try:
-            return await fn()
+            with tracer.span("attempt", {"retry.attempt": i}):
+                return await fn()
         except retry_on as e:
             last_exc = e
             if i == attempts:
                 break
+            if allow_retry is not None and not allow_retry():
+                raise RetryError(f"{e} (retry budget exhausted)") from e
+            if on_retry is not None:
+                on_retry(i, e)
             delay = min(max_delay, base_delay * ( 2 ** (i - 1)))
             delay = max(0.0, delay + random.uniform(0.0, jitter))
-            await asyncio.sleep(delay)
-        raise RetryError(str(last_exc) if last_exc else "retry failed")
\ No newline at end of file
+            if defer_after is not None and delay >= defer_after:
+                raise RetryLater(i, delay, e) from e
+            with tracer.span("retry.backoff", {"retry.attempt": i, "retry.delay_s": delay}):
+                await asyncio.sleep(delay)
+    raise RetryError(str(last_exc) if last_exc else "retry failed")
@@ -0,0 +1,82 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Protocol, Tuple, Union
+
+from .events import Subscription
+from .models import StepRecord, Task
+
+# What Worker, api and main need from a backend. Two implementations:
+# - "redis": RedisStore + RedisQueue / RedisStreamQueue + TaskEventHub
+# - "memory": InMemoryStore + InMemoryQueue + LocalEventHub, one process only
+# bench/conformance.py runs the same checks against both.
+
+class TaskQueue(Protocol):
+    # "list" | "stream" | "memory"; RedisStore enqueues list and stream kinds in its create script
+    kind: str
+
+    async def enqueue(self, task_id: str, tenant: Optional[str] = None, priority: str = "normal") -> None: ...
+
+    async def dequeue_blocking(self, timeout_s: int = 0) -> str: ...
+
+    async def dequeue_batch(self, max_items: int, timeout_s: int = 0) -> List[str]: ...
+
+    async def ack(self, task_id: str) -> None: ...
+
+    async def stats(self) -> Dict[str, float]: ...
+
+
+class TaskStore(Protocol):
+    async def create_or_get_task(self, task: Task, queue: Optional[TaskQueue] = None) -> Task: ...
+
+    async def create_many(
+            self, tasks: List[Task], queue: Optional[TaskQueue] = None,
+    ) -> List[Union[Tuple[Task, bool], Exception]]: ...
+
+    async def get_task(self, task_id: str) -> Optional[Task]: ...
+
+    async def get_tasks(
+            self, task_ids: List[str], include_steps: bool = True, fallback: bool = True,
+    ) -> List[Optional[Task]]: ...
+
+    # Steps come back in step_no order, whatever order they were appended in
+    async def get_steps(self, task_id: str) -> List[StepRecord]: ...
+
+    async def update_task_fields(
+            self,
+            task_id: str,
+            *,
+            status: Optional[str] = None,
+            result: Optional[str] = None,
+            error: Optional[str] = None,
+    ) -> None: ...
+
+    async def append_step(self, task_id: str, step: StepRecord) -> None: ...
+
+    async def apply_batch(self, task_id: str, steps: List[StepRecord], fields: Dict[str, str]) -> None: ...
+
+    # Delayed retries (see DelayedRetryScheduler): a set of task ids scored by due time per key
+    async def schedule_retry(
+            self,
+            task_id: str,
+            *,
+            delayed_key: str,
+            delay_s: float,
+            attempts: Dict[int, int],
+            error: str,
+    ) -> None: ...
+
+    async def claim_retries(self, delayed_key: str, now: float, lease_until: float, count: int) -> List[str]: ...
+
+    # With lease_until, only while the entry is still that claim's (not rescheduled since)
+    async def drop_retry(self, delayed_key: str, task_id: str, lease_until: Optional[float] = None) -> None: ...
+
+    async def retry_counts(self, delayed_key: str, now: float) -> Tuple[int, int]: ...
+
+    def stats(self) -> Dict[str, float]: ...
+
+
+class EventHub(Protocol):
+    async def subscribe(self, task_id: str) -> Subscription: ...
+
+    async def unsubscribe(self, sub: Subscription) -> None: ...
+
+    async def aclose(self) -> None: ...
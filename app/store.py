@@ -1,38 +1,293 @@
+from __future__ import annotations
+import heapq
+import threading
+import time
 from datetime import datetime
-import asyncio
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple, Union
+
+from .config import settings
+from .events import LocalEventHub
+from .models import StepRecord, Task
+from .storage import TaskQueue
+from . import codec, events
+
+_TERMINAL = ("succeeded", "failed")
+
+
+class _Shard:
+    __slots__ = ("lock", "tasks", "steps", "expiry")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # Stored without steps; those live in steps[task_id]
+        self.tasks: Dict[str, Task] = {}
+        self.steps: Dict[str, List[StepRecord]] = {}
+        # (monotonic deadline, task_id) of finished tasks under a TTL
+        self.expiry: List[Tuple[float, str]] = []
+
+
+class _KeyShard:
+    __slots__ = ("lock", "keys", "expiry")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # idempotency_key -> (task_id, monotonic deadline)
+        self.keys: Dict[str, Tuple[str, float]] = {}
+        # (monotonic deadline, key) of keys whose task finished
+        self.expiry: List[Tuple[float, str]] = []
 
-from .models import Task
 
 class InMemoryStore:
     """
-    Simple store:
-    - task: task_id -> Task
-    - idempotency: idempotency_key -> task_id
+    The TaskStore protocol in process memory, for single-node deployments
+    and benchmarks without Redis:
+    - tasks and idempotency keys in settings.memory_store_shards shards by
+      key hash, each under its own lock, held only for dict operations
+      (never across an await), so it is also safe from threads
+    - Task and StepRecord objects are kept as they are: a read is a shallow
+      copy, nothing is serialized or parsed. Returned steps are shared with
+      the store; treat them as read-only
+    - task_ttl_seconds / idempotency_ttl_seconds apply once a task is
+      terminal, as with RedisStore; expired tasks and keys are dropped
+      lazily, and every create also sweeps the next shard in turn
+    - events go to a LocalEventHub, encoded only while the task is watched
+    Nothing survives a restart, and the archive is not supported.
     """
-    def __init__(self) -> None:
-        self._lock = asyncio.Lock()
-        self._tasks: Dict[str, Task] = {}
-        self._idemp: Dict[str, str] = {}
-    
-    async def create_or_get_task(self, task:Task) -> Task:
-        async with self._lock:
-            if task.idempotency_key:
-                existing_id = self._idemp.get(task.idempotency_key)
-                if existing_id and existing_id in self._tasks:
-                    return self._tasks[existing_id]
-                
-            self._tasks[task.task_id] = task
-            if task.idempotency_key:
-                self._idemp[task.idempotency_key] = task.task_id
-            return task
-    
+    def __init__(self, hub: Optional[LocalEventHub] = None, shards: Optional[int] = None) -> None:
+        self.hub = hub
+        n = max(1, shards or settings.memory_store_shards)
+        self._shards = [_Shard() for _ in range(n)]
+        self._key_shards = [_KeyShard() for _ in range(n)]
+        self._retry_lock = threading.Lock()
+        # delayed_key -> {task_id: due time (epoch seconds)}
+        self._retries: Dict[str, Dict[str, float]] = {}
+        self._op_stats: Dict[str, int] = {}
+        # Next shard _sweep() purges, so shards no call touches still drop expired entries
+        self._next_sweep = 0
+
+    def _shard(self, task_id: str) -> _Shard:
+        return self._shards[hash(task_id) % len(self._shards)]
+
+    def _key_shard(self, key: str) -> _KeyShard:
+        return self._key_shards[hash(key) % len(self._key_shards)]
+
+    def _count(self, op: str) -> None:
+        self._op_stats[op] = self._op_stats.get(op, 0) + 1
+
+    def stats(self) -> Dict[str, float]:
+        out: Dict[str, float] = {f'store_ops_total{{op="{op}"}}': n for op, n in self._op_stats.items()}
+        out["memory_store_tasks"] = sum(len(s.tasks) for s in self._shards)
+        out["memory_store_idempotency_keys"] = sum(len(ks.keys) for ks in self._key_shards)
+        return out
+
+    @staticmethod
+    def _purge(shard: _Shard, now: float) -> None:
+        # Caller holds shard.lock
+        while shard.expiry and shard.expiry[0][0] <= now:
+            _, task_id = heapq.heappop(shard.expiry)
+            shard.tasks.pop(task_id, None)
+            shard.steps.pop(task_id, None)
+
+    @staticmethod
+    def _purge_keys(ks: _KeyShard, now: float) -> None:
+        # Caller holds ks.lock. A key taken over since its deadline was pushed has a new one; it stays
+        while ks.expiry and ks.expiry[0][0] <= now:
+            _, key = heapq.heappop(ks.expiry)
+            hit = ks.keys.get(key)
+            if hit is not None and hit[1] <= now:
+                del ks.keys[key]
+
+    def _sweep(self) -> None:
+        i = self._next_sweep = (self._next_sweep + 1) % len(self._shards)
+        now = time.monotonic()
+        shard, ks = self._shards[i], self._key_shards[i]
+        if shard.expiry and shard.expiry[0][0] <= now:
+            with shard.lock:
+                self._purge(shard, now)
+        if ks.expiry and ks.expiry[0][0] <= now:
+            with ks.lock:
+                self._purge_keys(ks, now)
+
+    def _read(self, task_id: str, include_steps: bool = True) -> Optional[Task]:
+        shard = self._shard(task_id)
+        with shard.lock:
+            self._purge(shard, time.monotonic())
+            t = shard.tasks.get(task_id)
+            if t is None:
+                return None
+            steps = list(shard.steps.get(task_id, ())) if include_steps else []
+        return t.model_copy(update={"steps": steps})
+
+    def _create(self, task: Task) -> Tuple[Task, bool]:
+        self._sweep()
+        now = datetime.utcnow()
+        task.created_at = now
+        task.updated_at = now
+        stored = task.model_copy(update={"steps": []})
+        shard = self._shard(task.task_id)
+        if not task.idempotency_key:
+            with shard.lock:
+                shard.tasks[task.task_id] = stored
+                shard.steps[task.task_id] = list(task.steps)
+            return task, True
+        ks = self._key_shard(task.idempotency_key)
+        # Key shard first, then task shards: the only place two locks are held
+        with ks.lock:
+            now = time.monotonic()
+            self._purge_keys(ks, now)
+            hit = ks.keys.get(task.idempotency_key)
+            if hit is not None and hit[1] > now:
+                existing = self._read(hit[0])
+                if existing is not None:
+                    return existing, False
+            # No mapping, or it points at a task that no longer exists: take it over
+            ks.keys[task.idempotency_key] = (task.task_id, float("inf"))
+            with shard.lock:
+                shard.tasks[task.task_id] = stored
+                shard.steps[task.task_id] = list(task.steps)
+        return task, True
+
+    async def create_or_get_task(self, task: Task, queue: Optional[TaskQueue] = None) -> Task:
+        """Creates the task, or returns the one already mapped to its idempotency key; enqueues a new one on queue."""
+        t, created = self._create(task)
+        self._count("create_or_get_task")
+        if created and queue is not None:
+            await queue.enqueue(t.task_id, t.tenant, t.priority)
+        return t
+
+    async def create_many(self, tasks: List[Task], queue: Optional[TaskQueue] = None) -> List[Union[Tuple[Task, bool], Exception]]:
+        out: List[Union[Tuple[Task, bool], Exception]] = []
+        for task in tasks:
+            try:
+                t, created = self._create(task)
+                if created and queue is not None:
+                    await queue.enqueue(t.task_id, t.tenant, t.priority)
+                out.append((t, created))
+            except Exception as e:
+                out.append(e)
+        self._count("create_many")
+        return out
+
     async def get_task(self, task_id: str) -> Optional[Task]:
-        async with self._lock:
-            t = self._tasks.get(task_id)
-            return t
-        
-    async def update_task(self, task: Task) -> None:
-        async with self._lock:
-            task.updated_at = datetime.utcnow()
-            self._tasks[task.task_id] = task
+        self._count("get_task")
+        return self._read(task_id)
+
+    async def get_tasks(self, task_ids: List[str], include_steps: bool = True, fallback: bool = True) -> List[Optional[Task]]:
+        # fallback is for RedisStore's archive; there is none here
+        self._count("get_tasks")
+        return [self._read(tid, include_steps) for tid in task_ids]
+
+    async def get_steps(self, task_id: str) -> List[StepRecord]:
+        self._count("get_steps")
+        shard = self._shard(task_id)
+        with shard.lock:
+            return list(shard.steps.get(task_id, ()))
+
+    def _apply(self, task_id: str, steps: List[StepRecord], fields: Dict[str, str]) -> None:
+        """Appends steps and sets fields (RedisStore hash encoding) in one critical section, then publishes."""
+        shard = self._shard(task_id)
+        terminal = fields.get("status") in _TERMINAL
+        with shard.lock:
+            if steps:
+                # Like RPUSH, steps of an unknown task still get a list
+                stored = shard.steps.setdefault(task_id, [])
+                stored.extend(steps)
+                if len(stored) > len(steps) and stored[-len(steps) - 1].step_no > steps[0].step_no:
+                    # A step re-run after a delayed retry: keep step_no order, as RedisStore reads it
+                    stored.sort(key=codec.step_no)
+            t = shard.tasks.get(task_id)
+            if t is not None and fields:
+                for k, v in fields.items():
+                    if k == "updated_at":
+                        t.updated_at = datetime.fromisoformat(v)
+                    elif k in ("result", "error"):
+                        setattr(t, k, v or None)
+                    else:
+                        setattr(t, k, v)
+                if terminal and settings.task_ttl_seconds > 0:
+                    heapq.heappush(shard.expiry, (time.monotonic() + settings.task_ttl_seconds, task_id))
+        if terminal and t is not None and t.idempotency_key and settings.idempotency_ttl_seconds > 0:
+            ks = self._key_shard(t.idempotency_key)
+            with ks.lock:
+                now = time.monotonic()
+                self._purge_keys(ks, now)
+                hit = ks.keys.get(t.idempotency_key)
+                if hit is not None and hit[0] == task_id:
+                    deadline = now + settings.idempotency_ttl_seconds
+                    ks.keys[t.idempotency_key] = (task_id, deadline)
+                    heapq.heappush(ks.expiry, (deadline, t.idempotency_key))
+        if settings.events_enabled and self.hub is not None and self.hub.watching(task_id):
+            for s in steps:
+                self.hub.publish(task_id, events.step_event(codec.step_json(s)))
+            if "status" in fields:
+                self.hub.publish(task_id, events.status_event(fields))
+
+    async def update_task_fields(
+            self,
+            task_id: str,
+            *,
+            status: Optional[str] = None,
+            result: Optional[str] = None,
+            error: Optional[str] = None,
+    ) -> None:
+        fields = {"updated_at": datetime.utcnow().isoformat()}
+        if status is not None:
+            fields["status"] = status
+        if result is not None:
+            fields["result"] = result
+        if error is not None:
+            fields["error"] = error
+        self._apply(task_id, [], fields)
+        self._count("update_task_fields")
+
+    async def append_step(self, task_id: str, step: StepRecord) -> None:
+        self._apply(task_id, [step], {})
+        self._count("append_step")
+
+    async def apply_batch(self, task_id: str, steps: List[StepRecord], fields: Dict[str, str]) -> None:
+        self._apply(task_id, steps, fields)
+        self._count("apply_batch")
+
+    async def schedule_retry(
+            self,
+            task_id: str,
+            *,
+            delayed_key: str,
+            delay_s: float,
+            attempts: Dict[int, int],
+            error: str,
+    ) -> None:
+        shard = self._shard(task_id)
+        with shard.lock:
+            t = shard.tasks.get(task_id)
+            if t is not None:
+                t.updated_at = datetime.utcnow()
+                t.status = "queued"
+                t.error = error or None
+                t.attempts = dict(attempts)
+        with self._retry_lock:
+            self._retries.setdefault(delayed_key, {})[task_id] = time.time() + delay_s
+        if settings.events_enabled and self.hub is not None and self.hub.watching(task_id):
+            self.hub.publish(task_id, events.status_event({"status": "queued", "error": error}))
+        self._count("schedule_retry")
+
+    async def claim_retries(self, delayed_key: str, now: float, lease_until: float, count: int) -> List[str]:
+        with self._retry_lock:
+            due = self._retries.get(delayed_key, {})
+            ids = [tid for _, tid in heapq.nsmallest(count, ((s, tid) for tid, s in due.items() if s <= now))]
+            for tid in ids:
+                due[tid] = lease_until
+        self._count("claim_retries")
+        return ids
+
+    async def drop_retry(self, delayed_key: str, task_id: str, lease_until: Optional[float] = None) -> None:
+        with self._retry_lock:
+            due = self._retries.get(delayed_key, {})
+            if lease_until is None or due.get(task_id) == lease_until:
+                due.pop(task_id, None)
+        self._count("drop_retry")
+
+    async def retry_counts(self, delayed_key: str, now: float) -> Tuple[int, int]:
+        with self._retry_lock:
+            due = self._retries.get(delayed_key, {})
+            return len(due), sum(1 for s in due.values() if s <= now)
@@ -1,41 +1,117 @@
 from __future__ import annotations
-import ast
+import codecs
+import contextlib
 import httpx
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
+
+from . import calc_eval
+from .http_cache import HttpResponseCache
+from .http_pool import HttpClientPool
+from .config import settings
+from .metrics import metrics
+from .resilience import CircuitOpenError, HostGuard
+from .tracing import tracer, KIND_CLIENT
 
 class ToolError(Exception):
     pass
 
-async def http_get(url: str, timeout_s: float = 6.0) -> Dict[str, Any]:
+class ToolLimitError(Exception):
+    """
+    Input rejected by a tool limit. Deliberately not a ToolError: the same
+    input fails the same way, so it is not retried.
+    """
+
+class ToolInputError(Exception):
+    """
+    Input the tool can never accept, such as an invalid calc expression or a
+    division by zero. Not a ToolError either, for the same reason.
+    """
+
+_TEXT_CHARS = 4000
+
+async def _read_capped(resp: httpx.Response, cap: int) -> Tuple[bytes, bool]:
+    """At most cap bytes of the (content-decoded) body, and whether more was left unread."""
+    buf = bytearray()
+    async for chunk in resp.aiter_bytes():
+        buf += chunk
+        if len(buf) > cap:
+            return bytes(buf[:cap]), True
+    return bytes(buf), False
+
+def _decode(resp: httpx.Response, body: bytes, truncated: bool) -> str:
     try:
-        async with httpx.AsyncClient(timeout=timeout_s, follow_max_redirects=True) as client:
-            resp = await client.get(url)
-            return {
-                "status_code": resp.status_code,
-                "header": dict(resp.headers),
-                "text": resp.text[:4000],
-            }
-    except Exception as e:
-        raise ToolError(f"http_get failed: {e}") from e
+        decoder = codecs.getincrementaldecoder(resp.charset_encoding or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    # final=False drops a multi-byte character cut in half by the cap
+    return decoder.decode(body, final=not truncated)
 
-_ALLOWED_NODES = {
-    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd, ast.Load
-}
+def _headers(resp: httpx.Response) -> Dict[str, str]:
+    allow = settings.http_header_allowlist
+    if allow == ["*"]:
+        return dict(resp.headers)
+    return {k: resp.headers[k] for k in allow if k in resp.headers}
 
-def _validate_expr(node: ast.AST) -> None :
-    for n in ast.walk(node):
-        if type(n) not in _ALLOWED_NODES:
-            raise ToolError(f"calc: disallowed syntax: {type(n).__name__}")
-        
-async def calc(expr: str ) -> Dict[str, Any]:
+async def _fetch(
+        url: str,
+        timeout_s: float,
+        pool: Optional[HttpClientPool],
+        headers: Optional[Dict[str, str]] = None,
+        guard: Optional[HostGuard] = None,
+) -> Tuple[httpx.Response, Dict[str, Any]]:
+    cap = settings.http_max_body_bytes
+    with tracer.span("tool.http_get", {"http.method": "GET", "http.url": url, "http.conditional": bool(headers)}, kind=KIND_CLIENT) as sp:
+        async with contextlib.AsyncExitStack() as stack:
+            call = await stack.enter_async_context(guard.call(url)) if guard is not None else None
+            if pool is not None:
+                resp = await stack.enter_async_context(pool.stream(url, timeout=timeout_s, headers=headers))
+            else:
+                client = await stack.enter_async_context(httpx.AsyncClient(timeout=timeout_s, follow_redirects=True))
+                resp = await stack.enter_async_context(client.stream("GET", url, headers=headers))
+            body, truncated = await _read_capped(resp, cap)
+            if call is not None:
+                call.failed = resp.status_code >= 500
+        # Leaving the stack closed the response: an unfinished body drops its connection instead of leaking it
+        text = _decode(resp, body, truncated)
+        if truncated:
+            metrics.inc("http_get_truncated_total")
+        sp.set(**{"http.status_code": resp.status_code, "http.bytes_read": len(body), "http.truncated": truncated})
+    return resp, {
+        "status_code": resp.status_code,
+        "header": _headers(resp),
+        "text": text[:_TEXT_CHARS],
+        "truncated": truncated or len(text) > _TEXT_CHARS,
+        "bytes_read": len(body),
+    }
+
+async def http_get(
+        url: str,
+        timeout_s: float = 6.0,
+        pool: Optional[HttpClientPool] = None,
+        cache: Optional[HttpResponseCache] = None,
+        guard: Optional[HostGuard] = None,
+) -> Dict[str, Any]:
     try:
-        parsed = ast.parse(expr, mode = "eval")
-        _validate_expr(parsed)
-        val = eval(compile(parsed, "<calc>", "eval"), {"__builtins__":{}},{})
-        if not isinstance(val, (int, float)):
-            raise ToolError("calc: expression did not produce a number")
-        return {"value": float(val)}
-    except ToolError:
+        if cache is not None:
+            return await cache.get(url, lambda headers: _fetch(url, timeout_s, pool, headers, guard))
+        _, out = await _fetch(url, timeout_s, pool, guard=guard)
+        return out
+    except CircuitOpenError:
         raise
     except Exception as e:
-        raise ToolError(f"Calc failed : {e}") from e
\ No newline at end of file
+        raise ToolError(f"http_get failed: {e}") from e
+
+async def calc(expr: str ) -> Dict[str, Any]:
+    try:
+        with tracer.span("tool.calc", {"calc.expr_len": len(expr)}) as sp:
+            out = await calc_eval.engine.evaluate(expr)
+            sp.set(**{"calc.offloaded": out["offloaded"]})
+        return {"value": float(out["value"])}
+    except calc_eval.CalcLimitError as e:
+        raise ToolLimitError(f"calc: {e}") from e
+    except calc_eval.CalcUnavailable as e:
+        raise ToolError(f"calc: {e}") from e
+    except calc_eval.CalcError as e:
+        raise ToolInputError(f"calc: {e}") from e
+    except OverflowError as e:
+        raise ToolLimitError(f"calc: result too large for a float") from e
@@ -0,0 +1,258 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from .config import settings
+
+log = logging.getLogger(__name__)
+
+# OTLP enums
+KIND_INTERNAL, KIND_CLIENT = 1, 3
+STATUS_OK, STATUS_ERROR = 1, 2
+
+SERVICE_NAME = "llm-task-runner"
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def _attr_value(v: Any) -> Dict[str, Any]:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        # OTLP JSON carries 64-bit ints as strings
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+def _attrs(d: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": k, "value": _attr_value(v)} for k, v in d.items() if v is not None]
+
+
+class Trace:
+    """Spans of one sampled task, exported together once the root span ends."""
+    def __init__(self) -> None:
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List[Span] = []
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attrs", "events", "status", "message")
+
+    def __init__(self, trace: Trace, name: str, parent_id: str = "", kind: int = KIND_INTERNAL,
+                 attrs: Optional[Dict[str, Any]] = None, start_ns: Optional[int] = None) -> None:
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns = 0
+        self.attrs: Dict[str, Any] = dict(attrs or {})
+        self.events: List[Dict[str, Any]] = []
+        self.status = 0
+        self.message = ""
+        trace.spans.append(self)
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def event(self, name: str, **attrs: Any) -> None:
+        self.events.append({"timeUnixNano": str(time.time_ns()), "name": name, "attributes": _attrs(attrs)})
+
+    def error(self, message: str) -> None:
+        self.status, self.message = STATUS_ERROR, message
+
+    def end(self, end_ns: Optional[int] = None) -> None:
+        self.end_ns = end_ns if end_ns is not None else time.time_ns()
+
+    def to_otlp(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or self.start_ns),
+            "attributes": _attrs(self.attrs),
+            "status": {"code": self.status or STATUS_OK, **({"message": self.message} if self.message else {})},
+        }
+        if self.parent_id:
+            out["parentSpanId"] = self.parent_id
+        if self.events:
+            out["events"] = self.events
+        return out
+
+
+class _NoopSpan:
+    """Stands in for a span when the task is not sampled, so call sites need no checks."""
+    trace = None
+    span_id = ""
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def event(self, name: str, **attrs: Any) -> None:
+        pass
+
+    def error(self, message: str) -> None:
+        pass
+
+NOOP = _NoopSpan()
+
+
+class Tracer:
+    """
+    Per-task span tracing. A task is sampled (settings.trace_sample_rate) when
+    its root span opens; spans opened while it is current become its children,
+    including inside asyncio tasks created from there, since those copy the
+    context. Outside a sampled task span() is a no-op.
+
+    Finished traces are queued and written in batches as OTLP/JSON
+    (ExportTraceServiceRequest) by a background exporter: one request per
+    line to settings.trace_export_file and/or POSTed to
+    settings.trace_export_endpoint (an OTLP/HTTP /v1/traces URL).
+    """
+    def __init__(self) -> None:
+        self._pending: Deque[Trace] = deque()
+        self._wake = asyncio.Event()
+        self._exporter: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+        self.export_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.trace_enabled
+
+    def current(self) -> Any:
+        return _current.get() or NOOP
+
+    @contextlib.contextmanager
+    def start_trace(self, name: str, attrs: Optional[Dict[str, Any]] = None, *, start_ns: Optional[int] = None) -> Iterator[Any]:
+        if not self.enabled or random.random() >= settings.trace_sample_rate:
+            yield NOOP
+            return
+        trace = Trace()
+        root = Span(trace, name, attrs=attrs, start_ns=start_ns)
+        token = _current.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.error(_describe(e))
+            raise
+        finally:
+            _current.reset(token)
+            root.end()
+            self._finish(trace)
+
+    @contextlib.contextmanager
+    def span(self, name: str, attrs: Optional[Dict[str, Any]] = None, *, kind: int = KIND_INTERNAL) -> Iterator[Any]:
+        parent = _current.get()
+        if parent is None:
+            yield NOOP
+            return
+        sp = Span(parent.trace, name, parent.span_id, kind, attrs)
+        token = _current.set(sp)
+        try:
+            yield sp
+        except BaseException as e:
+            sp.error(_describe(e))
+            raise
+        finally:
+            _current.reset(token)
+            sp.end()
+
+    def record(self, name: str, start_ns: int, end_ns: int, attrs: Optional[Dict[str, Any]] = None) -> None:
+        """Add an already finished child span, e.g. time spent before execution started."""
+        parent = _current.get()
+        if parent is not None:
+            Span(parent.trace, name, parent.span_id, KIND_INTERNAL, attrs, start_ns).end(end_ns)
+
+    def _finish(self, trace: Trace) -> None:
+        if len(self._pending) >= settings.trace_max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+        self._pending.append(trace)
+        if len(self._pending) >= settings.trace_export_batch_size:
+            self._wake.set()
+
+    def start(self) -> None:
+        if self.enabled and self._exporter is None:
+            self._exporter = asyncio.create_task(self._export_loop())
+
+    async def stop(self) -> None:
+        if self._exporter is None:
+            return
+        self._exporter.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await self._exporter
+        self._exporter = None
+        await self.flush()
+
+    async def _export_loop(self) -> None:
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), timeout=settings.trace_export_interval_seconds)
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self.export_errors += 1
+                log.warning("trace export failed: %s", e)
+
+    def _request(self, traces: List[Trace]) -> Dict[str, Any]:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _attrs({"service.name": SERVICE_NAME, "process.pid": os.getpid()})},
+                "scopeSpans": [{
+                    "scope": {"name": "app.tracing"},
+                    "spans": [s.to_otlp() for t in traces for s in t.spans],
+                }],
+            }]
+        }
+
+    async def flush(self) -> None:
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(len(self._pending), settings.trace_export_batch_size))]
+            body = json.dumps(self._request(batch), separators=(",", ":"))
+            if settings.trace_export_file:
+                await asyncio.to_thread(_append_line, settings.trace_export_file, body)
+            if settings.trace_export_endpoint:
+                import httpx
+                async with httpx.AsyncClient(timeout=5.0) as client:
+                    resp = await client.post(
+                        settings.trace_export_endpoint, content=body, headers={"Content-Type": "application/json"}
+                    )
+                    resp.raise_for_status()
+            self.exported += len(batch)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "traces_exported_total": self.exported,
+            "traces_dropped_total": self.dropped,
+            "trace_export_errors_total": self.export_errors,
+            "traces_pending": len(self._pending),
+        }
+
+
+def _describe(e: BaseException) -> str:
+    if isinstance(e, asyncio.CancelledError):
+        return "cancelled"
+    return f"{type(e).__name__}: {e}"
+
+
+def _append_line(path: str, line: str) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+tracer = Tracer()
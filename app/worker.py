@@ -1,141 +1,509 @@
 from __future__ import annotations
 import asyncio
+import contextlib
 import time
-from typing import Any, Dict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from .models import StepRecord
-from .store import InMemoryStore
+from .models import StepRecord, Task
 from .metrics import metrics
 from .config import settings
-from .retry import retry_async, RetryError
-from .redis_store import RedisStore
-from .redis_queue import RedisQueue
-from .openai_planner import planner
-from . import tools
+from .retry import retry_async, RetryError, RetryLater
+from .storage import TaskQueue, TaskStore
+from .planner import AsyncPlanner, PlannedStep, PlannerUnavailable, RoutingPlanner, StreamingPlanner, build_planner
+from .http_pool import HttpClientPool
+from .http_cache import HttpResponseCache
+from .plan_cache import PlanCache
+from .write_buffer import TaskWriteBuffer
+from .delayed_retry import DelayedRetryScheduler
+from .limiter import AdaptiveLimiter, Bulkhead, Permit
+from .resilience import CircuitOpenError, HostGuard, RetryBudget
+from .tracing import tracer, NOOP
+from .profiler import profiler, folded
+from . import calc_eval, codec, dag, plan_stream, tools
 
 class Worker:
-    def __init__(self, store: RedisStore, queue: RedisQueue) -> None:
+    def __init__(self, store: TaskStore, queue: TaskQueue, planner: AsyncPlanner | None = None) -> None:
         self.store = store
         self.queue = queue
-        self._sem = asyncio.Semaphore(settings.max_concurrent_tasks)
+        self.planner = planner or build_planner()
+        # Goals the rule planner covers skip the LLM; self.llm is what the others go to
+        self.router = self.planner if isinstance(self.planner, RoutingPlanner) else None
+        self.llm: AsyncPlanner = self.router.fallback if self.router is not None else self.planner
+        # Set when steps may start while the LLM is still writing the plan
+        self.streamer: Optional[StreamingPlanner] = (
+            self.llm if settings.planner_streaming_enabled and hasattr(self.llm, "stream_plan") else None
+        )
+        # Task concurrency adapts to latency and failures; each dependency also gets its own pool
+        self.limiter = AdaptiveLimiter("tasks")
+        self.bulkheads: Dict[str, Bulkhead] = {
+            "planner": Bulkhead("planner", settings.planner_max_concurrency),
+            "calc": Bulkhead("calc", settings.bulkhead_calc),
+            "http_get": Bulkhead("http_get", settings.bulkhead_http_get),
+        }
+        self.plan_cache = PlanCache(getattr(store, "r", None)) if settings.plan_cache_enabled else None
         self._running = False
         self._bg: asyncio.Task | None = None
+        # Dequeued but not finished (running or waiting for a slot)
+        self._active: set[asyncio.Task] = set()
+        self._slot_freed = asyncio.Event()
+        self.http = HttpClientPool()
+        self.http_cache = (
+            HttpResponseCache(getattr(store, "r", None) if settings.http_cache_redis_enabled else None)
+            if settings.http_cache_enabled else None
+        )
+        # Per-host breakers and rate limits for http_get; retries of every tool share one budget
+        self.guard = (
+            HostGuard(getattr(store, "r", None) if settings.circuit_shared else None)
+            if settings.circuit_enabled else None
+        )
+        self.retry_budget = RetryBudget()
+        # Long backoffs wait in the store's delayed set instead of holding a task slot
+        self.delayed = DelayedRetryScheduler(store, queue) if settings.delayed_retry_enabled else None
+        metrics.register_collector(self.http.snapshot)
+        if self.http_cache is not None:
+            metrics.register_collector(self.http_cache.stats)
+        metrics.register_collector(self.queue.stats, shared=True)
+        metrics.register_collector(self.store.stats)
+        metrics.register_collector(codec.stats.snapshot)
+        metrics.register_collector(calc_eval.engine.stats)
+        metrics.register_collector(tracer.stats)
+        metrics.register_collector(self.limiter.stats)
+        for b in self.bulkheads.values():
+            metrics.register_collector(b.stats)
+        if self.guard is not None:
+            metrics.register_collector(self.guard.stats)
+        metrics.register_collector(self.retry_budget.stats)
+        if self.router is not None:
+            metrics.register_collector(self.router.stats)
+        if self.delayed is not None:
+            metrics.register_collector(self.delayed.stats, shared=True)
 
     def start(self) -> None:
         if self._running:
             return
         self._running = True
         self._bg = asyncio.create_task(self._loop())
+        if self.delayed is not None:
+            self.delayed.start()
 
     async def stop(self) -> None:
         self._running = False
+        if self.delayed is not None:
+            await self.delayed.stop()
         if self._bg:
             self._bg.cancel()
             try:
                 await self._bg
-            except Exception:
+            except (asyncio.CancelledError, Exception):
                 pass
     
     async def _loop(self) -> None:
         while self._running:
-            task_id = await self.queue.dequeue_blocking(timeout_s=1)
-            asyncio.create_task(self._guarded(task_id))
+            # Only take what we can start soon; the rest stays in Redis for other nodes
+            free = self.limiter.capacity + settings.dequeue_prefetch - len(self._active)
+            if free <= 0:
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+            for task_id in await self.queue.dequeue_batch(free, timeout_s=1):
+                t = asyncio.create_task(self._guarded(task_id))
+                self._active.add(t)
+                t.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, t: asyncio.Task) -> None:
+        self._active.discard(t)
+        self._slot_freed.set()
     
     async def _guarded(self, task_id: str) -> None:
-        async with self._sem:
-            await self._execute(task_id)
+        async with self.limiter.slot() as permit:
+            outcome = await self._execute(task_id, permit)
+            permit.ignore = outcome is None
+
+    @staticmethod
+    def _congested(e: BaseException) -> bool:
+        # Timeouts and failing dependencies are a reason to back off; a bad goal, plan
+        # or expression is not, and must not shrink concurrency for every tenant
+        return isinstance(e, (asyncio.TimeoutError, RetryError, tools.ToolError, PlannerUnavailable))
 
-    async def _execute(self, task_id: str) -> None:
+    async def _execute(self, task_id: str, permit: Optional[Permit] = None) -> Optional[str]:
+        """
+        Runs the task; returns its outcome, or None when there was nothing to run.
+        A failure that signals congestion marks permit failed.
+        """
         task = await self.store.get_task(task_id)
-        if not task:
-            return
-        
-        if task.status in ("succeeded", "failed"):
-            return
-        
-        await self.store.update_task_fields(task_id, status="running")
-        await metrics.inc("tasks_running",1)
+        if not task or task.status in ("succeeded", "failed"):
+            await self.queue.ack(task_id)
+            return None
+
+        wait_s = max(0.0, (datetime.utcnow() - task.created_at).total_seconds())
+        metrics.observe("queue_wait_seconds", wait_s)
+        now_ns = time.time_ns()
+        with tracer.start_trace("task", {"task.id": task_id}, start_ns=now_ns - int(wait_s * 1e9)) as root:
+            tracer.record("queue.wait", now_ns - int(wait_s * 1e9), now_ns)
+            # Profile only traced tasks, so a slow one has a trace to carry it
+            prof = profiler.attach(task_id) if root is not NOOP and profiler.running else None
+            writer = TaskWriteBuffer(self.store, task_id)
+            # A resumed task clears the error its delayed retry left behind
+            await writer.update_task_fields(task_id, status="running", error="" if task.attempts else None)
+            metrics.gauge_add("tasks_running", 1)
+            started = time.perf_counter()
+
+            try:
+                try:
+                    await self._workflow(task, writer)
+                    await writer.update_task_fields(task_id, status="succeeded", result="Completed")
+                    outcome = "succeeded"
+                except RetryLater as e:
+                    await self._defer(task, writer, e)
+                    root.set(**{"task.retry_in_s": e.delay})
+                    outcome = "deferred"
+                except Exception as e:
+                    await writer.update_task_fields(task_id, status="failed", error=str(e))
+                    root.error(str(e))
+                    outcome = "failed"
+                    if permit is not None:
+                        permit.failed = self._congested(e)
+                # Pending steps and the terminal status go out together, steps first
+                await writer.close()
+                run_s = time.perf_counter() - started
+                root.set(**{"task.outcome": outcome})
+                metrics.inc(f"tasks_{outcome}_total")
+                metrics.observe("task_run_seconds", run_s, outcome=outcome)
+                if outcome != "deferred":
+                    metrics.observe(
+                        "task_duration_seconds",
+                        max(0.0, (datetime.utcnow() - task.created_at).total_seconds()),
+                        outcome=outcome,
+                    )
+            finally:
+                writer.cancel()
+                metrics.gauge_add("tasks_running", -1)
+                if prof is not None:
+                    profiler.detach(prof)
+                    samples = profiler.take(task_id)
+                    if time.perf_counter() - started >= settings.trace_profile_min_seconds:
+                        root.event(
+                            "profile",
+                            **{
+                                "profile.format": "folded",
+                                "profile.interval_ms": settings.trace_profile_interval_ms,
+                                "profile.samples": sum(samples.values()),
+                                "profile.stacks": folded(samples),
+                            },
+                        )
+        # Only once the terminal status is stored; otherwise a stream entry gets reclaimed
+        await self.queue.ack(task_id)
+        return outcome
+
+    async def _defer(self, task: Task, writer: TaskWriteBuffer, e: RetryLater) -> None:
+        """Stores the steps so far and the attempt state, then parks the task until its retry is due."""
+        # Only tool steps defer, and run_step sets their step_no
+        step_no = e.step_no
+        attempts = {**task.attempts, step_no: e.attempt}
+        await writer.close()
+        await self.delayed.schedule(
+            task.task_id, e.delay, attempts,
+            f"step {step_no} attempt {e.attempt} failed, retrying in {e.delay:.2f}s: {e}",
+        )
+
+    async def _workflow(self, task: Task, writer: TaskWriteBuffer) -> None:
+        task_id, goal = task.task_id, task.goal
+        stored_plan = next((s for s in task.steps if s.kind == "plan" and s.ok), None)
+        # Speculative: planning runs alongside the steps, which start as the plan streams in
+        streaming = stored_plan is None and self.streamer is not None
+        if stored_plan is not None:
+            # Resumed after a delayed retry: run against the plan already recorded
+            planned = stored_plan.output["planned_steps"]
+        elif streaming:
+            planned = []
+        else:
+            planned = await self._plan_step(task_id, goal, writer)
+
+        deps: List[List[int]] = []
+        if not streaming:
+            #Enforce step limits:
+            if len(planned) > settings.max_steps:
+                raise RuntimeError(f"too many steps planned : {len(planned)} > {settings.max_steps}")
+
+            #Execute tool steps, concurrently wherever the plan allows it
+            try:
+                deps = dag.dependencies(planned)
+            except ValueError as e:
+                raise RuntimeError(str(e)) from e
+
+        # step_no follows plan order; a run appends its records in that order too.
+        # Steps that succeeded before a delayed retry are stored already and not run again,
+        # so the re-run step lands behind them; the stores read steps back sorted.
+        stored = {s.step_no - 2: s for s in task.steps if s.kind == "tool" and s.ok}
+        records: Dict[int, StepRecord] = dict(stored)
+        finished: set[int] = set()
+        next_idx = 0
+        # Set once a step defers: failed and cancelled records of this run are not stored, they run again
+        deferring = False
+        # Tool records wait for the plan record; if the streamed plan fails they are discarded
+        plan_recorded = not streaming
+        flushing = asyncio.Lock()
+
+        async def run_step(i: int) -> None:
+            nonlocal deferring
+            if i in stored:
+                return
+            st = planned[i]
+            record = StepRecord(step_no=i + 2, kind="tool", name=st["tool"], input=st["args"])
+            records[i] = record
+            # Steps run in their own asyncio tasks, off the _execute frame the profiler watches
+            prof = profiler.attach(task_id) if profiler.running and tracer.current() is not NOOP else None
+            try:
+                with tracer.span("step", {"step.no": record.step_no, "tool": st["tool"]}):
+                    await self._run_tool_step(
+                        record, st["tool"], st["args"], attempt=task.attempts.get(record.step_no, 0) + 1,
+                    )
+            except RetryLater as e:
+                e.step_no = record.step_no
+                deferring = True
+                raise
+            finally:
+                if prof is not None:
+                    profiler.detach(prof)
+
+        def keep(i: int) -> bool:
+            return plan_recorded and i not in stored and (records[i].ok or not deferring)
+
+        async def flush() -> None:
+            nonlocal next_idx
+            async with flushing:
+                while next_idx in finished:
+                    if keep(next_idx):
+                        await writer.append_step(task_id, records[next_idx])
+                    next_idx += 1
+
+        async def settled(i: int) -> None:
+            finished.add(i)
+            if plan_recorded:
+                await flush()
+                await writer.boundary()
+
+        async def stream_plan(add: Callable[[List[int]], None]) -> None:
+            nonlocal plan_recorded
+
+            def on_step(i: int, st: PlannedStep) -> None:
+                if i < len(planned):
+                    return
+                try:
+                    step_deps = dag.step_dependencies(i, st)
+                except ValueError as e:
+                    raise RuntimeError(str(e)) from e
+                planned.append(st)
+                add(step_deps)
+
+            await self._plan_step(task_id, goal, writer, on_step=on_step)
+            # Steps that finished while the plan streamed follow the plan record
+            plan_recorded = True
+            await flush()
+            await writer.boundary()
 
         try:
-            await self._workflow(task_id, task.goal)
-            await self.store.update_task_fields(task_id, status="succeeded", result="Completed")
-            await metrics.inc("tasks_succeeded", 1)
-        except Exception as e:
-            await self.store.update_task_fields(task_id, status="failed", error=str(e))
-            await metrics.inc("tasks_failed",1)
+            await dag.run_dag(
+                deps, run_step, max_parallel=settings.max_parallel_steps, on_settled=settled,
+                feed=stream_plan if streaming else None,
+            )
         finally:
-            await metrics.dec("tasks_running", 1)
+            if not plan_recorded and records:
+                metrics.inc("plan_stream_discarded_steps_total", len(records))
+            # After a failure, steps behind a gap (never started) are still recorded
+            for i in sorted(finished):
+                if i >= next_idx and keep(i):
+                    await writer.append_step(task_id, records[i])
 
-    async def _workflow(self, task_id: str, goal: str) -> None:
-        # PLAN step
+    async def _plan_step(
+            self,
+            task_id: str,
+            goal: str,
+            writer: TaskWriteBuffer,
+            on_step: Optional[Callable[[int, PlannedStep], None]] = None,
+    ) -> List[PlannedStep]:
+        # PLAN step. With on_step, every step is handed over as soon as it is known:
+        # while the LLM streams them, or else once the plan record is written.
         t0 = time.perf_counter()
-        planned = planner.plan(goal)
-        await metrics.inc("llm_plans", 1)
+        streamed = False
+        with tracer.span("plan", {"planner": self.planner.name}) as sp:
+            planned: Optional[List[PlannedStep]] = None
+            if self.router is not None:
+                planned, route = self.router.route(goal)
+            if planned is not None:
+                used, cache = self.router.rules_name, "skipped"
+            else:
+                used = self.llm.name
+                if on_step is not None:
+                    planned, cache = await self._plan_streamed(goal, on_step)
+                    streamed = cache in ("miss", "disabled")
+                elif self.plan_cache is not None:
+                    planned, cache = await self.plan_cache.get_or_plan(
+                        goal, self.llm.name, self.llm.version, lambda: self._plan(goal)
+                    )
+                else:
+                    planned, cache = await self._plan(goal), "disabled"
+            sp.set(**{"plan.cache": cache, "plan.steps": len(planned), "planner.used": used, "plan.streamed": streamed})
+        metrics.observe("plan_latency_seconds", time.perf_counter() - t0, planner=used, cache=cache)
 
-        await self.store.append_step(
+        output: Dict[str, Any] = {
+            "planned_steps": planned,
+            "from_cache": cache in ("memory", "redis", "coalesced"),
+            "cache": cache,
+        }
+        if self.router is not None:
+            # "covered" for a rule plan, else why the LLM was asked
+            output["route"] = route
+        if streamed:
+            output["streamed"] = True
+        await writer.append_step(
             task_id,
             StepRecord(
                 step_no=1,
                 kind = "plan",
-                name="openai_planner",
+                name=used,
                 input= {"goal": goal},
-                output= {"planned_steps": planned},
+                output= output,
                 ok = True,
                 latency_ms=int((time.perf_counter() - t0) * 1000),
             ),
         )
-        
-
-        #Enforce step limits:
-        if len(planned) > settings.max_steps:
-            raise RuntimeError(f"too many steps planned : {len(planned)} > {settings.max_steps}")
-        
-        #Execute tool steps:
-        step_no = 2
-        for idx, st in enumerate(planned, start = 1):
-            tool = st["tool"]
-            args = st["args"]
-            record = StepRecord(step_no=step_no, kind="tool", name=tool_name, input=args)
-            step_no += 1
-
-            # Step timeout wrapper
-            async def run_one() -> Dict[str, Any]:
-                return await self._call_tool(tool, args)
-            
+        await writer.boundary()
+        if on_step is not None:
+            for i, st in enumerate(planned):
+                on_step(i, st)
+        return planned
+
+    async def _plan_streamed(
+            self, goal: str, on_step: Callable[[int, PlannedStep], None],
+    ) -> Tuple[List[PlannedStep], str]:
+        """Plan from the cache, else streamed from self.streamer with on_step(i, step) per complete step."""
+        if self.plan_cache is not None:
+            hit = await self.plan_cache.lookup(goal, self.llm.name, self.llm.version)
+            if hit is not None:
+                return hit
+        planned: List[PlannedStep] = []
+        w0 = time.perf_counter()
+        async with self.bulkheads["planner"]:
             s0 = time.perf_counter()
             try:
-                out = await asyncio.wait_for(
-                    retry_async(
-                        lambda: run_one(),
-                        attempts= settings.retry_max_attempts,
-                        base_delay= settings.retry_base_attempts,
-                        max_delay= settings.retry_max_attempts,
-                        jitter= settings.retry_jitter,
-                        retry_on= (tools.ToolError,),
-                    ),
-                    timeout = settings.step_timeout_seconds,
-                )
-                record.ok = True
-                record.output = out
-                await metrics.inc("tool_calls",1)
+                with tracer.span("planner.call", {"planner": self.llm.name, "planner.streamed": True, "planner.slot_wait_ms": int((s0 - w0) * 1000)}) as sp:
+                    async with asyncio.timeout(settings.planner_timeout_seconds):
+                        async with contextlib.aclosing(plan_stream.stream_steps(self.streamer.stream_plan(goal))) as steps:
+                            async for st in steps:
+                                if len(planned) >= settings.max_steps:
+                                    # Cut to max_steps like an unstreamed plan; the rest is only read for the final check
+                                    continue
+                                if not planned:
+                                    first_s = time.perf_counter() - s0
+                                    metrics.observe("plan_stream_first_step_seconds", first_s, planner=self.llm.name)
+                                    sp.set(**{"plan.first_step_ms": int(first_s * 1000)})
+                                planned.append(st)
+                                metrics.inc("plan_stream_steps_total", planner=self.llm.name)
+                                on_step(len(planned) - 1, st)
             except asyncio.TimeoutError:
-                record.ok = False
-                record.error = f"step timeout after {settings.step_timeout_seconds}s"
-                await metrics.inc("tool_failure",1)
-                raise
-            except RetryError as e:
-                record.ok = False
-                record.error = f"tool failed after retries: {e}"
-                await metrics.inc("tool_failure", 1)
-                raise
-            finally:
-                record.latency_ms = int((time.perf_counter() - s0) * 1000)
-                await self.store.append_step(task_id, record)
-                
+                raise asyncio.TimeoutError(f"planner timeout after {settings.planner_timeout_seconds}s")
+            except ValueError as e:
+                raise RuntimeError(str(e)) from e
+        # The whole stream, so it compares with unstreamed planner calls
+        self.limiter.observe("planner", time.perf_counter() - s0)
+        metrics.inc("llm_plans_total", planner=self.llm.name)
+        if self.plan_cache is None:
+            return planned, "disabled"
+        await self.plan_cache.store(goal, self.llm.name, self.llm.version, planned)
+        return planned, "miss"
+
+    async def _run_tool_step(self, record: StepRecord, tool: str, args: Dict[str, Any], attempt: int = 1) -> None:
+        # Step timeout wrapper
+        async def run_one() -> Dict[str, Any]:
+            self.retry_budget.deposit()
+            # Per attempt, so a retry's backoff sleep does not hold the tool's slot
+            bulkhead = self.bulkheads.get(tool)
+            if bulkhead is None:
+                return await self._call_tool(tool, args)
+            async with bulkhead:
+                c0 = time.perf_counter()
+                out = await self._call_tool(tool, args)
+                # Congestion signal: only calls that went over the network (calc latency follows the expression)
+                if tool == "http_get" and out.get("cache", "miss") in ("miss", "revalidated"):
+                    self.limiter.observe(tool, time.perf_counter() - c0)
+                return out
+
+        s0 = time.perf_counter()
+        outcome = "error"
+        try:
+            out = await asyncio.wait_for(
+                retry_async(
+                    lambda: run_one(),
+                    attempts= settings.retry_max_attempts,
+                    base_delay= settings.retry_base_attempts,
+                    max_delay= settings.retry_max_delay,
+                    jitter= settings.retry_jitter,
+                    retry_on= (tools.ToolError,),
+                    on_retry= lambda attempt, exc: metrics.inc("tool_retries_total", tool=tool),
+                    allow_retry= self.retry_budget.try_spend,
+                    first_attempt= attempt,
+                    defer_after= settings.delayed_retry_min_seconds if self.delayed is not None else None,
+                ),
+                timeout = settings.step_timeout_seconds,
+            )
+            record.ok = True
+            record.output = out
+            outcome = "ok"
+        except asyncio.TimeoutError:
+            record.ok = False
+            record.error = f"step timeout after {settings.step_timeout_seconds}s"
+            outcome = "timeout"
+            raise
+        except RetryLater as e:
+            record.ok = False
+            record.error = f"retry scheduled in {e.delay:.2f}s: {e}"
+            outcome = "deferred"
+            raise
+        except RetryError as e:
+            record.ok = False
+            record.error = f"tool failed after retries: {e}"
+            outcome = "error"
+            raise
+        except CircuitOpenError as e:
+            record.ok = False
+            record.error = str(e)
+            outcome = "circuit_open"
+            raise
+        except asyncio.CancelledError:
+            record.ok = False
+            record.error = "cancelled: another step failed"
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            record.ok = False
+            record.error = str(e)
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - s0
+            record.latency_ms = int(elapsed * 1000)
+            metrics.inc("tool_calls_total", tool=tool, outcome=outcome)
+            metrics.observe("tool_latency_seconds", elapsed, tool=tool, outcome=outcome)
+
+    async def _plan(self, goal: str) -> List[PlannedStep]:
+        # Own cap and timeout: a slow LLM must not eat into the tool step budget
+        w0 = time.perf_counter()
+        async with self.bulkheads["planner"]:
+            try:
+                s0 = time.perf_counter()
+                with tracer.span("planner.call", {"planner": self.llm.name, "planner.slot_wait_ms": int((s0 - w0) * 1000)}):
+                    planned = await asyncio.wait_for(self.llm.plan(goal), timeout=settings.planner_timeout_seconds)
+                self.limiter.observe("planner", time.perf_counter() - s0)
+                metrics.inc("llm_plans_total", planner=self.llm.name)
+                return planned
+            except asyncio.TimeoutError:
+                raise asyncio.TimeoutError(f"planner timeout after {settings.planner_timeout_seconds}s")
 
     async def _call_tool(self, tool_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
         if tool_name == "http_get":
-            return await tools.http_get(args["url"])
+            return await tools.http_get(args["url"], pool=self.http, cache=self.http_cache, guard=self.guard)
         if tool_name == "calc":
             return await tools.calc(args["expr"])
         raise RuntimeError(f"unknown tool : {tool_name}")
\ No newline at end of file
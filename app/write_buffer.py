@@ -0,0 +1,100 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from .config import settings
+from .models import StepRecord
+
+
+class TaskWriteBuffer:
+    """
+    Per-task write-behind buffer in front of the store's append_step /
+    update_task_fields. Buffered mutations are coalesced (field updates
+    merge, later values win) and written as one pipelined transaction.
+
+    Modes (settings.write_behind_mode):
+    - "off": write-through, every call is one awaited store write
+    - "step": flushed at every step boundary (boundary())
+    - "interval": flushed every flush_interval_ms in the background
+    In every mode close() flushes whatever is pending together with the
+    terminal status, steps first, so a terminal task never misses records.
+    See README for the durability / visibility trade-off.
+    """
+    def __init__(self, store: Any, task_id: str, *, mode: Optional[str] = None, flush_interval_ms: Optional[int] = None) -> None:
+        self.store = store
+        self.task_id = task_id
+        self.mode = mode or settings.write_behind_mode
+        self.flush_interval_s = (flush_interval_ms or settings.write_behind_flush_interval_ms) / 1000
+        self._steps: List[StepRecord] = []
+        self._fields: Dict[str, str] = {}
+        self._lock = asyncio.Lock()
+        self._ticker: Optional[asyncio.Task] = None
+        if self.mode == "interval":
+            self._ticker = asyncio.create_task(self._tick())
+
+    async def append_step(self, task_id: str, step: StepRecord) -> None:
+        if self.mode == "off":
+            await self.store.append_step(task_id, step)
+            return
+        self._steps.append(step)
+
+    async def update_task_fields(
+            self,
+            task_id: str,
+            *,
+            status: Optional[str] = None,
+            result: Optional[str] = None,
+            error: Optional[str] = None,
+    ) -> None:
+        if self.mode == "off":
+            await self.store.update_task_fields(task_id, status=status, result=result, error=error)
+            return
+        self._fields["updated_at"] = datetime.utcnow().isoformat()
+        if status is not None:
+            self._fields["status"] = status
+        if result is not None:
+            self._fields["result"] = result
+        if error is not None:
+            self._fields["error"] = error
+
+    async def boundary(self) -> None:
+        if self.mode == "step":
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._steps and not self._fields:
+                return
+            steps, fields = self._steps, self._fields
+            self._steps, self._fields = [], {}
+            try:
+                await self.store.apply_batch(self.task_id, steps, fields)
+            except BaseException:
+                # keep them for the next flush; newer field values win
+                self._steps = steps + self._steps
+                self._fields = {**fields, **self._fields}
+                raise
+
+    async def _tick(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval_s)
+            try:
+                await self.flush()
+            except Exception:
+                # retried on the next tick, and close() re-raises if it still fails
+                pass
+
+    def cancel(self) -> None:
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+
+    async def close(self) -> None:
+        ticker, self._ticker = self._ticker, None
+        if ticker is not None:
+            ticker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await ticker
+        await self.flush()
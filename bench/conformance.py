@@ -0,0 +1,287 @@
+"""
+Storage backend conformance: the same checks against every TaskStore /
+TaskQueue / EventHub backend (app/storage.py), then a short latency probe
+per backend. Redis runs on fakeredis unless --redis-url names a local
+server (its current database is flushed).
+
+    python -m bench.conformance
+    python -m bench.conformance --redis-url redis://localhost:6379/15
+
+Exits non-zero when a check fails on any backend.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import sys
+import time
+import traceback
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.events import LocalEventHub, TaskEventHub
+from app.memory_queue import InMemoryQueue
+from app.models import StepRecord, Task
+from app.redis_queue import RedisQueue
+from app.redis_store import RedisStore
+from app.store import InMemoryStore
+
+# (store, queue, hub)
+Backend = Tuple[Any, Any, Any]
+Check = Callable[[Any, Any, Any], Awaitable[None]]
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(prog="python -m bench.conformance", description=__doc__.split("\n\n")[0])
+    p.add_argument("--redis-url", default="", help="local Redis to use; fakeredis when empty")
+    p.add_argument("--backend", choices=("all", "redis", "memory"), default="all")
+    p.add_argument("--ops", type=int, default=2000, help="operations per latency probe; 0 skips it")
+    return p.parse_args(argv)
+
+
+def _task(goal: str = "calc: 1+1", **kw: Any) -> Task:
+    return Task(goal=goal, idempotency_key=kw.pop("idempotency_key", None), **kw)
+
+
+def _step(no: int, **kw: Any) -> StepRecord:
+    return StepRecord(step_no=no, kind="tool", name="calc", input={"expr": str(no)}, output={"value": no}, **kw)
+
+
+CHECKS: List[Tuple[str, Check]] = []
+
+
+def check(fn: Check) -> Check:
+    CHECKS.append((fn.__name__, fn))
+    return fn
+
+
+@check
+async def create_and_get(store: Any, queue: Any, hub: Any) -> None:
+    t = _task(priority="high", tenant="acme")
+    created = await store.create_or_get_task(t, queue=queue)
+    assert created.task_id == t.task_id
+    got = await store.get_task(t.task_id)
+    assert got is not None and got.goal == t.goal and got.status == "queued"
+    assert (got.priority, got.tenant, got.steps, got.attempts) == ("high", "acme", [], {})
+    assert got.created_at == created.created_at
+    assert await store.get_task("missing") is None
+    assert await queue.dequeue_batch(10, timeout_s=1) == [t.task_id]
+
+
+@check
+async def idempotency(store: Any, queue: Any, hub: Any) -> None:
+    first = await store.create_or_get_task(_task(idempotency_key="k1"), queue=queue)
+    again = await store.create_or_get_task(_task("other goal", idempotency_key="k1"), queue=queue)
+    assert again.task_id == first.task_id and again.goal == first.goal
+    # Only the created task is enqueued
+    assert await queue.dequeue_batch(10, timeout_s=1) == [first.task_id]
+
+
+@check
+async def create_many(store: Any, queue: Any, hub: Any) -> None:
+    existing = await store.create_or_get_task(_task(idempotency_key="k2"))
+    res = await store.create_many([_task(), _task(idempotency_key="k2"), _task(idempotency_key="k3")], queue=queue)
+    assert [created for _, created in res] == [True, False, True]
+    assert res[1][0].task_id == existing.task_id
+    popped = await queue.dequeue_batch(10, timeout_s=1)
+    assert sorted(popped) == sorted([res[0][0].task_id, res[2][0].task_id])
+
+
+@check
+async def steps_and_fields(store: Any, queue: Any, hub: Any) -> None:
+    t = await store.create_or_get_task(_task())
+    await store.update_task_fields(t.task_id, status="running")
+    await store.append_step(t.task_id, _step(1))
+    await store.apply_batch(t.task_id, [_step(2), _step(3, ok=False, error="boom")], {"error": "partial"})
+    got = await store.get_task(t.task_id)
+    assert got.status == "running" and got.error == "partial"
+    assert [s.step_no for s in got.steps] == [1, 2, 3]
+    assert got.steps[1].output == {"value": 2} and got.steps[2].error == "boom"
+    assert [s.step_no for s in await store.get_steps(t.task_id)] == [1, 2, 3]
+    # An empty error clears it, as a resumed task does
+    await store.update_task_fields(t.task_id, status="succeeded", result="Completed", error="")
+    got = await store.get_task(t.task_id)
+    assert (got.status, got.result, got.error) == ("succeeded", "Completed", None)
+    assert got.updated_at >= got.created_at
+
+
+@check
+async def bulk_reads(store: Any, queue: Any, hub: Any) -> None:
+    a = await store.create_or_get_task(_task())
+    await store.append_step(a.task_id, _step(1))
+    got = await store.get_tasks([a.task_id, "missing", a.task_id], include_steps=False)
+    assert got[1] is None and got[0].task_id == got[2].task_id == a.task_id
+    assert got[0].steps == []
+    got = await store.get_tasks([a.task_id])
+    assert [s.step_no for s in got[0].steps] == [1]
+
+
+@check
+async def reads_are_snapshots(store: Any, queue: Any, hub: Any) -> None:
+    t = await store.create_or_get_task(_task())
+    before = await store.get_task(t.task_id)
+    await store.update_task_fields(t.task_id, status="running")
+    await store.append_step(t.task_id, _step(1))
+    assert before.status == "queued" and before.steps == []
+
+
+@check
+async def delayed_retries(store: Any, queue: Any, hub: Any) -> None:
+    t = await store.create_or_get_task(_task())
+    await store.update_task_fields(t.task_id, status="running")
+    key = "conformance:delayed"
+    await store.schedule_retry(t.task_id, delayed_key=key, delay_s=0, attempts={2: 3}, error="retrying")
+    got = await store.get_task(t.task_id)
+    assert (got.status, got.error, got.attempts) == ("queued", "retrying", {2: 3})
+    now = time.time() + 0.01
+    assert await store.retry_counts(key, now) == (1, 1)
+    assert await store.claim_retries(key, now, now + 30, 10) == [t.task_id]
+    # Leased: not claimed again until the lease runs out
+    assert await store.claim_retries(key, now, now + 30, 10) == []
+    assert await store.claim_retries(key, now + 31, now + 60, 10) == [t.task_id]
+    # Parked again after the claim: dropping with the old lease leaves the new entry
+    await store.schedule_retry(t.task_id, delayed_key=key, delay_s=5, attempts={2: 4}, error="again")
+    await store.drop_retry(key, t.task_id, now + 60)
+    assert await store.retry_counts(key, now + 100) == (1, 1)
+    assert await store.claim_retries(key, now + 100, now + 130, 10) == [t.task_id]
+    await store.drop_retry(key, t.task_id, now + 130)
+    assert await store.retry_counts(key, now + 200) == (0, 0)
+
+
+@check
+async def priorities(store: Any, queue: Any, hub: Any) -> None:
+    if settings.queue_priority_mode != "strict":
+        return
+    for prio in ("low", "normal", "high"):
+        await queue.enqueue(f"t-{prio}", priority=prio)
+    assert await queue.dequeue_batch(3, timeout_s=1) == ["t-high", "t-normal", "t-low"]
+
+
+@check
+async def tenant_fairness(store: Any, queue: Any, hub: Any) -> None:
+    if settings.queue_tenant_weights:
+        return
+    for i in range(4):
+        await queue.enqueue(f"a{i}", tenant="a")
+    for i in range(2):
+        await queue.enqueue(f"b{i}", tenant="b")
+    got = await queue.dequeue_batch(6, timeout_s=1)
+    assert got == ["a0", "b0", "a1", "b1", "a2", "a3"], got
+
+
+@check
+async def dequeue_wakes_on_enqueue(store: Any, queue: Any, hub: Any) -> None:
+    waiter = asyncio.create_task(queue.dequeue_batch(5, timeout_s=3))
+    await asyncio.sleep(0.05)
+    await queue.enqueue("late")
+    assert await asyncio.wait_for(waiter, 3) == ["late"]
+    t0 = time.monotonic()
+    assert await queue.dequeue_batch(5, timeout_s=1) == []
+    assert time.monotonic() - t0 >= 0.9
+
+
+@check
+async def events(store: Any, queue: Any, hub: Any) -> None:
+    if not settings.events_enabled:
+        return
+    t = await store.create_or_get_task(_task())
+    sub = await hub.subscribe(t.task_id)
+    try:
+        # Let a pub/sub subscription settle before publishing
+        await asyncio.sleep(0.05)
+        await store.append_step(t.task_id, _step(1))
+        await store.update_task_fields(t.task_id, status="succeeded", result="Completed")
+        got = [json.loads(await asyncio.wait_for(sub.queue.get(), 3)) for _ in range(2)]
+    finally:
+        await hub.unsubscribe(sub)
+    assert got[0]["type"] == "step" and got[0]["step"]["step_no"] == 1
+    assert got[1] == {"type": "status", "status": "succeeded", "result": "Completed"}
+
+
+async def _redis(url: str) -> Tuple[Backend, Callable[[], Awaitable[None]]]:
+    if url:
+        import redis.asyncio as redis
+        r = redis.from_url(url, decode_responses=False)
+        await r.flushdb()
+    else:
+        try:
+            import fakeredis  # type: ignore
+        except ImportError:
+            sys.exit("fakeredis is not installed: pip install fakeredis, or pass --redis-url")
+        r = fakeredis.FakeAsyncRedis()
+    hub = TaskEventHub(r)
+
+    async def close() -> None:
+        await hub.aclose()
+        await r.flushdb()
+        await r.aclose()
+    return (RedisStore(r), RedisQueue(r), hub), close
+
+
+async def _memory(url: str) -> Tuple[Backend, Callable[[], Awaitable[None]]]:
+    hub = LocalEventHub()
+
+    async def close() -> None:
+        await hub.aclose()
+    return (InMemoryStore(hub=hub), InMemoryQueue(), hub), close
+
+
+BACKENDS = {"redis": _redis, "memory": _memory}
+
+
+async def _probe(store: Any, ops: int) -> Dict[str, float]:
+    """Mean microseconds per store call, one call at a time."""
+    t = await store.create_or_get_task(_task())
+    # Reads go to a task with a typical plan's worth of steps
+    read = await store.create_or_get_task(_task())
+    await store.apply_batch(read.task_id, [_step(i) for i in range(1, 6)], {"status": "succeeded", "result": "Completed"})
+    out: Dict[str, float] = {}
+    for name, call in (
+        ("create_or_get_task", lambda i: store.create_or_get_task(_task())),
+        ("append_step", lambda i: store.append_step(t.task_id, _step(i % 50))),
+        ("update_task_fields", lambda i: store.update_task_fields(t.task_id, status="running")),
+        ("get_task", lambda i: store.get_task(read.task_id)),
+    ):
+        t0 = time.perf_counter()
+        for i in range(ops):
+            await call(i)
+        out[name] = round((time.perf_counter() - t0) / ops * 1e6, 1)
+    return out
+
+
+async def run(args: argparse.Namespace) -> int:
+    names = list(BACKENDS) if args.backend == "all" else [args.backend]
+    failed = 0
+    probes: Dict[str, Dict[str, float]] = {}
+    for backend in names:
+        for name, fn in CHECKS:
+            (store, queue, hub), close = await BACKENDS[backend](args.redis_url)
+            try:
+                await fn(store, queue, hub)
+                print(f"ok    {backend:7} {name}")
+            except Exception:
+                failed += 1
+                print(f"FAIL  {backend:7} {name}")
+                traceback.print_exc()
+            finally:
+                await close()
+        if args.ops:
+            (store, _, _), close = await BACKENDS[backend](args.redis_url)
+            try:
+                probes[backend] = await _probe(store, args.ops)
+            finally:
+                await close()
+    if probes:
+        print(f"\n{'us per call':20}" + "".join(f"{b:>12}" for b in probes))
+        for op in next(iter(probes.values())):
+            print(f"{op:20}" + "".join(f"{p[op]:>12}" for p in probes.values()))
+    print(f"\n{len(CHECKS) * len(names) - failed} passed, {failed} failed")
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    sys.exit(asyncio.run(run(_parse_args(argv))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Offline end-to-end benchmark: the FastAPI app and a Worker in one process,
+against a local Redis (--redis-url), fakeredis or the in-process backend
+(--storage memory), the stub planner and a local HTTP server for http_get. Tasks are submitted through POST /tasks at
+a fixed arrival rate; results are written as JSON for comparison across
+changes (--compare).
+
+    python -m bench.run --rate 50 --duration 20 --out bench-results.json
+
+Worker settings (concurrency, write-behind, codec, ...) come from the usual
+APP_* environment variables and are recorded in the result file.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(prog="python -m bench.run", description=__doc__.split("\n\n")[0])
+    p.add_argument("--redis-url", default="", help="local Redis to use; fakeredis when empty")
+    p.add_argument("--storage", choices=("redis", "memory"), default="redis", help="memory: in-process backend, no Redis at all")
+    p.add_argument("--rate", type=float, default=20.0, help="task arrivals per second")
+    p.add_argument("--duration", type=float, default=10.0, help="seconds of arrivals")
+    p.add_argument("--arrival", choices=("constant", "poisson"), default="constant")
+    p.add_argument("--planner-latency-ms", type=float, default=50.0)
+    p.add_argument("--http-ratio", type=float, default=0.5, help="share of tasks whose plan includes http_get")
+    p.add_argument("--http-latency-ms", type=float, default=5.0, help="local HTTP server response delay")
+    p.add_argument("--http-body-bytes", type=int, default=2048)
+    p.add_argument("--distinct-goals", type=int, default=0, help="cycle through N goals (plan cache hits); 0 = all distinct")
+    p.add_argument("--drain-timeout", type=float, default=60.0, help="seconds to wait for stragglers after the last arrival")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", default="bench-results.json")
+    p.add_argument("--compare", default="", help="earlier result file to print deltas against")
+    return p.parse_args(argv)
+
+
+class LocalHttpServer:
+    """Minimal keep-alive HTTP/1.1 server answering every GET with a fixed body."""
+    def __init__(self, latency_s: float, body_bytes: int) -> None:
+        self.latency_s = latency_s
+        self.body = b"x" * body_bytes
+        self.requests = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.port = 0
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                if not head:
+                    break
+                self.requests += 1
+                if self.latency_s > 0:
+                    await asyncio.sleep(self.latency_s)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nCache-Control: no-store\r\n"
+                    b"Content-Length: " + str(len(self.body)).encode() + b"\r\n\r\n" + self.body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    v = sorted(values)
+
+    def rank(q: float) -> float:
+        return round(v[min(len(v) - 1, int(q * len(v)))], 4)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": round(v[-1], 4)}
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+async def _redis_info(r: Any, section: str) -> Optional[Dict[str, Any]]:
+    # fakeredis has no INFO; the server-side numbers are simply missing then
+    try:
+        return await r.info(section)
+    except Exception:
+        return None
+
+
+def _commands(info: Optional[Dict[str, Any]]) -> Optional[int]:
+    if info is None:
+        return None
+    return sum(v["calls"] for k, v in info.items() if k.startswith("cmdstat_") and k != "cmdstat_info")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    # Settings are read at import time, so the planner choice has to be in place first
+    os.environ["APP_PLANNER_BACKEND"] = "stub"
+    import httpx
+    import redis.asyncio as redis
+    from fastapi import FastAPI
+
+    from app import api
+    from app.config import settings
+    from app.events import LocalEventHub, TaskEventHub
+    from app.metrics import metrics
+    from app.planner import StubPlanner
+    from app.redis_queue import RedisQueue
+    from app.redis_store import RedisStore
+    from app.redis_stream_queue import RedisStreamQueue
+    from app.memory_queue import InMemoryQueue
+    from app.store import InMemoryStore
+    from app.worker import Worker
+
+    r: Any = None
+    if args.storage == "memory":
+        backend = "none"
+    elif args.redis_url:
+        r = redis.from_url(args.redis_url, decode_responses=False)
+        await r.flushdb()
+        backend = "redis"
+    else:
+        try:
+            import fakeredis  # type: ignore
+        except ImportError:
+            sys.exit("fakeredis is not installed: pip install fakeredis, or pass --redis-url")
+        r = fakeredis.FakeAsyncRedis()
+        backend = "fakeredis"
+
+    # Fine buckets so the queue-wait quantiles below are close to exact
+    metrics.set_buckets("queue_wait_seconds", tuple(round(0.001 * 1.15 ** i, 6) for i in range(90)))
+
+    if r is None:
+        hub: Any = LocalEventHub()
+        store: Any = InMemoryStore(hub=hub)
+        queue: Any = InMemoryQueue()
+    else:
+        hub = TaskEventHub(r)
+        store = RedisStore(r)
+        queue = RedisStreamQueue(r) if settings.queue_backend == "stream" else RedisQueue(r)
+    worker = Worker(store, queue, planner=StubPlanner(latency_s=args.planner_latency_ms / 1000))
+
+    app = FastAPI()
+    app.include_router(api.router)
+    app.dependency_overrides[api.get_store] = lambda: store
+    app.dependency_overrides[api.get_queue] = lambda: queue
+    app.dependency_overrides[api.get_event_hub] = lambda: hub
+
+    http = LocalHttpServer(args.http_latency_ms / 1000, args.http_body_bytes)
+    await http.start()
+
+    rng = random.Random(args.seed)
+    n_tasks = max(1, int(args.rate * args.duration))
+    distinct = args.distinct_goals or n_tasks
+
+    def goal(i: int) -> str:
+        k = i % distinct
+        if rng.random() < args.http_ratio:
+            return f"fetch http://127.0.0.1:{http.port}/item/{k}"
+        return f"calc: {k} * 2 + 1"
+
+    cmds_before = _commands(await _redis_info(r, "commandstats"))
+    rss_before = _rss_mb()
+    task_ids: List[str] = []
+    submit_errors = 0
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def submit(g: str) -> None:
+            nonlocal submit_errors
+            try:
+                resp = await client.post("/tasks", json={"goal": g})
+                resp.raise_for_status()
+                task_ids.append(resp.json()["task_id"])
+            except Exception:
+                submit_errors += 1
+
+        worker.start()
+        t0 = time.perf_counter()
+        submitters = []
+        next_at = 0.0
+        # Open loop: arrivals follow the schedule whether or not the service keeps up
+        for i in range(n_tasks):
+            delay = t0 + next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            submitters.append(asyncio.create_task(submit(goal(i))))
+            next_at += rng.expovariate(args.rate) if args.arrival == "poisson" else 1.0 / args.rate
+        await asyncio.gather(*submitters)
+        arrivals_done = time.perf_counter()
+
+        def finished() -> float:
+            return metrics.total("tasks_succeeded_total") + metrics.total("tasks_failed_total")
+
+        deadline = arrivals_done + args.drain_timeout
+        while finished() < len(task_ids) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        wall = time.perf_counter() - t0
+        await worker.stop()
+
+        cmds_after = _commands(await _redis_info(r, "commandstats"))
+        store_stats = store.stats()
+
+        tasks = []
+        for i in range(0, len(task_ids), 500):
+            resp = await client.post("/tasks/status", json={"task_ids": task_ids[i:i + 500]})
+            tasks.extend(item["task"] for item in resp.json()["results"] if item["found"])
+
+    # Pooled keep-alive connections first, or the server's wait_closed() waits on them
+    await worker.http.aclose()
+    await http.stop()
+    mem_info = await _redis_info(r, "memory")
+    await hub.aclose()
+    if r is not None:
+        await r.aclose()
+
+    rss_end = _rss_mb()
+    terminal = [t for t in tasks if t["status"] in ("succeeded", "failed")]
+    e2e = [
+        (_ts(t["updated_at"]) - _ts(t["created_at"]))
+        for t in terminal
+    ]
+    n_done = len(terminal)
+    store_ops = sum(v for k, v in store_stats.items() if k.startswith("store_ops_total"))
+    store_rts = sum(v for k, v in store_stats.items() if k.startswith("store_round_trips_total"))
+
+    return {
+        "meta": {
+            "git_rev": _git_rev(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": sys.version.split()[0],
+            "redis_backend": backend,
+        },
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "settings": settings.model_dump(mode="json", exclude={"redis_url"}),
+        "results": {
+            "tasks_submitted": len(task_ids),
+            "submit_errors": submit_errors,
+            "tasks_finished": n_done,
+            "tasks_succeeded": sum(1 for t in terminal if t["status"] == "succeeded"),
+            "tasks_unfinished": len(task_ids) - n_done,
+            "wall_seconds": round(wall, 3),
+            "tasks_per_second": round(n_done / wall, 2) if wall else None,
+            "end_to_end_seconds": _percentiles(e2e),
+            "queue_wait_seconds": {
+                f"p{int(q * 100)}": _round(metrics.quantile("queue_wait_seconds", q)) for q in (0.5, 0.95, 0.99)
+            },
+            "redis_commands_per_task": round((cmds_after - cmds_before) / n_done, 2)
+            if n_done and cmds_before is not None and cmds_after is not None else None,
+            "store_ops_per_task": round(store_ops / n_done, 2) if n_done else None,
+            "store_round_trips_per_task": round(store_rts / n_done, 2) if n_done else None,
+            "http_requests_served": http.requests,
+            "rss_mb_start": round(rss_before, 1),
+            "rss_mb_end": round(rss_end, 1),
+            "rss_mb_peak": round(max(rss_end, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024), 1),
+            "redis_used_memory_mb": round(mem_info["used_memory"] / 2**20, 2) if mem_info else None,
+        },
+    }
+
+
+def _ts(iso: str) -> float:
+    from datetime import datetime
+    return datetime.fromisoformat(iso).timestamp()
+
+
+def _round(v: Optional[float]) -> Optional[float]:
+    return None if v is None else round(v, 4)
+
+
+def _flatten(d: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[f"{prefix}{k}"] = v
+    return out
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> str:
+    a, b = _flatten(old["results"]), _flatten(new["results"])
+    lines = [f"{'metric':40} {'before':>12} {'after':>12} {'change':>9}"]
+    for k in b:
+        if k not in a:
+            continue
+        change = f"{(b[k] - a[k]) / a[k] * 100:+.1f}%" if a[k] else ""
+        lines.append(f"{k:40} {a[k]:>12} {b[k]:>12} {change:>9}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = _parse_args(argv)
+    result = asyncio.run(run(args))
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result["results"], indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""Helpers shared by the test modules."""
+from __future__ import annotations
+import contextlib
+from typing import Any, Iterator
+
+from app.config import settings
+
+
+@contextlib.contextmanager
+def override_settings(**kw: Any) -> Iterator[None]:
+    """Sets settings attributes for the block, then puts the old values back."""
+    old = {k: getattr(settings, k) for k in kw}
+    for k, v in kw.items():
+        setattr(settings, k, v)
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            setattr(settings, k, v)
@@ -0,0 +1,108 @@
+from __future__ import annotations
+import asyncio
+import multiprocessing
+import tempfile
+import unittest
+from pathlib import Path
+from typing import List
+
+from app.archive import TaskArchive
+from app.models import Task
+
+
+def _tasks(n: int, prefix: str) -> List[Task]:
+    return [Task(task_id=f"{prefix}-{i}", goal="g" * 50, status="succeeded", idempotency_key=None) for i in range(n)]
+
+
+def _append_from_process(directory: str, prefix: str, batches: int) -> None:
+    a = TaskArchive(directory, segment_bytes=2048)
+    for b in range(batches):
+        a._append_sync(_tasks(3, f"{prefix}-{b}"))
+    a.close()
+
+
+class TaskArchiveTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.dir = self._tmp.name
+
+    def archive(self, segment_bytes: int = 1 << 20) -> TaskArchive:
+        a = TaskArchive(self.dir, segment_bytes=segment_bytes)
+        self.addCleanup(a.close)
+        return a
+
+    async def test_round_trip_across_segments(self) -> None:
+        a = self.archive(segment_bytes=512)
+        tasks = _tasks(12, "t")
+        for i in range(0, 12, 2):
+            await a.append(tasks[i: i + 2])
+        self.assertGreater(a.stats()["archive_segments"], 1)
+        for t in tasks:
+            self.assertEqual(await a.get(t.task_id), t)
+        self.assertIsNone(await a.get("missing"))
+
+    async def test_torn_tail_is_cut_off(self) -> None:
+        a = self.archive()
+        await a.append(_tasks(2, "t"))
+        a.close()
+        seg = Path(self.dir, "seg-00000000.log")
+        size = seg.stat().st_size
+        with open(seg, "ab") as f:
+            f.write(b"TA\x00\x00\x01\x00partial")
+        with self.assertLogs("app.archive", "WARNING"):
+            b = self.archive()
+        self.assertEqual(seg.stat().st_size, size)
+        self.assertEqual((await b.get("t-1")).task_id, "t-1")
+        # New records go after the cut, not after the garbage
+        await b.append(_tasks(1, "u"))
+        self.assertEqual((await self.archive().get("u-0")).task_id, "u-0")
+
+    async def test_records_missing_from_the_index_are_reindexed(self) -> None:
+        a = self.archive()
+        await a.append(_tasks(3, "t"))
+        a.close()
+        idx = Path(self.dir, "seg-00000000.idx")
+        lines = idx.read_text().splitlines(keepends=True)
+        # Crash between the record write and its index line
+        idx.write_text(lines[0])
+        b = self.archive()
+        self.assertEqual(b.stats()["archive_tasks"], 3)
+        self.assertEqual((await b.get("t-2")).task_id, "t-2")
+        self.assertEqual(len(idx.read_text().splitlines()), 3)
+
+    async def test_lookup_sees_appends_of_another_instance(self) -> None:
+        a, b = self.archive(segment_bytes=512), self.archive(segment_bytes=512)
+        await a.append(_tasks(4, "a"))
+        await b.append(_tasks(4, "b"))
+        await a.append(_tasks(4, "c"))
+        for task_id in ("a-0", "b-3", "c-3"):
+            self.assertEqual((await a.get(task_id)).task_id, task_id)
+            self.assertEqual((await b.get(task_id)).task_id, task_id)
+
+    async def test_concurrent_processes_do_not_overlap(self) -> None:
+        ctx = multiprocessing.get_context("spawn")
+        procs = [ctx.Process(target=_append_from_process, args=(self.dir, f"p{i}", 10)) for i in range(4)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            await asyncio.to_thread(p.join, 60)
+            self.assertEqual(p.exitcode, 0)
+        a = self.archive()
+        self.assertEqual(a.stats()["archive_tasks"], 4 * 10 * 3)
+        for i in range(4):
+            for b in range(10):
+                for n in range(3):
+                    task_id = f"p{i}-{b}-{n}"
+                    self.assertEqual((await a.get(task_id)).task_id, task_id)
+        # Every byte of every segment belongs to exactly one indexed record
+        ends = {}
+        for seg, off, length in sorted(a._index.values()):
+            self.assertEqual(off, ends.get(seg, 0))
+            ends[seg] = off + length
+        for seg, end in ends.items():
+            self.assertEqual(a._seg_path(seg).stat().st_size, end)
+
+
+if __name__ == "__main__":
+    unittest.main()
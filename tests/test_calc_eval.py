@@ -0,0 +1,55 @@
+from __future__ import annotations
+import unittest
+
+from app.calc_eval import CalcEngine, CalcError, CalcLimitError
+
+from .support import override_settings
+
+
+class CalcLimitsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.engine = CalcEngine()
+
+    async def asyncTearDown(self) -> None:
+        self.engine.shutdown()
+
+    async def test_cheap_expressions_run_inline(self) -> None:
+        out = await self.engine.evaluate("2**10 + 7 // 2")
+        self.assertEqual(out, {"value": 1027, "offloaded": False})
+
+    async def test_invalid_syntax(self) -> None:
+        for expr in ("__import__('os')", "1 +", "1 / 0", "'a' * 3"):
+            with self.assertRaises(CalcError, msg=expr):
+                await self.engine.evaluate(expr)
+
+    async def test_size_limits(self) -> None:
+        with override_settings(calc_max_expr_chars=20):
+            with self.assertRaisesRegex(CalcLimitError, "longer than 20 chars"):
+                await self.engine.evaluate("1+" * 20 + "1")
+        with self.assertRaisesRegex(CalcLimitError, "exponent magnitude"):
+            await self.engine.evaluate("2**1000001")
+        # Refused from the predicted size, before any of the work is done
+        with self.assertRaisesRegex(CalcLimitError, "result would exceed"):
+            await self.engine.evaluate("(2**99999)**99")
+        with self.assertRaisesRegex(CalcLimitError, "not finite"):
+            await self.engine.evaluate("1e308 * 10")
+        self.assertEqual(self.engine.rejected, 4)
+
+    async def test_large_ints_move_to_the_pool(self) -> None:
+        out = await self.engine.evaluate("3**20000 % 1000")
+        self.assertEqual(out, {"value": pow(3, 20000, 1000), "offloaded": True})
+        self.assertEqual((self.engine.inline, self.engine.offloaded), (0, 1))
+
+    async def test_deadline_kills_the_pool(self) -> None:
+        with override_settings(calc_timeout_seconds=0.001):
+            with self.assertRaisesRegex(CalcLimitError, "exceeded"):
+                await self.engine.evaluate("3**99999 % 7")
+        self.assertEqual(self.engine.deadline_exceeded, 1)
+        self.assertIsNone(self.engine._pool)
+        # The next evaluation gets a fresh pool
+        out = await self.engine.evaluate("3**99999 % 7")
+        self.assertEqual(out["value"], pow(3, 99999, 7))
+
+
+if __name__ == "__main__":
+    unittest.main()
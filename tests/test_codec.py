@@ -0,0 +1,34 @@
+from __future__ import annotations
+import json
+import unittest
+
+from app import codec
+from app.models import StepRecord
+
+from .support import override_settings
+
+
+class ApplyLimitsTest(unittest.TestCase):
+    def test_tool_output_and_error_are_capped(self) -> None:
+        step = StepRecord(step_no=2, kind="tool", name="http_get", output={"text": "x" * 50, "n": [1, "y" * 50]}, error="e" * 50)
+        with override_settings(store_max_field_chars=10, store_max_error_chars=5):
+            d = codec.apply_limits(step.model_dump(mode="json"))
+        self.assertEqual(d["output"]["text"], "x" * 10 + "...[truncated 40 chars]")
+        self.assertEqual(d["output"]["n"], [1, "y" * 10 + "...[truncated 40 chars]"])
+        self.assertEqual(d["error"], "eeeee...[truncated 45 chars]")
+
+    def test_planned_steps_survive_a_round_trip(self) -> None:
+        url = "http://example.test/" + "a" * 200
+        planned = [{"tool": "http_get", "args": {"url": url}}, {"tool": "calc", "args": {"expr": "1+" * 100 + "1"}}]
+        step = StepRecord(step_no=1, kind="plan", name="planner", output={"planned_steps": planned, "raw": "r" * 200})
+        for ser in ("json", "legacy"):
+            with override_settings(store_max_field_chars=10, store_codec=ser):
+                d = codec.decode_step_dict(codec.encode_step(step))
+                event = json.loads(codec.step_json(step))
+            self.assertEqual(d["output"]["planned_steps"], planned, ser)
+            self.assertEqual(event["output"]["planned_steps"], planned)
+            self.assertEqual(event["output"]["raw"], "r" * 10 + "...[truncated 190 chars]")
+
+
+if __name__ == "__main__":
+    unittest.main()
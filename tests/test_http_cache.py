@@ -0,0 +1,106 @@
+from __future__ import annotations
+import asyncio
+import time
+import unittest
+from email.utils import formatdate
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from app.http_cache import HttpResponseCache, freshness
+
+URL = "http://example.test/x"
+
+
+class FreshnessTest(unittest.TestCase):
+    def test_max_age_minus_age(self) -> None:
+        now = 1_000_000.0
+        storable, fresh_until, shareable = freshness(httpx.Headers({"cache-control": "max-age=60", "age": "10"}), now)
+        self.assertEqual((storable, fresh_until, shareable), (True, now + 50, True))
+
+    def test_expires_relative_to_date(self) -> None:
+        now = time.time()
+        h = httpx.Headers({"date": formatdate(now - 30, usegmt=True), "expires": formatdate(now + 90, usegmt=True)})
+        _, fresh_until, _ = freshness(h, now)
+        # Lifetime 120s from Date, of which 30s are used up
+        self.assertAlmostEqual(fresh_until, now + 90, delta=1.5)
+
+    def test_unparseable_expires_is_stale(self) -> None:
+        now = 1_000_000.0
+        self.assertEqual(freshness(httpx.Headers({"expires": "0"}), now), (True, now, True))
+
+    def test_directives(self) -> None:
+        now = 1_000_000.0
+        self.assertEqual(freshness(httpx.Headers({"cache-control": "no-store"}), now), (False, 0.0, False))
+        self.assertEqual(freshness(httpx.Headers({"vary": "*"}), now)[0], False)
+        self.assertEqual(freshness(httpx.Headers({"cache-control": "no-cache, max-age=60"}), now), (True, now, True))
+        self.assertEqual(freshness(httpx.Headers({"cache-control": "Private, max-age=60"}), now)[2], False)
+
+
+class _Origin:
+    """Fetch stand-in: answers with the scripted (status, headers) in turn and records request headers."""
+    def __init__(self, *responses: Tuple[int, Dict[str, str]], delay: float = 0.0) -> None:
+        self.responses = list(responses)
+        self.requests: List[Optional[Dict[str, str]]] = []
+        self.delay = delay
+
+    async def __call__(self, headers: Optional[Dict[str, str]]) -> Tuple[httpx.Response, Dict[str, Any]]:
+        self.requests.append(dict(headers) if headers is not None else None)
+        await asyncio.sleep(self.delay)
+        status, h = self.responses[min(len(self.requests), len(self.responses)) - 1]
+        return httpx.Response(status, headers=h), {"status_code": status, "text": "body", "bytes_read": 4}
+
+
+class HttpResponseCacheTest(unittest.IsolatedAsyncioTestCase):
+    def cache(self) -> HttpResponseCache:
+        return HttpResponseCache(None, max_bytes=1 << 20, max_entry_bytes=1 << 20, stale_s=60)
+
+    async def test_fresh_entry_served_without_request(self) -> None:
+        c, origin = self.cache(), _Origin((200, {"cache-control": "max-age=60"}))
+        self.assertEqual((await c.get(URL, origin))["cache"], "miss")
+        self.assertEqual((await c.get(URL, origin))["cache"], "hit")
+        self.assertEqual(len(origin.requests), 1)
+        self.assertEqual(c.bytes_saved, 4)
+
+    async def test_stale_entry_revalidated_with_validators(self) -> None:
+        c = self.cache()
+        origin = _Origin(
+            (200, {"cache-control": "no-cache", "etag": '"v1"'}),
+            (304, {"cache-control": "max-age=60", "etag": '"v2"'}),
+        )
+        await c.get(URL, origin)
+        out = await c.get(URL, origin)
+        self.assertEqual((out["cache"], out["text"]), ("revalidated", "body"))
+        self.assertEqual(origin.requests, [None, {"If-None-Match": '"v1"'}])
+        # The 304's max-age made the entry fresh; its ETag is used from now on
+        self.assertEqual((await c.get(URL, origin))["cache"], "hit")
+        self.assertEqual(c._mem_get(c.key(URL))["validators"]["If-None-Match"], '"v2"')
+
+    async def test_not_fresh_without_validators_is_not_kept(self) -> None:
+        c, origin = self.cache(), _Origin((200, {}))
+        await c.get(URL, origin)
+        self.assertEqual(len(c._lru), 0)
+
+    async def test_coalesced_waiters(self) -> None:
+        for headers, status, expect, fetches in (
+            ({"cache-control": "max-age=60"}, 200, "hit", 1),
+            ({"cache-control": "max-age=60"}, 503, "coalesced", 1),
+            ({"cache-control": "no-store"}, 200, "coalesced", 1),
+            ({"cache-control": "private, max-age=60"}, 200, "miss", 3),
+        ):
+            c, origin = self.cache(), _Origin((status, headers), delay=0.02)
+            outs = await asyncio.gather(*(c.get(URL, origin) for _ in range(3)))
+            self.assertEqual([o["cache"] for o in outs], ["miss", expect, expect], headers)
+            self.assertEqual(len(origin.requests), fetches, headers)
+            if expect != "hit":
+                self.assertEqual((c.hits, c.bytes_saved), (0, 0), headers)
+
+    async def test_private_responses_stay_out_of_the_lru(self) -> None:
+        c, origin = self.cache(), _Origin((200, {"cache-control": "private, max-age=60"}))
+        await c.get(URL, origin)
+        self.assertEqual(len(c._lru), 0)
+        self.assertEqual((await c.get(URL, origin))["cache"], "miss")
+
+
+if __name__ == "__main__":
+    unittest.main()
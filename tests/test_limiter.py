@@ -0,0 +1,94 @@
+from __future__ import annotations
+import asyncio
+import time
+import unittest
+from typing import List
+
+from app.limiter import AdaptiveLimiter
+
+
+def _limiter(**kw) -> AdaptiveLimiter:
+    opts = dict(initial=4, min_limit=1, max_limit=8, tolerance=2.0, decrease_ratio=0.5, adaptive=True)
+    opts.update(kw)
+    return AdaptiveLimiter("test", **opts)
+
+
+class AdaptiveLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def _wave(self, lim: AdaptiveLimiter, durations: List[float], dep_latency: float = 0.01) -> None:
+        """Runs one task per duration, all at once; each makes one dependency call of dep_latency."""
+        async def task(duration: float) -> None:
+            async with lim.slot() as permit:
+                await asyncio.sleep(0)
+                lim.observe("dep", dep_latency)
+                # Backdated rather than slept: the task took `duration` end to end
+                permit.started = time.perf_counter() - duration
+        await asyncio.gather(*(task(d) for d in durations))
+
+    async def test_full_use_raises_the_limit(self) -> None:
+        lim = _limiter()
+        # More tasks than slots keep it saturated
+        await self._wave(lim, [0.01] * 200)
+        self.assertEqual((lim.capacity, lim.decreases), (8, 0))
+        self.assertGreater(lim.increases, 0)
+
+    async def test_idle_capacity_does_not_raise_it(self) -> None:
+        lim = _limiter()
+        for _ in range(8):
+            await self._wave(lim, [0.01])
+        self.assertEqual((lim.capacity, lim.increases), (4, 0))
+
+    async def test_mixed_task_lengths_are_not_congestion(self) -> None:
+        # Rule-routed tasks take ms, planned ones seconds; the dependency itself stays healthy
+        lim = _limiter()
+        for i in range(20):
+            await self._wave(lim, [0.005, 2.0, 0.01, 5.0][i % 4:] + [0.005])
+        self.assertEqual(lim.decreases, 0)
+
+    async def test_slow_dependency_cuts_the_limit(self) -> None:
+        lim = _limiter()
+        await self._wave(lim, [0.01] * 4)
+        await self._wave(lim, [0.01], dep_latency=0.5)
+        self.assertEqual((lim.capacity, lim.decreases), (2, 1))
+        # The long-run average moved only a little towards the outlier
+        self.assertLess(lim.dep_latency["dep"], 0.05)
+
+    async def test_failures_cut_at_most_once_per_average_latency(self) -> None:
+        lim = _limiter(initial=8)
+        await self._wave(lim, [10.0])
+        for _ in range(3):
+            with self.assertRaises(RuntimeError):
+                async with lim.slot():
+                    raise RuntimeError("boom")
+        self.assertEqual((lim.capacity, lim.decreases), (4, 1))
+
+    async def test_limit_stays_within_bounds(self) -> None:
+        lim = _limiter(min_limit=3)
+        for _ in range(5):
+            lim._last_decrease = 0.0
+            with self.assertRaises(RuntimeError):
+                async with lim.slot():
+                    raise RuntimeError("boom")
+        self.assertEqual(lim.capacity, 3)
+
+    async def test_fixed_when_not_adaptive(self) -> None:
+        lim = _limiter(adaptive=False)
+        with self.assertRaises(RuntimeError):
+            async with lim.slot():
+                raise RuntimeError("boom")
+        self.assertEqual((lim.capacity, lim.min_limit, lim.max_limit, lim.decreases), (4, 4, 4, 0))
+
+    async def test_cancelled_waiter_hands_the_wake_up_on(self) -> None:
+        lim = _limiter(initial=1, adaptive=False)
+        await lim.acquire()
+        first = asyncio.create_task(lim.acquire())
+        second = asyncio.create_task(lim.acquire())
+        await asyncio.sleep(0)
+        lim.release()
+        # first was woken; cancelled before it ran, its turn goes to second
+        first.cancel()
+        await asyncio.wait_for(second, 1)
+        self.assertEqual(lim.in_flight, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
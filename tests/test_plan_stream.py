@@ -0,0 +1,74 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import json
+import unittest
+from typing import Any, AsyncIterator, List
+
+from app.plan_stream import StepsParser, stream_steps
+from app.planner import PlannedStep
+
+
+def _chunked(text: str, size: int) -> List[str]:
+    return [text[i: i + size] for i in range(0, len(text), size)]
+
+
+async def _stream(chunks: List[str]) -> AsyncIterator[str]:
+    for c in chunks:
+        await asyncio.sleep(0)
+        yield c
+
+
+async def _collect(text: str, size: int) -> List[PlannedStep]:
+    out: List[PlannedStep] = []
+    async with contextlib.aclosing(stream_steps(_stream(_chunked(text, size)))) as steps:
+        async for st in steps:
+            out.append(st)
+    return out
+
+
+def _calc(expr: str, **kw: Any) -> PlannedStep:
+    return {"tool": "calc", "args": {"expr": expr}, **kw}
+
+
+class StreamStepsTest(unittest.IsolatedAsyncioTestCase):
+    async def assertRejected(self, text: str, size: int, match: str) -> None:
+        with self.assertRaisesRegex(ValueError, match):
+            await _collect(text, size)
+
+    async def test_split_escapes(self) -> None:
+        # Quotes, backslashes, braces and brackets inside strings, cut at every possible point
+        steps = [
+            _calc('1+1', note='say "hi" {not a step} [nor this]'),
+            _calc('2*3', note='back\\slash \\" and \\\\'),
+            {"tool": "http_get", "args": {"url": "http://x/?q=\"}]"}, "depends_on": [0]},
+        ]
+        text = json.dumps({"goal": "a \"steps\" key in a string", "steps": steps}, indent=1)
+        for size in (1, 2, 3, 5, 7, len(text)):
+            self.assertEqual(await _collect(text, size), steps, size)
+
+    def test_steps_emitted_at_their_closing_brace(self) -> None:
+        text = json.dumps({"steps": [_calc("1+1"), _calc("2*3"), _calc("4")]})
+        parser = StepsParser()
+        at = [i for i, c in enumerate(text) for _ in parser.feed(c)]
+        self.assertEqual(len(at), 3)
+        self.assertLess(at[0], text.index('"2*3"'))
+        self.assertEqual([text[i] for i in at], ["}"] * 3)
+
+    async def test_non_object_step(self) -> None:
+        for text in ('{"steps": [1]}', '{"steps": [[{"tool": "calc"}]]}', '{"steps": [{"tool": "calc", "args": {"expr": "1"}}, "x"]}'):
+            await self.assertRejected(text, 2, "is not an object")
+
+    async def test_unknown_tool_and_bad_args(self) -> None:
+        await self.assertRejected('{"steps": [{"tool": "shell", "args": {"cmd": "ls"}}]}', 3, "unknown tool 'shell'")
+        await self.assertRejected('{"steps": [{"tool": "calc", "args": "1+1"}]}', 3, "args must be an object")
+
+    async def test_final_document_differs(self) -> None:
+        # A later duplicate "steps" key wins when the whole document is parsed
+        await self.assertRejected('{"steps": [{"tool": "calc", "args": {"expr": "1"}}], "steps": []}', 4, "differ from the streamed")
+        await self.assertRejected('{"steps": [{"tool": "calc", "args": {"expr": "1"}}]', 4, "not valid JSON")
+        self.assertEqual(await _collect("", 4), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
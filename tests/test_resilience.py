@@ -0,0 +1,133 @@
+from __future__ import annotations
+import asyncio
+import time
+import unittest
+
+from app.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, HostGuard
+
+from .support import override_settings
+
+URL = "http://flaky.test/x"
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._cm = override_settings(
+            circuit_failure_threshold=3, circuit_failure_ratio=0.5, circuit_window_seconds=10,
+            circuit_open_seconds=5, circuit_half_open_max_calls=1,
+        )
+        self._cm.__enter__()
+        self.addCleanup(self._cm.__exit__, None, None, None)
+
+    def test_opens_on_threshold_and_ratio(self) -> None:
+        b, now = CircuitBreaker("h"), time.monotonic()
+        for _ in range(4):
+            b.record(now, failed=False)
+        self.assertFalse(b.record(now, failed=True))
+        self.assertFalse(b.record(now, failed=True))
+        # 3 failures out of 7 calls: over the threshold, under the ratio
+        self.assertFalse(b.record(now, failed=True))
+        self.assertTrue(b.record(now, failed=True))
+        self.assertEqual(b.state, OPEN)
+        self.assertFalse(b.allow(now + 4.9))
+
+    def test_window_rolls_over(self) -> None:
+        b, now = CircuitBreaker("h"), time.monotonic()
+        b.record(now, failed=True)
+        b.record(now, failed=True)
+        b.record(now + 11, failed=True)
+        self.assertEqual((b.state, b.failures), (CLOSED, 1))
+
+    def test_half_open_probe(self) -> None:
+        b, now = CircuitBreaker("h"), time.monotonic()
+        b.open(now)
+        self.assertTrue(b.allow(now + 5))
+        self.assertEqual(b.state, HALF_OPEN)
+        # One probe at a time
+        self.assertFalse(b.allow(now + 5))
+        self.assertTrue(b.record(now + 6, failed=True))
+        self.assertEqual(b.state, OPEN)
+        self.assertTrue(b.allow(now + 11))
+        self.assertFalse(b.record(now + 11, failed=False))
+        self.assertEqual((b.state, b.probes), (CLOSED, 0))
+
+    def test_abandon_gives_probe_back(self) -> None:
+        b, now = CircuitBreaker("h"), time.monotonic()
+        b.open(now)
+        self.assertTrue(b.allow(now + 5))
+        b.abandon()
+        self.assertEqual(b.state, HALF_OPEN)
+        self.assertTrue(b.allow(now + 5))
+
+
+class HostGuardTest(unittest.IsolatedAsyncioTestCase):
+    async def test_failures_open_the_circuit(self) -> None:
+        g = HostGuard()
+        with override_settings(circuit_failure_threshold=2, circuit_failure_ratio=0.5, host_rate_limit_per_second=0), \
+                self.assertLogs("app.resilience", "WARNING"):
+            for _ in range(2):
+                with self.assertRaises(RuntimeError):
+                    async with g.call(URL):
+                        raise RuntimeError("boom")
+            with self.assertRaises(CircuitOpenError):
+                async with g.call(URL):
+                    self.fail("admitted through an open circuit")
+        b = g.breaker(g.host(URL))
+        self.assertEqual((b.state, b.active), (OPEN, 0))
+
+    async def test_cancelled_while_throttled_gives_probe_back(self) -> None:
+        g = HostGuard()
+        host = g.host(URL)
+        b = g.breaker(host)
+        b.open(time.monotonic(), until=time.monotonic() - 1)
+        entered = asyncio.Event()
+
+        async def probe() -> None:
+            async with g.call(URL):
+                entered.set()
+
+        with override_settings(host_rate_limit_per_second=1, host_rate_limit_burst=0.5):
+            task = asyncio.create_task(probe())
+            await asyncio.sleep(0.05)
+            self.assertEqual((b.state, b.probes, b.active), (HALF_OPEN, 1, 1))
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertFalse(entered.is_set())
+        self.assertEqual((b.state, b.probes, b.active), (HALF_OPEN, 0, 0))
+        # The next call gets to probe, and its success closes the circuit
+        with override_settings(host_rate_limit_per_second=0):
+            async with g.call(URL):
+                pass
+        self.assertEqual(b.state, CLOSED)
+
+    async def test_idle_hosts_are_swept(self) -> None:
+        g = HostGuard()
+        with override_settings(circuit_window_seconds=0.05, host_rate_limit_per_second=1000, host_rate_limit_burst=1):
+            for i in range(20):
+                async with g.call(f"http://h{i}.test/"):
+                    pass
+            g.breaker("down.test:80").open(time.monotonic())
+            self.assertEqual(len(g._breakers), 21)
+            await asyncio.sleep(0.06)
+            async with g.call("http://last.test/"):
+                pass
+        # The open breaker holds state and stays; the idle ones and their full buckets go
+        self.assertEqual(set(g._breakers), {"down.test:80", "last.test:80"})
+        self.assertEqual(set(g._buckets), {"last.test:80"})
+
+    async def test_host_label_cap(self) -> None:
+        g = HostGuard()
+        with override_settings(circuit_metrics_max_hosts=2):
+            labels = [g._host_label(f"h{i}:80") for i in range(4)]
+            self.assertEqual(labels, ["h0:80", "h1:80", "other", "other"])
+            self.assertEqual(g._host_label("h1:80"), "h1:80")
+            for i in range(4):
+                g.breaker(f"h{i}:80").open(time.monotonic())
+            stats = g.stats()
+        self.assertEqual(stats['circuit_open{host="other"}'], 2)
+        self.assertEqual(stats["circuit_tracked_hosts"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
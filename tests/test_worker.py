@@ -0,0 +1,117 @@
+from __future__ import annotations
+import json
+import unittest
+from typing import Any, AsyncIterator, Dict, List
+
+from app.config import settings
+from app.events import LocalEventHub
+from app.memory_queue import InMemoryQueue
+from app.models import Task
+from app.planner import PlannedStep, StubPlanner
+from app.store import InMemoryStore
+from app.worker import Worker
+from app import tools
+
+from .support import override_settings
+
+
+def _calc(expr: str, **kw: Any) -> PlannedStep:
+    return {"tool": "calc", "args": {"expr": expr}, **kw}
+
+
+class _ScriptedPlanner(StubPlanner):
+    """Streams a fixed plan, slowly enough for steps to start mid-stream."""
+    def __init__(self, steps: List[PlannedStep]) -> None:
+        super().__init__(latency_s=0.3, chunk_chars=8)
+        self.steps = steps
+        self.streams = 0
+
+    def arguments(self, goal: str) -> str:
+        return json.dumps({"steps": self.steps})
+
+    async def stream_plan(self, goal: str) -> AsyncIterator[str]:
+        self.streams += 1
+        async for chunk in super().stream_plan(goal):
+            yield chunk
+
+
+class _ScriptedWorker(Worker):
+    """calc calls are counted; fail[expr] is raised once per listed exception."""
+    def __init__(self, planner: StubPlanner, fail: Dict[str, List[Exception]]) -> None:
+        super().__init__(InMemoryStore(hub=LocalEventHub()), InMemoryQueue(), planner=planner)
+        self.fail = fail
+        self.calls: Dict[str, int] = {}
+
+    async def _call_tool(self, tool_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        expr = args.get("expr", "")
+        self.calls[expr] = self.calls.get(expr, 0) + 1
+        if self.fail.get(expr):
+            raise self.fail[expr].pop(0)
+        return await super()._call_tool(tool_name, args)
+
+    async def submit(self, goal: str) -> str:
+        t = await self.store.create_or_get_task(Task(goal=goal, idempotency_key=None))
+        return t.task_id
+
+
+class StreamedPlanTest(unittest.IsolatedAsyncioTestCase):
+    async def test_deferred_step_keeps_plan_and_order(self) -> None:
+        planner = _ScriptedPlanner([_calc("1+1"), _calc("2+2"), _calc("3+3")])
+        w = _ScriptedWorker(planner, {"2+2": [tools.ToolError("flaky")]})
+        # Every retry parks the task, however short its backoff
+        with override_settings(delayed_retry_enabled=True, delayed_retry_min_seconds=0.0, retry_max_attempts=3):
+            task_id = await w.submit("streamed deferral")
+            self.assertEqual(await w._execute(task_id), "deferred")
+            t = await w.store.get_task(task_id)
+            self.assertEqual((t.status, t.attempts), ("queued", {3: 1}))
+            kinds = [(s.step_no, s.kind, s.ok) for s in t.steps]
+            self.assertEqual(kinds[0], (1, "plan", True))
+            self.assertIn((2, "tool", True), kinds)
+            self.assertTrue(all(ok for _, _, ok in kinds), kinds)
+            # Resumed: the recorded plan is reused and step 2 does not run again
+            self.assertEqual(await w._execute(task_id), "succeeded")
+            t = await w.store.get_task(task_id)
+        self.assertEqual(planner.streams, 1)
+        self.assertEqual((w.calls["1+1"], w.calls["2+2"]), (1, 2))
+        # Step 3 is stored after step 4, but reads come back in step_no order
+        self.assertEqual([s.step_no for s in t.steps], [1, 2, 3, 4])
+        self.assertEqual([s.step_no for s in await w.store.get_steps(task_id)], [1, 2, 3, 4])
+
+    async def test_failed_step_keeps_records(self) -> None:
+        planner = _ScriptedPlanner([_calc("1+1"), _calc("2+2"), _calc("3+3")])
+        w = _ScriptedWorker(planner, {"2+2": [RuntimeError("boom")]})
+        task_id = await w.submit("streamed failure")
+        self.assertEqual(await w._execute(task_id), "failed")
+        t = await w.store.get_task(task_id)
+        self.assertEqual((t.status, t.error), ("failed", "boom"))
+        self.assertEqual(t.steps[0].kind, "plan")
+        self.assertEqual(len(t.steps[0].output["planned_steps"]), 3)
+        by_no = {s.step_no: s for s in t.steps}
+        self.assertTrue(by_no[2].ok)
+        self.assertFalse(by_no[3].ok)
+
+    async def test_too_many_steps_are_cut(self) -> None:
+        n = settings.max_steps
+        planner = _ScriptedPlanner([_calc(f"{i}+1") for i in range(n + 1)])
+        w = _ScriptedWorker(planner, {})
+        task_id = await w.submit("streamed overflow")
+        self.assertEqual(await w._execute(task_id), "succeeded")
+        t = await w.store.get_task(task_id)
+        # Same as an unstreamed plan: the first max_steps steps run, the rest are dropped
+        self.assertEqual(len(t.steps[0].output["planned_steps"]), n)
+        self.assertEqual([s.step_no for s in t.steps], list(range(1, n + 2)))
+        self.assertNotIn(f"{n}+1", w.calls)
+
+    async def test_too_many_steps_still_checked(self) -> None:
+        # A broken document past the cut still fails the plan
+        planner = _ScriptedPlanner([_calc(f"{i}+1") for i in range(settings.max_steps + 1)])
+        planner.arguments = lambda goal: json.dumps({"steps": planner.steps})[:-1]
+        w = _ScriptedWorker(planner, {})
+        task_id = await w.submit("streamed overflow")
+        self.assertEqual(await w._execute(task_id), "failed")
+        t = await w.store.get_task(task_id)
+        self.assertIn("not valid JSON", t.error)
+        self.assertEqual(t.steps, [])
+
+if __name__ == "__main__":
+    unittest.main()